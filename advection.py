@@ -0,0 +1,348 @@
+import numpy as np
+
+import config
+import labelarchive
+
+"""
+Advection-predicted matching of plumes between slots. The labelled raster
+of the previous slot is moved forward, either by the centroid velocity of
+each plume or by a coarse block-matching flow field of the dust mask,
+before the overlap test in scan_for_plumes. Plumes which go undetected can
+be held for a number of slots and moved on until they are found again.
+"""
+
+
+def pixel_centroids(labels, ids):
+    """
+    Finds the centroid of every labelled plume in pixel coordinates
+    :param labels: 2D array of plume labels, zero outside plumes
+    :param ids: sorted array containing every label in the raster
+    :return: arrays of the centroid row and column of each ID, nan for IDs
+    with no pixels
+    """
+
+    pixels = np.nonzero(labels)
+    index = np.searchsorted(ids, labels[pixels])
+    count = np.bincount(index, minlength=ids.shape[0]).astype(float)
+    count[count == 0] = np.nan
+
+    return (np.bincount(index, weights=pixels[0],
+                        minlength=ids.shape[0]) / count,
+            np.bincount(index, weights=pixels[1],
+                        minlength=ids.shape[0]) / count)
+
+
+def advect_labels(labels, ids, shift_rows, shift_columns):
+    """
+    Moves each labelled plume rigidly by its own shift. Pixels moved off
+    the grid are dropped.
+    :param labels: 2D array of plume labels, zero outside plumes
+    :param ids: sorted array containing every label in the raster
+    :param shift_rows: array of the row shift of each ID in pixels
+    :param shift_columns: array of the column shift of each ID in pixels
+    :return: the advected raster
+    """
+
+    pixels = np.nonzero(labels)
+    values = labels[pixels]
+    index = np.searchsorted(ids, values)
+    rows = pixels[0] + np.rint(shift_rows[index]).astype(np.intp)
+    columns = pixels[1] + np.rint(shift_columns[index]).astype(np.intp)
+    inside = (rows >= 0) & (rows < labels.shape[0]) & (columns >= 0) & \
+        (columns < labels.shape[1])
+
+    advected = np.zeros_like(labels)
+    advected[rows[inside], columns[inside]] = values[inside]
+
+    return advected
+
+
+def _block_sum(array, size):
+    # Sum over non-overlapping size x size blocks, dropping any remainder
+    rows = array.shape[0] // size
+    columns = array.shape[1] // size
+    return array[:rows * size, :columns * size].reshape(
+        rows, size, columns, size).sum(axis=(1, 3))
+
+
+def block_flow(previous, current, downsample=config.FLOW_DOWNSAMPLE,
+               block=config.FLOW_BLOCK, search=config.FLOW_SEARCH):
+    """
+    Estimates a coarse displacement field between two fields by block
+    matching on a downsampled grid. Every candidate displacement is tested
+    for all blocks at once, so the only loop is over the small search
+    window.
+    :param previous: 2D array of the field at the earlier time, e.g. a
+    dust mask
+    :param current: 2D array of the field at the later time
+    :param downsample: the fields are averaged over blocks of this many
+    pixels before matching
+    :param block: size in downsampled pixels of each matched block
+    :param search: largest displacement searched, in downsampled pixels
+    :return: arrays of the row and column displacement of each block in
+    full resolution pixels
+    """
+
+    previous = _block_sum(np.asarray(previous, dtype=np.float32),
+                          downsample)
+    current = _block_sum(np.asarray(current, dtype=np.float32), downsample)
+    current = np.pad(current, search, mode='constant')
+    rows, columns = previous.shape
+
+    # Smaller displacements are tested first so they win ties, e.g. in
+    # blocks with no dust at all
+    shifts = [(i, j) for i in range(-search, search + 1) for j in
+              range(-search, search + 1)]
+    shifts.sort(key=lambda shift: shift[0] ** 2 + shift[1] ** 2)
+
+    best = None
+    for i, j in shifts:
+        shifted = current[search + i:search + i + rows,
+                          search + j:search + j + columns]
+        error = _block_sum(np.abs(shifted - previous), block)
+        if best is None:
+            best = error
+            flow_rows = np.zeros(error.shape)
+            flow_columns = np.zeros(error.shape)
+            continue
+        better = error < best
+        best[better] = error[better]
+        flow_rows[better] = i
+        flow_columns[better] = j
+
+    return flow_rows * downsample, flow_columns * downsample
+
+
+def plume_flow(labels, ids, flow_rows, flow_columns,
+               downsample=config.FLOW_DOWNSAMPLE, block=config.FLOW_BLOCK):
+    """
+    Averages a block flow field over the pixels of each plume
+    :param labels: 2D array of plume labels, zero outside plumes
+    :param ids: sorted array containing every label in the raster
+    :param flow_rows: row displacements from block_flow
+    :param flow_columns: column displacements from block_flow
+    :param downsample: the downsampling used by block_flow
+    :param block: the block size used by block_flow
+    :return: arrays of the mean row and column displacement of each ID
+    """
+
+    pixels = np.nonzero(labels)
+    index = np.searchsorted(ids, labels[pixels])
+    size = downsample * block
+    block_rows = np.minimum(pixels[0] // size, flow_rows.shape[0] - 1)
+    block_columns = np.minimum(pixels[1] // size, flow_rows.shape[1] - 1)
+
+    count = np.bincount(index, minlength=ids.shape[0]).astype(float)
+    count[count == 0] = 1
+    return (np.bincount(index, weights=flow_rows[block_rows, block_columns],
+                        minlength=ids.shape[0]) / count,
+            np.bincount(index,
+                        weights=flow_columns[block_rows, block_columns],
+                        minlength=ids.shape[0]) / count)
+
+
+## Class of advection-predicted matchers
+class AdvectionMatcher(object):
+    """
+    Holds the plumes seen within the gap tolerance, each at the position it
+    was last seen, with a velocity in pixels per minute. predict gives the
+    raster to pass to scan_for_plumes as the previous slot, and update
+    takes the result. With no mode and no gap tolerance the prediction is
+    exactly the previous slot's raster.
+    """
+
+    def __init__(self, mode=config.MATCH_MODE,
+                 gap_slots=config.MATCH_GAP_SLOTS, cadence=15,
+                 downsample=config.FLOW_DOWNSAMPLE, block=config.FLOW_BLOCK,
+                 search=config.FLOW_SEARCH):
+        """
+        :param mode: None, 'centroid' or 'flow'
+        :param gap_slots: number of slots an undetected plume is held
+        :param cadence: minutes between slots
+        :param downsample: downsampling of the flow field
+        :param block: block size of the flow field in downsampled pixels
+        :param search: largest flow displacement in downsampled pixels
+        """
+        if mode not in (None, 'centroid', 'flow'):
+            raise ValueError('Unknown matching mode ' + str(mode))
+        self.mode = mode
+        self.gap_minutes = gap_slots * cadence
+        self.downsample = downsample
+        self.block = block
+        self.search = search
+
+        self.memory = None
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.last_seen = np.zeros(0, dtype='datetime64[m]')
+        self.centroid_rows = np.zeros(0)
+        self.centroid_columns = np.zeros(0)
+        self.velocity_rows = np.zeros(0)
+        self.velocity_columns = np.zeros(0)
+        self.previous_dust = None
+        self.previous_time = None
+        self.flow_rows = None
+        self.flow_columns = None
+
+    def predict(self, time, sdf_now):
+        """
+        Moves every held plume forward to a slot
+        :param time: datetime object of the slot
+        :param sdf_now: array of SDF values of the slot
+        :return: the predicted raster of plume IDs, or None before the
+        first slot
+        """
+
+        if self.memory is None:
+            return None
+        if self.mode is None:
+            return self.memory
+
+        time = np.datetime64(time, 'm')
+        minutes = (time - self.last_seen) / np.timedelta64(1, 'm')
+        shift_rows = self.velocity_rows * minutes
+        shift_columns = self.velocity_columns * minutes
+
+        if self.mode == 'flow' and self.previous_dust is not None:
+            # Plumes seen in the previous slot are moved by the flow between
+            # it and this slot. update keeps this as their velocity if they
+            # are found again.
+            flow_rows, flow_columns = block_flow(
+                self.previous_dust, np.asarray(sdf_now) != 0,
+                self.downsample, self.block, self.search)
+            self.flow_rows, self.flow_columns = plume_flow(
+                self.memory, self.ids, flow_rows, flow_columns,
+                self.downsample, self.block)
+            seen = self.last_seen == self.previous_time
+            shift_rows[seen] = self.flow_rows[seen]
+            shift_columns[seen] = self.flow_columns[seen]
+
+        return advect_labels(self.memory, self.ids, shift_rows,
+                             shift_columns)
+
+    def update(self, time, sdf_plumes, plume_ids, sdf_now):
+        """
+        Takes the plumes found in a slot, and drops held plumes which have
+        been undetected for longer than the gap tolerance
+        :param time: datetime object of the slot
+        :param sdf_plumes: array of plume IDs from scan_for_plumes
+        :param plume_ids: sorted array of the IDs of every plume in the slot
+        :param sdf_now: array of SDF values of the slot
+        :return: sorted array of every plume ID still held, i.e. the plumes
+        of this slot and those within the gap tolerance
+        """
+
+        time = np.datetime64(time, 'm')
+        plume_ids = np.asarray(plume_ids, dtype=np.int64)
+        rows, columns = pixel_centroids(sdf_plumes, plume_ids)
+
+        # Centroid velocities come from the last two sightings of a plume
+        velocity_rows = np.zeros(plume_ids.shape[0])
+        velocity_columns = np.zeros(plume_ids.shape[0])
+        seen = np.isin(plume_ids, self.ids)
+        held = np.searchsorted(self.ids, plume_ids[seen])
+        if self.mode == 'centroid':
+            minutes = (time - self.last_seen[held]) / np.timedelta64(1, 'm')
+            velocity_rows[seen] = (rows[seen] -
+                                   self.centroid_rows[held]) / minutes
+            velocity_columns[seen] = (columns[seen] -
+                                      self.centroid_columns[held]) / minutes
+        else:
+            velocity_rows[seen] = self.velocity_rows[held]
+            velocity_columns[seen] = self.velocity_columns[held]
+        if self.mode == 'flow' and self.flow_rows is not None:
+            flowed = self.last_seen[held] == self.previous_time
+            minutes = (time - self.previous_time) / np.timedelta64(1, 'm')
+            velocity_rows[np.flatnonzero(seen)[flowed]] = \
+                self.flow_rows[held[flowed]] / minutes
+            velocity_columns[np.flatnonzero(seen)[flowed]] = \
+                self.flow_columns[held[flowed]] / minutes
+
+        # Plumes not found in this slot are held until the gap runs out
+        missing = ~np.isin(self.ids, plume_ids)
+        missing &= (time - self.last_seen) / np.timedelta64(1, 'm') <= \
+            self.gap_minutes
+        dormant = self.ids[missing]
+
+        order = np.argsort(np.concatenate((plume_ids, dormant)),
+                           kind='mergesort')
+        self.ids = np.concatenate((plume_ids, dormant))[order]
+        self.last_seen = np.concatenate((
+            np.repeat(time, plume_ids.shape[0]),
+            self.last_seen[missing]))[order]
+        self.centroid_rows = np.concatenate((
+            rows, self.centroid_rows[missing]))[order]
+        self.centroid_columns = np.concatenate((
+            columns, self.centroid_columns[missing]))[order]
+        self.velocity_rows = np.concatenate((
+            velocity_rows, self.velocity_rows[missing]))[order]
+        self.velocity_columns = np.concatenate((
+            velocity_columns, self.velocity_columns[missing]))[order]
+
+        # Held plumes stay where they were last seen, under the plumes of
+        # this slot
+        if self.memory is None or dormant.shape[0] == 0:
+            self.memory = sdf_plumes
+        else:
+            memory = np.where(np.isin(self.memory, dormant), self.memory, 0)
+            plume_pixels = sdf_plumes != 0
+            memory[plume_pixels] = sdf_plumes[plume_pixels]
+            self.memory = memory
+
+        if self.mode == 'flow':
+            self.previous_dust = np.asarray(sdf_now) != 0
+        self.previous_time = time
+        self.flow_rows = None
+        self.flow_columns = None
+
+        return self.ids
+
+    def to_arrays(self):
+        """
+        Gathers the matcher state, e.g. as extra arrays for a checkpoint
+        :return: dictionary of arrays, all prefixed 'matcher_'
+        """
+
+        arrays = {}
+        for name in ('ids', 'last_seen', 'centroid_rows',
+                     'centroid_columns', 'velocity_rows',
+                     'velocity_columns'):
+            arrays['matcher_' + name] = getattr(self, name)
+        for name in ('memory', 'previous_dust'):
+            raster = getattr(self, name)
+            if raster is not None:
+                arrays['matcher_' + name + '_runs'] = \
+                    labelarchive.encode_runs(raster.astype(np.int64))
+                arrays['matcher_' + name + '_shape'] = np.asarray(
+                    np.shape(raster))
+        if self.previous_time is not None:
+            arrays['matcher_previous_time'] = self.previous_time
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, **kwargs):
+        """
+        Rebuilds a matcher from the output of to_arrays
+        :param arrays: dictionary-like object of arrays
+        :param kwargs: the settings passed to AdvectionMatcher
+        :return: an AdvectionMatcher
+        """
+
+        matcher = cls(**kwargs)
+        for name in ('ids', 'last_seen', 'centroid_rows',
+                     'centroid_columns', 'velocity_rows',
+                     'velocity_columns'):
+            setattr(matcher, name, np.asarray(arrays['matcher_' + name]))
+        if 'matcher_memory_runs' in arrays:
+            matcher.memory = labelarchive.decode_runs(
+                arrays['matcher_memory_runs'],
+                tuple(arrays['matcher_memory_shape']))
+        if 'matcher_previous_dust_runs' in arrays:
+            matcher.previous_dust = labelarchive.decode_runs(
+                arrays['matcher_previous_dust_runs'],
+                tuple(arrays['matcher_previous_dust_shape'])) != 0
+        if 'matcher_previous_time' in arrays:
+            matcher.previous_time = np.datetime64(
+                arrays['matcher_previous_time'][()], 'm')
+
+        return matcher
@@ -0,0 +1,696 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from netCDF4 import Dataset
+from PIL import Image
+from pyresample.geometry import SwathDefinition
+from pyresample.kd_tree import resample_nearest
+from scipy import ndimage as ndi
+
+import metrics
+import pinkdust
+import plumes
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+"""
+Offline benchmarks of the tracking and imagery kernels on synthetic data,
+so scaling can be measured and speedups checked without the SEVIRI
+archive. Synthetic SDF sequences of drifting, merging and splitting
+plumes are labelled by scan_for_plumes, and synthetic BTs are composited
+by generate_image_from_array, written as frames and regridded, and a day
+of regridded slots is appended to netCDF with each chunking. Every kernel
+is timed, its throughput and peak memory recorded, and its output compared
+with a reference implementation kept here as the kernel was first written.
+"""
+
+# Wall clock with the best resolution available
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Scales run by default, as (grid shape, number of plumes, plume size in
+# pixels)
+DEFAULT_SCALES = (((250, 400), 10, 400),
+                  ((500, 800), 40, 800),
+                  ((1000, 1600), 160, 1600))
+
+# Regular grid shape the regridded writer is benchmarked on, and how many
+# times slower than 'map' chunking any other chunking may append a slot
+WRITER_SHAPE = (350, 500)
+MAX_APPEND_SLOWDOWN = 4.0
+
+
+def synthetic_sdf_sequence(n_slots=24, shape=(500, 800), n_plumes=40,
+                           plume_size=800, drift=(0.0, 2.0),
+                           merge_rate=0.05, split_rate=0.05, seed=0):
+    """
+    Generates a time series of SDFs containing drifting elliptical plumes.
+    Plumes which drift off the grid are replaced by new ones, so the
+    number of plumes stays about the same.
+    :param n_slots: the number of timesteps
+    :param shape: the (y, x) shape of the grid
+    :param n_plumes: the number of plumes at the first timestep
+    :param plume_size: the mean area of a plume in pixels
+    :param drift: the mean (row, column) velocity of the plumes in pixels
+    per timestep. Each plume's velocity is scattered around it.
+    :param merge_rate: the chance per timestep that a plume heads for its
+    nearest neighbour, so the two merge
+    :param split_rate: the chance per timestep that a plume splits into
+    two halves moving apart
+    :param seed: seed of the random generator
+    :return: uint8 array of shape (n_slots, y, x), 1 where dust is flagged
+    """
+
+    rng = np.random.RandomState(seed)
+    shape = np.asarray(shape)
+    drift = np.asarray(drift, dtype=float)
+
+    def new_plumes(n):
+        centres = rng.rand(n, 2) * shape
+        velocities = drift + rng.randn(n, 2) * max(1.0, np.hypot(*drift)) \
+            * 0.25
+        areas = plume_size * rng.uniform(0.5, 1.5, n)
+        elongations = rng.uniform(1.0, 3.0, n)
+        angles = rng.uniform(0, np.pi, n)
+        return [centres, velocities, areas, elongations, angles]
+
+    centres, velocities, areas, elongations, angles = new_plumes(n_plumes)
+    rows, columns = np.indices(tuple(shape))
+    sdfs = np.zeros((n_slots,) + tuple(shape), dtype=np.uint8)
+
+    for t in range(n_slots):
+        # Draw each plume as an ellipse of its area within its bounding box
+        minor = np.sqrt(areas / (np.pi * elongations))
+        major = minor * elongations
+        for i in range(centres.shape[0]):
+            r0, c0 = centres[i]
+            reach = int(np.ceil(major[i])) + 1
+            box = (slice(max(int(r0) - reach, 0), max(int(r0) + reach + 1,
+                                                      0)),
+                   slice(max(int(c0) - reach, 0), max(int(c0) + reach + 1,
+                                                      0)))
+            dr = rows[box] - r0
+            dc = columns[box] - c0
+            along = dr * np.sin(angles[i]) + dc * np.cos(angles[i])
+            across = dr * np.cos(angles[i]) - dc * np.sin(angles[i])
+            inside = (along / major[i]) ** 2 + (across / minor[i]) ** 2 <= 1
+            sdfs[t][box][inside] = 1
+
+        centres = centres + velocities
+
+        # Merging plumes are steered onto their nearest neighbour
+        n = centres.shape[0]
+        merging = np.flatnonzero(rng.rand(n) < merge_rate)
+        if n > 1 and merging.shape[0] > 0:
+            separation = centres[merging, None, :] - centres[None, :, :]
+            distance = np.hypot(separation[..., 0], separation[..., 1])
+            distance[np.arange(merging.shape[0]), merging] = np.inf
+            nearest = np.argmin(distance, axis=1)
+            velocities[merging] = velocities[nearest] + \
+                (centres[nearest] - centres[merging]) / 4.
+
+        # Splitting plumes are halved, and the halves move apart across
+        # their long axis
+        splitting = np.flatnonzero(rng.rand(n) < split_rate)
+        if splitting.shape[0] > 0:
+            areas[splitting] /= 2
+            push = np.stack((np.cos(angles[splitting]),
+                             -np.sin(angles[splitting])), axis=1)
+            push *= np.sqrt(areas[splitting] / np.pi)[:, None] / 2.
+            halves = [centres[splitting], velocities[splitting] - push,
+                      areas[splitting], elongations[splitting],
+                      angles[splitting]]
+            velocities[splitting] += push
+            centres, velocities, areas, elongations, angles = [
+                np.concatenate((a, b)) for a, b in
+                zip((centres, velocities, areas, elongations, angles),
+                    halves)]
+
+        # Plumes which have left the grid are replaced
+        gone = np.any((centres < 0) | (centres >= shape), axis=1)
+        kept = [a[~gone] for a in (centres, velocities, areas, elongations,
+                                   angles)]
+        added = new_plumes(int(np.count_nonzero(gone)))
+        centres, velocities, areas, elongations, angles = [
+            np.concatenate((a, b)) for a, b in zip(kept, added)]
+
+    return sdfs
+
+
+def synthetic_bts(n_slots=4, shape=(500, 800), masked_fraction=0.01,
+                  seed=0):
+    """
+    Generates smooth fields of SEVIRI BTs, with some pixels masked
+    :param n_slots: the number of timesteps
+    :param shape: the (y, x) shape of the grid
+    :param masked_fraction: the share of pixels masked in each channel
+    :param seed: seed of the random generator
+    :return: masked float32 array of shape (n_slots, y, x, 3) with
+    channels 8.7, 10.8 and 12.0
+    """
+
+    rng = np.random.RandomState(seed)
+    size = (n_slots,) + tuple(shape)
+    bt_108 = 260 + 50 * ndi.gaussian_filter(rng.rand(*size), (0, 8, 8)) + \
+        rng.randn(*size)
+    bt_087 = bt_108 - rng.uniform(-2, 16, size)
+    bt_120 = bt_108 + rng.uniform(-5, 3, size)
+    data = np.stack((bt_087, bt_108, bt_120), axis=-1).astype(np.float32)
+
+    return np.ma.array(data, mask=rng.rand(*data.shape) < masked_fraction)
+
+
+def synthetic_grid(shape=(500, 800), extent=(-21, 31, 10, 41)):
+    """
+    Generates an irregular lon/lat grid covering a region, like the
+    reprojected SEVIRI grid
+    :param shape: the (y, x) shape of the grid
+    :param extent: (lon_min, lon_max, lat_min, lat_max) of the region
+    :return: 2D arrays of longitudes and latitudes
+    """
+
+    rows, columns = np.indices(shape)
+    v = rows / float(shape[0] - 1)
+    u = columns / float(shape[1] - 1)
+    lons = extent[0] + (extent[1] - extent[0]) * u + \
+        0.3 * np.sin(np.pi * v) * (u - 0.5)
+    lats = extent[3] - (extent[3] - extent[2]) * v + \
+        0.2 * np.sin(np.pi * u) * (v - 0.5)
+
+    return lons, lats
+
+
+def synthetic_overlay(shape, spacing=16):
+    """
+    Generates a coastline overlay in the form given by
+    pinkdust.get_overlay, drawing a grid of half-transparent lines so
+    frames can be written with an overlay without pycoast
+    :param shape: the (y, x) shape of the frames
+    :param spacing: pixels between the lines
+    :return: a tuple of the flat pixel indices, their alpha (shape (n, 1))
+    and their colour multiplied by alpha (shape (n, 3))
+    """
+
+    rows, columns = np.indices(shape)
+    pixels = np.flatnonzero((rows % spacing == 0) |
+                            (columns % spacing == 0))
+    alpha = np.full((pixels.shape[0], 1), 128, dtype=np.uint16)
+    colour = np.full((pixels.shape[0], 3), 255, dtype=np.uint16)
+
+    return pixels, alpha, colour * alpha
+
+
+# Reference scan_for_plumes, as first written, with the size threshold
+# as a parameter
+def reference_scan_for_plumes(sdf_now, sdf_prev, min_size=250):
+    """
+    Scans a set of SDFs for plumes and labels them
+    :param sdf_now: array of SDF values for the current timestep
+    :param sdf_prev: array of plume labels from the previous timestep, or
+    None for the first timestep
+    :param min_size: clusters of this many pixels or fewer are not plumes
+    :return sdf_clusters: array of plume IDs for the current timestep
+    :return new_ids: IDs of plumes with no overlap with a previous plume
+    :return large_plume_ids: IDs of all plumes in the current timestep
+    """
+
+    label_objects, nb_labels = ndi.label(sdf_now)
+    sizes = np.bincount(label_objects.ravel())
+
+    # Set clusters of min_size or fewer pixels to zero
+    mask_sizes = sizes > min_size
+    mask_sizes[0] = 0
+    sdf_now = mask_sizes[label_objects]
+
+    sdf_clusters, num = ndi.label(sdf_now)
+    large_plume_ids = np.unique(sdf_clusters[sdf_clusters != 0])
+    if sdf_prev is None:
+        return sdf_clusters, large_plume_ids, large_plume_ids
+
+    # Increase the plume_ID so that they are all new
+    old_id_max = np.max(sdf_prev)
+    sdf_clusters[sdf_clusters != 0] += old_id_max
+
+    # Get an array of plumes which are overlapping
+    overlaps = (sdf_clusters > 0) & (sdf_prev > 0)
+    overlapping_ids = np.unique(sdf_clusters[overlaps])
+    large_plume_ids = np.unique(sdf_clusters[sdf_clusters != 0])
+    new_ids = np.asarray([j for j in large_plume_ids if j not in
+                          overlapping_ids], dtype=sdf_clusters.dtype)
+
+    for i in overlapping_ids:
+        prev_ids = sdf_prev[sdf_clusters == i]
+        # Take the most common of the previous IDs as the one which should
+        # be applied to the new plume
+        counts = np.bincount(prev_ids)
+        prev_id = np.argmax(counts)
+        sdf_clusters[sdf_clusters == i] = prev_id
+    large_plume_ids = np.unique(sdf_clusters[sdf_clusters != 0])
+
+    return sdf_clusters, new_ids, large_plume_ids
+
+
+# Reference generate_image_from_array for a single slot, as first written
+# except that NaNs from a negative base under the gamma are set to zero
+# rather than left to the uint8 cast
+def reference_generate_image_from_array(data_array):
+    """
+    Generate a pink dust image from an array of SEVIRI channels 8.7, 10.8
+    and 12.0
+    :param data_array: an array (optionally masked) of BTs of shape (y, x,
+    3)
+    :return rgbArray: the uint8 RGB array
+    """
+
+    IR_087 = data_array[:, :, 0]
+    IR_108 = data_array[:, :, 1]
+    IR_120 = data_array[:, :, 2]
+    (MinR, MaxR, GammaR), (MinG, MaxG, GammaG), (MinB, MaxB, GammaB) = \
+        pinkdust.DUST_RGB_PARAMETERS
+
+    # Masked array elements are replaced with zero
+    imgR = np.ma.filled(
+        (255 * (((IR_120 - IR_108) - MinR) / (MaxR - MinR)) **
+         (1.0 / GammaR)), fill_value=0)
+    imgG = np.ma.filled(
+        (255 * (((IR_108 - IR_087) - MinG) / (MaxG - MinG)) **
+         (1.0 / GammaG)), fill_value=0)
+    imgB = np.ma.filled(
+        (255 * ((IR_108 - MinB) / (MaxB - MinB)) ** (1.0 / GammaB)),
+        fill_value=0)
+
+    # Elements outside the RGB range are set to zero or 255
+    rgbArray = np.zeros((imgR.shape[0], imgR.shape[1], 3), 'uint8')
+    for i, img in enumerate((imgR, imgG, imgB)):
+        img[~(img >= 0)] = 0
+        img[img > 255] = 255
+        rgbArray[:, :, i] = img
+
+    return rgbArray
+
+
+# Reference regrid_data, as first written, searching for neighbours on
+# every call
+def reference_regrid_data(lons, lats, target_lons, target_lats, array):
+    """
+    Regrids an array from an irregular grid to a regular one
+    :param lons: 2D array of source longitudes
+    :param lats: 2D array of source latitudes
+    :param target_lons: 1D array of target longitudes
+    :param target_lats: 1D array of target latitudes
+    :param array: an array BTs or RGB values for each pixel
+    :return: the array on the regular grid
+    """
+
+    XI, YI = np.meshgrid(target_lons, target_lats)
+    def_a = SwathDefinition(lons=XI, lats=YI)
+    def_b = SwathDefinition(lons=lons, lats=lats)
+
+    return resample_nearest(def_b, array, def_a, radius_of_influence=7000)
+
+
+def measure(function, args=(), repeat=3):
+    """
+    Times a function and measures the memory it allocates. The time is the
+    best of repeat calls. Memory is traced in one further call where
+    tracemalloc is available, which numpy reports its arrays to, and
+    otherwise taken from how far the call raises the process's peak.
+    :param function: the function to call
+    :param args: tuple of arguments of the function
+    :param repeat: the number of timed calls
+    :return seconds: the fastest time of a call
+    :return peak_mb: the peak memory allocated by a call in MB
+    :return result: the return value of the last call
+    """
+
+    seconds = np.inf
+    for i in range(repeat):
+        start = _clock()
+        result = function(*args)
+        seconds = min(seconds, _clock() - start)
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            result = function(*args)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1048576.
+        finally:
+            tracemalloc.stop()
+    else:
+        peak = metrics.peak_rss()
+        result = function(*args)
+        peak_mb = metrics.peak_rss() - peak
+
+    return seconds, peak_mb, result
+
+
+def _track(scan, sdfs, min_size):
+    # Labels a whole sequence, matching each timestep to the last
+    sdf_previous = None
+    labels = []
+    for sdf_now in sdfs:
+        sdf_previous = scan(sdf_now, sdf_previous, min_size)[0]
+        labels.append(sdf_previous)
+    return labels
+
+
+def _result(kernel, seconds, peak_mb, n_items, n_pixels, identical,
+            **scale):
+    result = {'kernel': kernel, 'seconds': seconds, 'peak_mb': peak_mb,
+              'items_per_second': n_items / seconds,
+              'mpixels_per_second': n_pixels / seconds / 1e6,
+              'identical': identical}
+    result.update(scale)
+    return result
+
+
+def benchmark_scan(sdfs, min_size=250, repeat=3, check=True):
+    """
+    Times scan_for_plumes labelling and matching a whole SDF sequence
+    :param sdfs: array of SDFs of shape (time, y, x), e.g. from
+    synthetic_sdf_sequence
+    :param min_size: clusters of this many pixels or fewer are not plumes
+    :param repeat: the number of timed runs
+    :param check: if True, the labels are compared with those of
+    reference_scan_for_plumes
+    :return: dictionary of results, with throughput in slots per second
+    """
+
+    seconds, peak_mb, labels = measure(
+        _track, (plumes.scan_for_plumes, sdfs, min_size), repeat)
+    identical = None
+    if check:
+        reference = _track(reference_scan_for_plumes, sdfs, min_size)
+        identical = all(np.array_equal(a, b) for a, b in
+                        zip(labels, reference))
+
+    return _result('scan_for_plumes', seconds, peak_mb, sdfs.shape[0],
+                   sdfs.size, identical,
+                   plumes=int(np.max([np.max(l) for l in labels])))
+
+
+def benchmark_image(bts, repeat=3, check=True, tolerance=1):
+    """
+    Times generate_image_from_array compositing a stack of slots
+    :param bts: masked array of BTs of shape (time, y, x, 3), e.g. from
+    synthetic_bts
+    :param repeat: the number of timed runs
+    :param check: if True, the image is compared with that of
+    reference_generate_image_from_array
+    :param tolerance: the number of levels by which a pixel may differ
+    from the reference. Rounding in float32 can fall either side of the
+    uint8 truncation, so the images are not always bit-identical.
+    :return: dictionary of results, with throughput in slots per second
+    """
+
+    seconds, peak_mb, image = measure(pinkdust.generate_image_from_array,
+                                      (bts,), repeat)
+    identical = None
+    if check:
+        difference = max(np.max(np.abs(
+            image[i].astype(int) -
+            reference_generate_image_from_array(bts[i]))) for i in
+            range(bts.shape[0]))
+        identical = bool(difference <= tolerance)
+
+    return _result('generate_image_from_array', seconds, peak_mb,
+                   bts.shape[0], bts[..., 0].size, identical)
+
+
+def benchmark_frames(bts, repeat=3, check=True):
+    """
+    Times write_frame drawing a synthetic overlay onto frames which have
+    been through PIL, as quicklooks from an mpop scene are, and writing
+    them as PNGs
+    :param bts: masked array of BTs of shape (time, y, x, 3)
+    :param repeat: the number of timed runs
+    :param check: if True, the written frames are compared with the
+    overlay blended onto the composite by hand
+    :return: dictionary of results, with throughput in frames per second
+    """
+
+    images = [Image.fromarray(rgb) for rgb in
+              pinkdust.generate_image_from_array(bts)]
+    overlay = synthetic_overlay(bts.shape[1:3])
+    key = (pinkdust.SEVIRI_AREA_DEF, tuple(bts.shape[1:3]), 'i', 3)
+    directory = tempfile.mkdtemp()
+    filenames = [os.path.join(directory, str(i) + '.png') for i in
+                 range(len(images))]
+
+    def write_all():
+        for image, filename in zip(images, filenames):
+            pinkdust.write_frame(pinkdust.pil_frame(image), filename)
+
+    pinkdust._overlay_cache[key] = overlay
+    try:
+        seconds, peak_mb, result = measure(write_all, (), repeat)
+        identical = None
+        if check:
+            pixels, alpha, premultiplied = overlay
+            identical = True
+            for image, filename in zip(images, filenames):
+                expected = np.asarray(image).reshape(-1, 3).astype(float)
+                expected[pixels] = np.round(
+                    (expected[pixels] * (255 - alpha) + premultiplied) /
+                    255.)
+                written = np.asarray(Image.open(filename))
+                identical &= np.array_equal(
+                    written.reshape(-1, 3), expected.astype(np.uint8))
+            identical = bool(identical)
+    finally:
+        del pinkdust._overlay_cache[key]
+        shutil.rmtree(directory)
+
+    return _result('write_frame', seconds, peak_mb, bts.shape[0],
+                   bts[..., 0].size, identical)
+
+
+def benchmark_regrid(bts, lons, lats, repeat=3, check=True):
+    """
+    Times regrid_data_to_regular moving every slot of a stack onto a
+    regular grid, both with the neighbour search of a first call and with
+    the resampler cached from an earlier call
+    :param bts: masked array of BTs of shape (time, y, x, 3)
+    :param lons: 2D array of the source longitudes, e.g. from
+    synthetic_grid
+    :param lats: 2D array of the source latitudes
+    :param repeat: the number of timed runs
+    :param check: if True, the regridded slots are compared with those of
+    reference_regrid_data
+    :return: list of dictionaries of results, with throughput in slots per
+    second
+    """
+
+    def regrid_all(first_call):
+        if first_call:
+            del pinkdust._resampler_cache[:]
+        return [pinkdust.regrid_data_to_regular(lons, lats, bt) for bt in
+                bts]
+
+    results = []
+    for first_call in (True, False):
+        seconds, peak_mb, regridded = measure(regrid_all, (first_call,),
+                                              repeat)
+        results.append(_result('regrid_data_to_regular' +
+                               (' (first call)' if first_call else ''),
+                               seconds, peak_mb, bts.shape[0],
+                               bts[..., 0].size, None))
+
+    if check:
+        target_lons, target_lats = pinkdust.regular_grid(lons, lats)
+        identical = all(np.array_equal(
+            np.ma.filled(a, 0), np.ma.filled(reference_regrid_data(
+                lons, lats, target_lons, target_lats, bt), 0))
+            for a, bt in zip(regridded, bts))
+        for result in results:
+            result['identical'] = identical
+
+    return results
+
+
+def benchmark_writer(bts, n_slots=96, chunkings=('map', 'timeseries'),
+                     check=True, max_slowdown=MAX_APPEND_SLOWDOWN):
+    """
+    Times RegriddedWriter appending a day of slots to a new file with each
+    chunking, cycling through the slots of a stack. Slots are timed once,
+    as a day takes seconds to write.
+    :param bts: masked array of BTs of shape (time, y, x, 3) on a regular
+    grid
+    :param n_slots: the number of slots appended
+    :param chunkings: keys of pinkdust.CHUNK_SHAPES, the first of which
+    the append cost of the others is compared with
+    :param check: if True, the file is read back and compared with the
+    slots appended
+    :param max_slowdown: how many times slower than the first chunking
+    the others may append a slot
+    :return: list of dictionaries of results, with throughput in slots per
+    second and the slowdown against the first chunking
+    """
+
+    lats = np.linspace(10, 41, bts.shape[1])
+    lons = np.linspace(-21, 31, bts.shape[2])
+    cloud_mask = np.zeros(bts.shape[1:3], dtype=np.float32)
+    start = datetime.datetime(2010, 6, 1)
+    slots = [start + datetime.timedelta(minutes=15 * i) for i in
+             range(n_slots)]
+    directory = tempfile.mkdtemp()
+
+    def write_day(filename, chunking):
+        if os.path.exists(filename):
+            os.remove(filename)
+        with pinkdust.RegriddedWriter(filename, lons, lats,
+                                      chunking=chunking) as writer:
+            for i, slot in enumerate(slots):
+                bt = bts[i % bts.shape[0]]
+                writer.append(slot, bt[..., 0], bt[..., 1], bt[..., 2],
+                              cloud_mask)
+
+    results = []
+    try:
+        for chunking in chunkings:
+            filename = os.path.join(directory, chunking + '.nc')
+            seconds, peak_mb, result = measure(write_day,
+                                               (filename, chunking), 1)
+            identical = None
+            if check:
+                ncfile = Dataset(filename)
+                written = ncfile.variables['channel_108'][:]
+                ncfile.close()
+                expected = bts[np.arange(n_slots) % bts.shape[0], ..., 1]
+                identical = bool(
+                    np.array_equal(np.ma.getmaskarray(written),
+                                   np.ma.getmaskarray(expected)) and
+                    np.ma.allequal(written, expected))
+            results.append(_result('RegriddedWriter.append (' + chunking +
+                                   ')', seconds, peak_mb, n_slots,
+                                   n_slots * bts[0, ..., 0].size,
+                                   identical))
+    finally:
+        shutil.rmtree(directory)
+
+    # A chunking which has to recompress its chunks for every slot is far
+    # slower to append to than one chunk per slot
+    for result in results:
+        result['slowdown'] = result['seconds'] / results[0]['seconds']
+        result['within_budget'] = bool(result['slowdown'] <= max_slowdown)
+
+    return results
+
+
+def run_benchmarks(scales=DEFAULT_SCALES, n_slots=24, drift=(0.0, 2.0),
+                   merge_rate=0.05, split_rate=0.05, repeat=3, check=True,
+                   filename=None, writer_shape=WRITER_SHAPE):
+    """
+    Runs every benchmark at each scale and prints a table of the results
+    :param scales: sequence of (grid shape, number of plumes, plume size
+    in pixels)
+    :param n_slots: the number of timesteps of the SDF sequences. The
+    imagery kernels use a quarter as many.
+    :param drift: the mean (row, column) velocity of the plumes in pixels
+    per timestep
+    :param merge_rate: the chance per timestep that a plume merges
+    :param split_rate: the chance per timestep that a plume splits
+    :param repeat: the number of timed runs of each kernel
+    :param check: if True, outputs are compared with the reference
+    implementations
+    :param filename: path of a JSON-lines file to append the results to,
+    or None
+    :param writer_shape: the grid shape the regridded writer is
+    benchmarked on, or None to skip it
+    :return: list of dictionaries of results
+    """
+
+    print('%-36s %12s %8s %10s %10s %9s' % ('kernel', 'grid', 'plumes',
+                                             'items/s', 'Mpixel/s',
+                                             'peak MB'))
+    results = []
+    for shape, n_plumes, plume_size in scales:
+        scale = {'shape': list(shape), 'n_plumes': n_plumes,
+                 'plume_size': plume_size}
+        sdfs = synthetic_sdf_sequence(n_slots, shape, n_plumes, plume_size,
+                                      drift, merge_rate, split_rate)
+        bts = synthetic_bts(max(n_slots // 4, 1), shape)
+        lons, lats = synthetic_grid(shape)
+
+        scale_results = [benchmark_scan(sdfs, plume_size // 4, repeat,
+                                        check),
+                         benchmark_image(bts, repeat, check),
+                         benchmark_frames(bts, repeat, check)] + \
+            benchmark_regrid(bts, lons, lats, repeat, check)
+        for result in scale_results:
+            result.update(scale)
+            print('%-36s %12s %8d %10.1f %10.1f %9.1f%s' % (
+                result['kernel'], '%dx%d' % tuple(shape), n_plumes,
+                result['items_per_second'], result['mpixels_per_second'],
+                result['peak_mb'],
+                '  MISMATCH' if result['identical'] is False else ''))
+        results.extend(scale_results)
+
+    if writer_shape is not None:
+        writer_results = benchmark_writer(synthetic_bts(4, writer_shape),
+                                          check=check)
+        for result in writer_results:
+            result['shape'] = list(writer_shape)
+            print('%-36s %12s %8s %10.1f %10.1f %9.1f%s%s' % (
+                result['kernel'], '%dx%d' % tuple(writer_shape), '-',
+                result['items_per_second'], result['mpixels_per_second'],
+                result['peak_mb'],
+                '  MISMATCH' if result['identical'] is False else '',
+                '  SLOW' if not result['within_budget'] else ''))
+        results.extend(writer_results)
+
+    if filename is not None:
+        with open(filename, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the '
+                                     'tracking and imagery kernels on '
+                                     'synthetic data')
+    parser.add_argument('--shape', type=int, nargs=2, action='append',
+                        help='grid shape (y x), repeatable')
+    parser.add_argument('--plumes', type=int, default=40)
+    parser.add_argument('--plume-size', type=int, default=800)
+    parser.add_argument('--slots', type=int, default=24)
+    parser.add_argument('--drift', type=float, nargs=2, default=(0.0, 2.0))
+    parser.add_argument('--merge-rate', type=float, default=0.05)
+    parser.add_argument('--split-rate', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-check', action='store_true',
+                        help='skip the comparison with the references')
+    parser.add_argument('--output', help='JSON-lines file of results')
+    parser.add_argument('--writer-shape', type=int, nargs=2,
+                        default=WRITER_SHAPE,
+                        help='grid shape (y x) of the writer benchmark')
+    parser.add_argument('--no-writer', action='store_true',
+                        help='skip the writer benchmark')
+    args = parser.parse_args()
+
+    scales = DEFAULT_SCALES
+    if args.shape is not None:
+        scales = [(tuple(shape), args.plumes, args.plume_size) for shape in
+                  args.shape]
+
+    results = run_benchmarks(scales, args.slots, tuple(args.drift),
+                             args.merge_rate, args.split_rate, args.repeat,
+                             not args.no_check, args.output,
+                             None if args.no_writer else
+                             tuple(args.writer_shape))
+    if any(result['identical'] is False for result in results):
+        raise SystemExit('Outputs differ from the reference '
+                         'implementations')
+    if any(result.get('within_budget') is False for result in results):
+        raise SystemExit('Appending a slot is more than ' +
+                         str(MAX_APPEND_SLOWDOWN) + ' times slower than '
+                         'with map chunking')
@@ -0,0 +1,118 @@
+import datetime
+import os
+import numpy as np
+
+import labelarchive
+import plumes
+
+"""
+Checkpoints of the tracker state, so a long run can resume from the last
+completed slot and a near-real-time run can append newly arrived slots to
+an existing catalogue without reprocessing its history
+"""
+
+
+def save_checkpoint(filename, last_slot, sdf_previous, next_id,
+                    plume_table, **extra):
+    """
+    Saves the tracker state after a completed slot. Dead plumes are
+    already in the catalogue, so only active plumes and their history are
+    saved and a checkpoint stays the same size however long the run. The
+    file is written under a temporary name and then renamed, so an
+    interrupted save never replaces a good checkpoint.
+    :param filename: path of the checkpoint (.npz) file
+    :param last_slot: datetime object of the last completed slot
+    :param sdf_previous: array of plume labels of the last completed slot
+    :param next_id: the highest plume ID assigned so far
+    :param plume_table: the plumes.PlumeTable of the run
+    :param extra: any other arrays carried between slots, stored under
+    their keyword names
+    """
+
+    arrays = plume_table.to_arrays(active_only=True)
+    arrays['last_slot'] = np.datetime64(last_slot, 'm')
+    arrays['next_id'] = np.int64(next_id)
+
+    # The labelled raster is mostly zeros, so it is stored as runs
+    if sdf_previous is not None:
+        arrays['sdf_previous_runs'] = labelarchive.encode_runs(sdf_previous)
+        arrays['sdf_previous_shape'] = np.asarray(np.shape(sdf_previous))
+    for name in extra:
+        arrays['extra_' + name] = np.asarray(extra[name])
+
+    partial = filename + '.partial'
+    with open(partial, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(partial, filename)
+
+
+def load_checkpoint(filename):
+    """
+    Loads a checkpoint saved by save_checkpoint
+    :param filename: path of the checkpoint (.npz) file
+    :return: a dictionary with the last_slot (a datetime object),
+    sdf_previous, next_id and plume_table, plus every extra array under its
+    keyword name
+    """
+
+    saved = np.load(filename)
+    state = {'last_slot': saved['last_slot'][()].astype(datetime.datetime),
+             'next_id': int(saved['next_id']),
+             'plume_table': plumes.PlumeTable.from_arrays(saved),
+             'sdf_previous': None}
+
+    if 'sdf_previous_runs' in saved.files:
+        state['sdf_previous'] = labelarchive.decode_runs(
+            saved['sdf_previous_runs'], tuple(saved['sdf_previous_shape']))
+    for name in saved.files:
+        if name.startswith('extra_'):
+            state[name[len('extra_'):]] = saved[name]
+
+    return state
+
+
+def check_fresh_start(paths):
+    """
+    Refuses to start a new run over the outputs of an earlier one, which
+    it would be mixed up with
+    :param paths: the output files and directories of a run
+    """
+
+    existing = [path for path in paths if os.path.isfile(path) or
+                (os.path.isdir(path) and len(os.listdir(path)) > 0)]
+    if len(existing) > 0:
+        raise ValueError('Outputs of an earlier run exist: ' +
+                         ', '.join(existing) + '. Set config.RESUME to '
+                         'continue it, or remove them to start again.')
+
+
+def check_resume(datetimes, last_slot,
+                 cadence=datetime.timedelta(minutes=15)):
+    """
+    Refuses to resume from a checkpoint of another period. The last
+    completed slot must lie within the slots of the run or be the slot
+    just before them.
+    :param datetimes: array of datetime objects for the whole run
+    :param last_slot: datetime object of the last completed slot
+    :param cadence: time between slots
+    """
+
+    if len(datetimes) == 0 or last_slot < datetimes[0] - cadence or \
+            last_slot > datetimes[-1]:
+        raise ValueError('The checkpoint ends at ' + str(last_slot) +
+                         ', outside the slots of this run')
+
+
+def pending_slots(datetimes, last_slot):
+    """
+    Selects the slots which still need tracking after a checkpoint
+    :param datetimes: array of datetime objects for the whole run
+    :param last_slot: datetime object of the last completed slot, or None
+    :return: array of the datetime objects after last_slot
+    """
+
+    datetimes = np.asarray(datetimes)
+    if last_slot is None:
+        return datetimes
+
+    return datetimes[datetimes > last_slot]
@@ -0,0 +1,131 @@
+"""
+Paths and parameters shared by the plume tracking modules
+"""
+
+# Root of the native 15-minute SEVIRI archive
+SEVIRI_ROOT = '/ouce-home/data/satellite/meteosat/seviri/15-min/native/'
+
+# File templates for a single 15-minute slot. These are formatted with the
+# month directory (e.g. JUNE2012) and the slot date string (e.g.
+# 201206221800)
+SDF_FILE = SEVIRI_ROOT + 'sdf/nc/{month}/SDF_v2/SDF_v2.{date}.nc'
+BT_FILE = SEVIRI_ROOT + 'bt/nc/{month}/H-000-MSG2__-MSG2________-' \
+                        'IR_BrightnessTemperatures___-000005___-{date}-__.nc'
+
+# Longitude and latitude of each pixel of the SDF and BT grids
+LONLAT_FILE = SEVIRI_ROOT + 'lonlats.NA_MiddleEast.nc'
+
+# Clusters of this many pixels or fewer are not treated as plumes
+MIN_PLUME_SIZE = 250
+
+# Variable holding the field of interest in the SDF and BT files
+SDF_VARIABLE = 'bt108'
+BT_VARIABLE = 'bt108'
+
+# Number of leading slots of each chunk of a parallel run whose labels are
+# kept for stitching. Chunks which have not rejoined the serial labels by
+# then are tracked again in full when stitched.
+STITCH_SLOTS = 96
+
+# Number of slots read ahead of the tracker by the background reader
+PREFETCH_SLOTS = 4
+
+# Directory where reprojected lon/lat grids are cached between runs
+PROJECTION_CACHE_DIR = 'projection_cache'
+
+# Directory of the run-length encoded archive of labelled plume rasters
+LABEL_ARCHIVE_DIR = 'plume_labels'
+
+# Tracker state checkpoint, and the number of slots between checkpoints
+CHECKPOINT_FILE = 'tracker_checkpoint.npz'
+CHECKPOINT_INTERVAL = 16
+
+# If True, a run resumes from CHECKPOINT_FILE, which must end within the
+# requested period or at the slot just before it. If False, a run starts
+# fresh and refuses to start while the outputs of an earlier run exist.
+RESUME = False
+
+# Region of interest as (lon_min, lon_max, lat_min, lat_max). Only the
+# smallest window of the grid containing it is read and tracked. None
+# tracks the whole domain.
+REGION = None
+
+# Number of worker threads loading SEVIRI channels for a batch of slots
+CHANNEL_LOAD_WORKERS = 4
+
+# Number of worker threads rendering and writing dust RGB frames
+RENDER_WORKERS = 4
+
+# Directory where dust RGB quicklooks are written
+IMAGERY_DIR = '/ouce-home/students/hert4173/SEVIRI_imagery/'
+
+# GSHHS coastline and border data for the quicklook overlays
+GSHHS_DATA_ROOT = '/ouce-home/students/hert4173/.conda_envs/virtual_env/' \
+                  'lib/python2.7/pycoast/GSHHS_DATA_ROOT'
+
+# Directory where plume maps are written for every slot, or None to skip
+# plotting
+PLUME_MAP_DIR = None
+
+# Pixels with a 10.8 micron BT below this many Kelvin are deep convective
+# cloud tops
+DEEP_CONVECTION_BT = 220.0
+
+# Convective cells of this many pixels or fewer are not tracked
+MIN_CONVECTION_SIZE = 20
+
+# Plumes with a convective cell within this many pixels are associated
+# with it
+CONVECTION_RADIUS = 10
+
+# Plumes are scored as LLJ or CPO driven once they are this many hours old,
+# or when they die if sooner
+CLASSIFICATION_AGE = 1.0
+
+# Local solar hours around which LLJ and CPO driven emission peak
+LLJ_PEAK_HOUR = 9.0
+CPO_PEAK_HOUR = 18.0
+
+# Centroid speed (m/s) typical of plumes raised by a CPO
+CPO_SPEED = 10.0
+
+# Direction of travel (degrees clockwise from north) of plumes carried by
+# the north-easterly LLJ
+LLJ_DIRECTION = 225.0
+
+# Parent-to-child edges of every plume merge and split in the run
+LINEAGE_FILE = 'plume_lineage.npz'
+
+# If True, when a plume splits only its largest fragment keeps its ID and
+# the others become new plumes descended from it in the lineage. If False,
+# every fragment keeps the parent's ID.
+SPLIT_NEW_IDS = True
+
+# How plumes are matched between slots. None matches plumes which overlap
+# the previous slot. 'centroid' first moves each previous plume by its
+# centroid velocity, and 'flow' by a block-matching flow field of the dust
+# mask, so fast plumes and plumes after a missing slot keep their IDs.
+MATCH_MODE = None
+
+# Plumes which go undetected for up to this many slots keep their ID if
+# they are found again
+MATCH_GAP_SLOTS = 0
+
+# Block-matching flow: the dust mask is averaged over blocks of
+# FLOW_DOWNSAMPLE pixels, and displacements of up to FLOW_SEARCH coarse
+# pixels are searched for each block of FLOW_BLOCK coarse pixels
+FLOW_DOWNSAMPLE = 4
+FLOW_BLOCK = 8
+FLOW_SEARCH = 3
+
+# Per-slot timings and memory of every stage of the tracker are appended to
+# METRICS_FILE (JSON lines, or None to not log them), and a summary of the
+# run is written to METRICS_SUMMARY_FILE
+METRICS_FILE = 'tracking_metrics.jsonl'
+METRICS_SUMMARY_FILE = 'tracking_metrics_summary.json'
+
+# If True, memory allocations are traced while the tracker runs so the peak
+# memory of each stage can be measured. This needs Python 3.9 or later and
+# slows allocation down, so it can be turned off for long runs. Resident
+# memory growth is measured either way.
+METRICS_TRACE_MEMORY = True
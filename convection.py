@@ -0,0 +1,176 @@
+import numpy as np
+from scipy import ndimage as ndi
+
+import config
+import labelarchive
+import plumes
+
+"""
+Detection and tracking of deep convective cells from brightness
+temperatures, and their association with dust plumes. Cells are labelled
+and matched between timesteps with the same engine as plumes, and their
+attributes are kept in a PlumeTable.
+"""
+
+
+def find_deep_convection(bt, threshold=config.DEEP_CONVECTION_BT):
+    """
+    Flags deep convective cloud tops
+    :param bt: array (optionally masked) of 10.8 micron BTs in Kelvin
+    :param threshold: BT below which a pixel is deep convection
+    :return: boolean array, False wherever the BT is masked
+    """
+
+    return np.ma.filled(np.ma.less(bt, threshold), False)
+
+
+# Global function to associate each plume with its nearest convective cell
+def associate_convection(sdf_plumes, plume_ids, cells,
+                         radius=config.CONVECTION_RADIUS):
+    """
+    Finds the nearest convective cell to every plume, from a single
+    distance transform of the cell raster
+    :param sdf_plumes: array of plume IDs from scan_for_plumes
+    :param plume_ids: sorted array of the IDs of every active plume
+    :param cells: array of convective cell IDs on the same grid
+    :param radius: cells further than this many pixels from every pixel of
+    a plume are not associated with it
+    :return cell_match: array with the ID of the nearest cell to each
+    plume, or 0 where there is none within radius
+    :return cell_distance: array with the distance in pixels from each
+    plume to that cell, or inf where there is none within radius
+    """
+
+    plume_ids = np.asarray(plume_ids)
+    cell_match = np.zeros(plume_ids.shape[0], dtype=np.int64)
+    cell_distance = np.empty(plume_ids.shape[0])
+    cell_distance[:] = np.inf
+    if plume_ids.shape[0] == 0 or not np.any(cells):
+        return cell_match, cell_distance
+
+    # Distance from every pixel to the nearest convective pixel, and the
+    # cell that pixel belongs to
+    distance, indices = ndi.distance_transform_edt(cells == 0,
+                                                   return_indices=True)
+
+    plume_pixels = np.nonzero(sdf_plumes)
+    rows = np.searchsorted(plume_ids, sdf_plumes[plume_pixels])
+    pixel_distance = distance[plume_pixels]
+    pixel_cell = cells[tuple(indices[:, plume_pixels[0],
+                                     plume_pixels[1]])]
+
+    # Sort the plume pixels by plume then distance, so the first pixel of
+    # each plume is its closest to convection
+    order = np.lexsort((pixel_distance, rows))
+    rows = rows[order]
+    first = np.ones(rows.shape[0], dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    rows = rows[first]
+    nearest = pixel_distance[order][first]
+    in_range = nearest <= radius
+
+    cell_match[rows[in_range]] = pixel_cell[order][first][in_range]
+    cell_distance[rows[in_range]] = nearest[in_range]
+
+    return cell_match, cell_distance
+
+
+## Class of convection trackers
+class ConvectionTracker(object):
+    """
+    Tracks deep convective cells from slot to slot. The BT field is
+    thresholded once per slot, and the cells are labelled and matched to
+    the previous slot by plumes.scan_for_plumes, so each cell keeps its ID
+    for its lifetime. Area, centroid, speed and direction of every active
+    cell are kept in a PlumeTable, where the emission time and source are
+    the time and position of initiation.
+    """
+
+    def __init__(self, threshold=config.DEEP_CONVECTION_BT,
+                 min_size=config.MIN_CONVECTION_SIZE,
+                 radius=config.CONVECTION_RADIUS):
+        """
+        :param threshold: BT below which a pixel is deep convection
+        :param min_size: cells of this many pixels or fewer are ignored
+        :param radius: distance in pixels within which plumes are
+        associated with a cell
+        """
+        self.threshold = threshold
+        self.min_size = min_size
+        self.radius = radius
+        self.cells_previous = None
+        self.next_id = 0
+        self.table = plumes.PlumeTable()
+
+    def update(self, time, bt, sdf_plumes, plume_ids, lons, lats):
+        """
+        Detects and tracks the convective cells of a slot and associates
+        them with the active plumes
+        :param time: datetime object of the slot
+        :param bt: array (optionally masked) of 10.8 micron BTs
+        :param sdf_plumes: array of plume IDs from scan_for_plumes
+        :param plume_ids: sorted array of the IDs of every active plume
+        :param lons: array of pixel longitudes
+        :param lats: array of pixel latitudes
+        :return cells: array of convective cell IDs
+        :return cell_match: array with the ID of the nearest cell to each
+        plume, or 0 where there is none within radius
+        :return cell_distance: array with the distance in pixels from each
+        plume to that cell, or inf where there is none within radius
+        """
+
+        cells, new_ids, cell_ids = plumes.scan_for_plumes(
+            find_deep_convection(bt, self.threshold), self.cells_previous,
+            self.min_size, next_id=self.next_id)
+        if len(new_ids) > 0:
+            self.next_id = max(self.next_id, int(np.max(new_ids)))
+        self.cells_previous = cells
+
+        self.table.die(np.setdiff1d(self.table.active_ids(), cell_ids))
+        self.table.add(new_ids, time)
+        self.table.update(time, cells, cell_ids, lons, lats)
+
+        cell_match, cell_distance = associate_convection(
+            sdf_plumes, plume_ids, cells, self.radius)
+
+        return cells, cell_match, cell_distance
+
+    def to_arrays(self):
+        """
+        Gathers the tracker state, e.g. as extra arrays for a checkpoint.
+        Only active cells are kept, so the state does not grow with the
+        length of the run.
+        :return: dictionary of arrays, all prefixed 'convection_'
+        """
+
+        arrays = dict(('convection_' + name, array) for name, array in
+                      self.table.to_arrays(active_only=True).items())
+        arrays['convection_next_id'] = np.int64(self.next_id)
+        if self.cells_previous is not None:
+            arrays['convection_runs'] = labelarchive.encode_runs(
+                self.cells_previous)
+            arrays['convection_shape'] = np.asarray(
+                np.shape(self.cells_previous))
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, **kwargs):
+        """
+        Rebuilds a tracker from the output of to_arrays
+        :param arrays: dictionary-like object of arrays
+        :param kwargs: the thresholds passed to ConvectionTracker
+        :return: a ConvectionTracker
+        """
+
+        tracker = cls(**kwargs)
+        tracker.table = plumes.PlumeTable.from_arrays(dict(
+            (name[len('convection_'):], arrays[name]) for name in arrays if
+            name.startswith('convection_')))
+        tracker.next_id = int(arrays['convection_next_id'])
+        if 'convection_runs' in arrays:
+            tracker.cells_previous = labelarchive.decode_runs(
+                arrays['convection_runs'],
+                tuple(arrays['convection_shape']))
+
+        return tracker
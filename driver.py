@@ -0,0 +1,213 @@
+import functools
+import multiprocessing
+import numpy as np
+
+import config
+import labelarchive
+import plumes
+import reader
+
+"""
+Parallel driver for long tracking runs. A date range is split into
+chunks which are tracked independently on a process pool, then stitched
+back together at the chunk boundaries so plume IDs and emissions are the
+same as those of tracking the whole range serially
+"""
+
+
+def split_datetimes(datetimes, n_chunks):
+    """
+    Splits an array of slot datetimes into contiguous chunks
+    :param datetimes: array of datetime objects from
+    utilities.get_datetime_objects
+    :param n_chunks: the number of chunks to split the slots into
+    :return: list of arrays of datetime objects, in time order
+    """
+
+    chunks = np.array_split(np.asarray(datetimes), n_chunks)
+    return [chunk for chunk in chunks if chunk.shape[0] > 0]
+
+
+def track_chunk(datetimes, window=None, stitch_slots=config.STITCH_SLOTS):
+    """
+    Tracks plumes serially through one chunk of slots, starting with no
+    previous plumes. IDs are local to the chunk until it is stitched.
+    :param datetimes: array of datetime objects for the chunk
+    :param window: a (row slice, column slice) tuple from
+    reader.get_region_window, or None for the whole grid
+    :param stitch_slots: the number of leading slots whose labels are kept
+    for stitch_chunks to compare against
+    :return: a dictionary with the run-length encoded labels and next ID
+    of each of the leading slots, the labelled raster of the last slot,
+    the highest local ID assigned and a list of (local ID, datestring)
+    pairs for each plume emitted in the chunk
+    """
+
+    sdf_previous = None
+    next_id = 0
+    new_plumes = []
+    leading = []
+
+    for slot, sdf_now, bt in reader.SlotReader(datetimes, read_bt=False,
+                                               window=window):
+        date = slot.strftime("%Y%m%d%H%M")
+
+        sdf_plumes, new_ids, plume_ids = plumes.scan_for_plumes(
+            sdf_now, sdf_previous, min_size=config.MIN_PLUME_SIZE,
+            next_id=next_id, split_ids=config.SPLIT_NEW_IDS)
+
+        if len(new_ids) > 0:
+            next_id = max(next_id, int(np.max(new_ids)))
+        new_plumes.extend([(int(i), date) for i in new_ids])
+        if len(leading) < stitch_slots:
+            leading.append((slot, labelarchive.encode_runs(sdf_plumes),
+                            next_id))
+
+        sdf_previous = sdf_plumes
+
+    return {'leading': leading,
+            'last_clusters': sdf_previous,
+            'next_id': next_id,
+            'new_plumes': new_plumes}
+
+
+def label_correspondence(local, serial):
+    """
+    Finds whether two labellings of the same slot split the plume pixels
+    into the same plumes, with IDs in the same order. Tracking continues
+    identically from two such labellings, apart from the IDs.
+    :param local: array of chunk-local plume labels
+    :param serial: array of plume labels from serial tracking
+    :return: array of (local ID, serial ID) pairs sorted by ID, or None if
+    the labellings differ
+    """
+
+    plume_pixels = local != 0
+    if not np.array_equal(plume_pixels, serial != 0):
+        return None
+
+    pairs = np.unique(np.stack((local[plume_pixels],
+                                serial[plume_pixels]), axis=1), axis=0)
+    pairs = pairs.reshape(-1, 2)
+    if np.any(np.diff(pairs[:, 0]) == 0) or \
+            np.any(np.diff(pairs[:, 1]) <= 0):
+        return None
+
+    return pairs
+
+
+def stitch_chunks(results, chunks, window=None):
+    """
+    Makes chunk-local plume IDs globally consistent, giving the same IDs
+    and emissions as tracking the whole run serially. The start of each
+    chunk is tracked again from the serial labels of the previous chunk's
+    last slot, until it reaches a slot whose labels correspond to the
+    chunk's own. From there on the chunk's IDs only need renumbering.
+    :param results: list of dictionaries from track_chunk, in time order
+    :param chunks: list of arrays of datetime objects of each chunk
+    :param window: the window the chunks were tracked with
+    :return id_lookups: list of arrays, one per chunk, mapping each local
+    plume ID alive from the slot where the chunk was joined onwards to its
+    global ID, and every other local ID to 0
+    :return new_plumes: list of (global ID, datestring) pairs for each plume
+    emitted in the whole run
+    """
+
+    id_lookups = []
+    new_plumes = []
+    next_id = 0
+    last_clusters = None
+
+    for result, datetimes in zip(results, chunks):
+        id_lookup = np.zeros(result['next_id'] + 1, dtype=np.int64)
+
+        # The first chunk starts from nothing, as the serial run does
+        if last_clusters is None and next_id == 0:
+            id_lookup = np.arange(result['next_id'] + 1)
+            new_plumes.extend(result['new_plumes'])
+            last_clusters = result['last_clusters']
+            next_id = result['next_id']
+            id_lookups.append(id_lookup)
+            continue
+
+        leading = iter(result['leading'])
+        joined = False
+        slots = reader.SlotReader(datetimes, read_bt=False, window=window)
+        for slot, sdf_now, bt in slots:
+            sdf_plumes, new_ids, plume_ids = plumes.scan_for_plumes(
+                sdf_now, last_clusters, min_size=config.MIN_PLUME_SIZE,
+                next_id=next_id, split_ids=config.SPLIT_NEW_IDS)
+            if len(new_ids) > 0:
+                next_id = max(next_id, int(np.max(new_ids)))
+            date = slot.strftime("%Y%m%d%H%M")
+            new_plumes.extend([(int(i), date) for i in new_ids])
+            last_clusters = sdf_plumes
+
+            # Past the kept slots the chunk is tracked again to its end
+            kept = next(leading, None)
+            if kept is None:
+                continue
+            kept_slot, runs, local_next_id = kept
+            pairs = label_correspondence(
+                labelarchive.decode_runs(runs, np.shape(sdf_plumes)),
+                sdf_plumes)
+            if pairs is not None:
+                joined = True
+                break
+        slots.close()
+
+        if not joined:
+            print('Chunk starting ' + datetimes[0].strftime("%Y%m%d%H%M") +
+                  ' never matched the serial labels and was tracked '
+                  'again in full')
+            id_lookups.append(id_lookup)
+            continue
+
+        # Plumes alive at the join take their serial IDs, and plumes
+        # emitted after it are numbered on from the serial next ID
+        id_lookup[pairs[:, 0]] = pairs[:, 1]
+        later = np.arange(local_next_id + 1, result['next_id'] + 1)
+        id_lookup[later] = later - local_next_id + next_id
+
+        new_plumes.extend([(int(id_lookup[i]), date) for i, date in
+                           result['new_plumes'] if i > local_next_id])
+        last_clusters = id_lookup[result['last_clusters']]
+        next_id += result['next_id'] - local_next_id
+        id_lookups.append(id_lookup)
+
+    return id_lookups, new_plumes
+
+
+def run_parallel(datetimes, processes=None, n_chunks=None, window=None):
+    """
+    Tracks plumes over a date range on a process pool
+    :param datetimes: array of datetime objects from
+    utilities.get_datetime_objects
+    :param processes: the number of worker processes (defaults to the
+    number of cores)
+    :param n_chunks: the number of chunks to split the slots into (defaults
+    to the number of worker processes)
+    :param window: a (row slice, column slice) tuple from
+    reader.get_region_window, or None for the window of config.REGION as
+    tracked by main.py
+    :return: the id_lookups and new_plumes from stitch_chunks
+    """
+
+    if window is None:
+        window = reader.read_region_grids(config.REGION)[0]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if n_chunks is None:
+        n_chunks = processes
+
+    chunks = split_datetimes(datetimes, n_chunks)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(functools.partial(track_chunk, window=window),
+                           chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    return stitch_chunks(results, chunks, window)
@@ -0,0 +1,233 @@
+import json
+import os
+import numpy as np
+
+"""
+Archive of labelled plume rasters. Plume pixels cover a small fraction of
+the domain, so each slot is run-length encoded along the flattened raster
+and the runs of every slot are appended to a single file. A time index
+records where each slot's runs start, and both files are memory-mapped,
+so any slot or time window can be decoded without reading the rest.
+"""
+
+# One run of identically labelled, consecutive pixels of the flattened
+# raster
+RUN_DTYPE = np.dtype([('start', '<u4'), ('length', '<u4'),
+                      ('label', '<i8')])
+
+# One slot of the archive: its time (minutes since 1970) and the position
+# and number of its runs in the run file
+INDEX_DTYPE = np.dtype([('time', '<i8'), ('offset', '<i8'),
+                        ('count', '<i8')])
+
+
+def encode_runs(labels):
+    """
+    Run-length encodes the nonzero pixels of a labelled raster
+    :param labels: 2D array of plume labels, zero outside plumes
+    :return: array of RUN_DTYPE records in raster order
+    """
+
+    flat = np.ravel(labels)
+    pixels = np.flatnonzero(flat)
+    values = flat[pixels]
+
+    # A run ends where the pixels stop being consecutive or the label
+    # changes
+    breaks = np.flatnonzero((np.diff(pixels) != 1) |
+                            (np.diff(values) != 0)) + 1
+    first = np.concatenate(([0], breaks)) if pixels.shape[0] > 0 else \
+        np.zeros(0, dtype=np.intp)
+
+    runs = np.zeros(first.shape[0], dtype=RUN_DTYPE)
+    runs['start'] = pixels[first]
+    runs['length'] = np.diff(np.append(first, pixels.shape[0]))
+    runs['label'] = values[first]
+
+    return runs
+
+
+def decode_runs(runs, shape, out=None):
+    """
+    Rebuilds a labelled raster from its runs
+    :param runs: array of RUN_DTYPE records
+    :param shape: the shape of the raster
+    :param out: an integer array of that shape to write into, or None
+    :return: the labelled raster
+    """
+
+    if out is None:
+        out = np.zeros(shape, dtype=np.int64)
+    else:
+        out[...] = 0
+
+    lengths = runs['length'].astype(np.intp)
+    starts = runs['start'].astype(np.intp)
+
+    # Every pixel of a run is its start plus its distance into the run
+    run_offsets = np.cumsum(lengths) - lengths
+    pixels = np.arange(lengths.sum()) + np.repeat(starts - run_offsets,
+                                                  lengths)
+    out.reshape(-1)[pixels] = np.repeat(runs['label'], lengths)
+
+    return out
+
+
+def _to_minutes(time):
+    return np.datetime64(time, 'm').astype(np.int64)
+
+
+class LabelArchive(object):
+    """
+    An append-only archive of labelled rasters in a directory holding
+    meta.json (the raster shape), runs.bin (the runs of every slot) and
+    index.bin (the time index). Slots must be appended in time order.
+    """
+
+    def __init__(self, directory, shape=None):
+        """
+        :param directory: the archive directory, created if it does not
+        exist
+        :param shape: the raster shape, required for a new archive
+        """
+        self.directory = directory
+        meta_file = os.path.join(directory, 'meta.json')
+
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                self.shape = tuple(json.load(f)['shape'])
+        else:
+            if shape is None:
+                raise ValueError('A shape is needed to create the label '
+                                 'archive ' + directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.shape = tuple(int(i) for i in shape)
+            with open(meta_file, 'w') as f:
+                json.dump({'shape': self.shape}, f)
+
+        self.runs_file = os.path.join(directory, 'runs.bin')
+        self.index_file = os.path.join(directory, 'index.bin')
+        for filename in (self.runs_file, self.index_file):
+            if not os.path.exists(filename):
+                open(filename, 'wb').close()
+
+    def _map(self, filename, dtype):
+        # Map the file as it currently stands, since appends extend it
+        count = os.path.getsize(filename) // dtype.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', shape=(count,))
+
+    @property
+    def index(self):
+        """
+        :return: memory-mapped array of INDEX_DTYPE records, one per slot
+        """
+        return self._map(self.index_file, INDEX_DTYPE)
+
+    def __len__(self):
+        return os.path.getsize(self.index_file) // INDEX_DTYPE.itemsize
+
+    def times(self):
+        """
+        :return: array of the datetime64 times of every archived slot
+        """
+        return np.array(self.index['time']).astype('datetime64[m]')
+
+    def append(self, time, labels):
+        """
+        Encodes a labelled raster and appends it to the archive
+        :param time: datetime object of the slot
+        :param labels: 2D array of plume labels
+        """
+
+        if np.shape(labels) != self.shape:
+            raise ValueError('Raster of shape ' + str(np.shape(labels)) +
+                             ' does not match the archive shape ' +
+                             str(self.shape))
+
+        index = self.index
+        if index.shape[0] > 0 and _to_minutes(time) <= index['time'][-1]:
+            raise ValueError('Slots must be appended in time order')
+
+        runs = encode_runs(labels)
+        entry = np.zeros(1, dtype=INDEX_DTYPE)
+        entry['time'] = _to_minutes(time)
+        entry['offset'] = os.path.getsize(self.runs_file) // \
+            RUN_DTYPE.itemsize
+        entry['count'] = runs.shape[0]
+
+        # The runs are written before the index entry that points to them
+        with open(self.runs_file, 'ab') as f:
+            f.write(runs.tobytes())
+        with open(self.index_file, 'ab') as f:
+            f.write(entry.tobytes())
+
+    def truncate_after(self, time):
+        """
+        Removes every slot after a given time, e.g. the slots processed
+        after the checkpoint a run is resuming from
+        :param time: datetime object of the last slot to keep
+        """
+
+        index = self.index
+        keep = np.searchsorted(index['time'], _to_minutes(time), 'right')
+        if keep == index.shape[0]:
+            return
+        runs_kept = int(index['offset'][keep])
+        del index
+
+        with open(self.index_file, 'r+b') as f:
+            f.truncate(keep * INDEX_DTYPE.itemsize)
+        with open(self.runs_file, 'r+b') as f:
+            f.truncate(runs_kept * RUN_DTYPE.itemsize)
+
+    def read(self, i, out=None):
+        """
+        Decodes a single slot
+        :param i: position of the slot in the archive
+        :param out: an integer array of the raster shape to write into
+        :return: the labelled raster
+        """
+
+        entry = self.index[i]
+        runs = self._map(self.runs_file, RUN_DTYPE)[
+            entry['offset']:entry['offset'] + entry['count']]
+
+        return decode_runs(runs, self.shape, out)
+
+    def read_time(self, time):
+        """
+        Decodes the slot at a given time
+        :param time: datetime object of the slot
+        :return: the labelled raster
+        """
+
+        times = self.index['time']
+        i = np.searchsorted(times, _to_minutes(time))
+        if i == times.shape[0] or times[i] != _to_minutes(time):
+            raise KeyError('No slot archived at ' + str(time))
+
+        return self.read(i)
+
+    def read_window(self, time_lower, time_upper):
+        """
+        Decodes every slot within a time window
+        :param time_lower: datetime object of the start of the window
+        (inclusive)
+        :param time_upper: datetime object of the end of the window
+        (inclusive)
+        :return: array of datetime64 times and a (time, y, x) array of the
+        labelled rasters
+        """
+
+        times = self.index['time']
+        lower = np.searchsorted(times, _to_minutes(time_lower), 'left')
+        upper = np.searchsorted(times, _to_minutes(time_upper), 'right')
+
+        rasters = np.zeros((upper - lower,) + self.shape, dtype=np.int64)
+        for k, i in enumerate(np.arange(lower, upper)):
+            self.read(i, rasters[k])
+
+        return np.array(times[lower:upper]).astype('datetime64[m]'), rasters
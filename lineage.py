@@ -0,0 +1,167 @@
+import numpy as np
+
+import plumes
+
+"""
+Lineage graph of plumes. Every timestep adds the parent-to-child edges
+found by scan_for_plumes, so merges keep a record of every parent and
+splits a record of their fragments. Edges are held as flat arrays, and
+ancestors and descendants are found by walking sorted copies of them one
+generation at a time.
+"""
+
+# A lineage edge with the time of the child's timestep
+GRAPH_EDGE_DTYPE = np.dtype([('time', 'datetime64[m]')] +
+                            plumes.EDGE_DTYPE.descr)
+
+
+def _neighbours(keys, values, frontier):
+    # keys is sorted, so every edge of the frontier lies in one range of
+    # keys per frontier ID
+    lower = np.searchsorted(keys, frontier, 'left')
+    upper = np.searchsorted(keys, frontier, 'right')
+    lengths = upper - lower
+    offsets = np.cumsum(lengths) - lengths
+    index = np.arange(lengths.sum()) + np.repeat(lower - offsets, lengths)
+
+    return values[index]
+
+
+class LineageGraph(object):
+    """
+    Parent-to-child edges of every timestep of a run, in time order
+    """
+
+    def __init__(self, capacity=4096):
+        """
+        :param capacity: the number of edges to allocate room for initially.
+        The edge array doubles in size whenever it fills up.
+        """
+        self.edges = np.zeros(capacity, dtype=GRAPH_EDGE_DTYPE)
+        self.size = 0
+        self._by_parent = None
+        self._by_child = None
+
+    def append(self, time, edges):
+        """
+        Adds the edges of a timestep
+        :param time: datetime object of the timestep
+        :param edges: array of EDGE_DTYPE records from scan_for_plumes
+        """
+
+        n = edges.shape[0]
+        if self.size + n > self.edges.shape[0]:
+            capacity = self.edges.shape[0]
+            while capacity < self.size + n:
+                capacity *= 2
+            grown = np.zeros(capacity, dtype=GRAPH_EDGE_DTYPE)
+            grown[:self.size] = self.edges[:self.size]
+            self.edges = grown
+
+        added = self.edges[self.size:self.size + n]
+        added['time'] = np.datetime64(time, 'm')
+        for name in plumes.EDGE_DTYPE.names:
+            added[name] = edges[name]
+        self.size += n
+        self._by_parent = None
+        self._by_child = None
+
+    def _index(self):
+        # Sorted copies of the edges which change ID, built on the first
+        # query after an append
+        if self._by_parent is None:
+            edges = self.edges[:self.size]
+            edges = edges[edges['parent'] != edges['child']]
+            order = np.argsort(edges['parent'], kind='mergesort')
+            self._by_parent = (edges['parent'][order], edges['child'][order])
+            order = np.argsort(edges['child'], kind='mergesort')
+            self._by_child = (edges['child'][order], edges['parent'][order])
+        return self._by_parent, self._by_child
+
+    def _walk(self, plume_id, keys, values):
+        found = np.zeros(0, dtype=np.int64)
+        frontier = np.array([plume_id], dtype=np.int64)
+        while frontier.shape[0] > 0:
+            frontier = np.setdiff1d(_neighbours(keys, values, frontier),
+                                    found)
+            frontier = frontier[frontier != plume_id]
+            found = np.union1d(found, frontier)
+        return found
+
+    def ancestors(self, plume_id):
+        """
+        Finds every plume which merged or split into a plume, however many
+        generations back
+        :param plume_id: ID of the plume
+        :return: sorted array of ancestor IDs
+        """
+        by_parent, by_child = self._index()
+        return self._walk(plume_id, *by_child)
+
+    def descendants(self, plume_id):
+        """
+        Finds every plume which a plume merged or split into, however many
+        generations on, e.g. everything raised by one emission event
+        :param plume_id: ID of the plume
+        :return: sorted array of descendant IDs
+        """
+        by_parent, by_child = self._index()
+        return self._walk(plume_id, *by_parent)
+
+    def lineage(self, plume_id):
+        """
+        Gathers every edge between a plume, its ancestors and its
+        descendants
+        :param plume_id: ID of the plume
+        :return: array of GRAPH_EDGE_DTYPE records in time order
+        """
+
+        ids = np.union1d(np.union1d(self.ancestors(plume_id),
+                                    self.descendants(plume_id)),
+                         [plume_id])
+        edges = self.edges[:self.size]
+
+        return edges[np.isin(edges['parent'], ids) &
+                     np.isin(edges['child'], ids)]
+
+    def to_arrays(self):
+        """
+        Gathers the edges, e.g. as extra arrays for a checkpoint
+        :return: dictionary with a 'lineage_' array for each edge field
+        """
+
+        edges = self.edges[:self.size]
+        return dict(('lineage_' + name, edges[name]) for name in
+                    GRAPH_EDGE_DTYPE.names)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuilds a graph from the output of to_arrays
+        :param arrays: dictionary-like object of arrays
+        :return: a LineageGraph
+        """
+
+        size = len(arrays['lineage_time'])
+        graph = cls(capacity=max(size, 1))
+        for name in GRAPH_EDGE_DTYPE.names:
+            graph.edges[name][:size] = arrays['lineage_' + name]
+        graph.size = size
+
+        return graph
+
+    def save(self, filename):
+        """
+        Saves the edges to a .npz file
+        :param filename: path of the file
+        """
+        np.savez(filename, **self.to_arrays())
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a graph saved with save
+        :param filename: path of the .npz file
+        :return: a LineageGraph
+        """
+        return cls.from_arrays(np.load(filename))
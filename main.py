@@ -5,10 +5,21 @@ from netCDF4 import Dataset
 import numpy as np
 from mpl_toolkits.basemap import Basemap
 import datetime
-import shelve
-
+import os
+
+import advection
+import checkpoint
+import config
+import convection
+import labelarchive
+import lineage
+import metrics
 import utilities
+import plotting
 import plumes
+import plumestore
+import reader
+import timeslots
 
 if __name__ == '__main__':
     # NOTES #
@@ -37,17 +48,11 @@ if __name__ == '__main__':
                             minute_upper])
 
     datetimes = utilities.get_datetime_objects(time_params)
-    datestrings = [j.strftime("%Y%m%d%H%M") for j in datetimes]
-
-    lonlats = Dataset(
-        '/ouce-home/data/satellite/meteosat/seviri/15-min/native/'
-        'lonlats.NA_MiddleEast.nc')
-    lons = lonlats.variables['longitude'][:]
-    lats = lonlats.variables['latitude'][:]
-    lonmask = lons > 360
-    latmask = lats > 90
-    lons = np.ma.array(lons, mask=lonmask)
-    lats = np.ma.array(lats, mask=latmask)
+    datestrings = timeslots.format_datestrings(datetimes)
+
+    # Every read, and all labelling and matching, is limited to the region
+    # of interest
+    window, lons, lats = reader.read_region_grids(config.REGION)
     fig, ax = plt.subplots()
     extent = (-21, 31, 10, 41)
     m = Basemap(projection='cyl', llcrnrlon=extent[0], urcrnrlon=extent[1],
@@ -57,85 +62,162 @@ if __name__ == '__main__':
     m.drawcoastlines(linewidth=0.5)
     m.drawcountries(linewidth=0.5)
 
+    # Resuming is asked for explicitly. A new run refuses to start over the
+    # outputs of an earlier one.
+    resume = config.RESUME and os.path.exists(config.CHECKPOINT_FILE)
+    if not resume:
+        if config.RESUME:
+            print 'No checkpoint to resume from, starting a new run'
+        checkpoint.check_fresh_start([config.CHECKPOINT_FILE,
+                                      'plume_objects.db',
+                                      config.LABEL_ARCHIVE_DIR])
+
     sdf_previous = None
-    deep_conv_IDs_prev = None
-    LLJ_plumes_IDs_prev = []
     k = 0
-    available_colours = np.arange(0, 41)
-    used_colour_IDs = {}
-    plume_objects = []
-
-    for date in datestrings:
+    plume_colours = plotting.ColourAllocator()
+    renderer = None
+    if config.PLUME_MAP_DIR is not None:
+        renderer = plotting.PlumeMapRenderer(lons, lats)
+    plume_table = plumes.PlumeTable()
+    convection_tracker = convection.ConvectionTracker()
+    lineage_graph = lineage.LineageGraph()
+    matcher = advection.AdvectionMatcher()
+    plume_store = plumestore.PlumeStore('plume_objects.db')
+    label_archive = labelarchive.LabelArchive(config.LABEL_ARCHIVE_DIR,
+                                              np.shape(lons))
+    next_id = 0
+    last_slot = None
+    slots_since_checkpoint = 0
+    run_metrics = metrics.PipelineMetrics()
+
+    # Resume from the last checkpoint if asked to. Only slots after the
+    # last completed slot are tracked, so re-running with a later upper
+    # bound appends newly arrived slots to the existing catalogue.
+    if resume:
+        state = checkpoint.load_checkpoint(config.CHECKPOINT_FILE)
+        last_slot = state['last_slot']
+        checkpoint.check_resume(datetimes, last_slot)
+        sdf_previous = state['sdf_previous']
+        next_id = state['next_id']
+        plume_table = state['plume_table']
+        convection_tracker = convection.ConvectionTracker.from_arrays(state)
+        lineage_graph = lineage.LineageGraph.from_arrays(state)
+        matcher = advection.AdvectionMatcher.from_arrays(state)
+        plume_colours = plotting.ColourAllocator.from_arrays(state)
+
+        # Anything written after the checkpoint is tracked again
+        plume_store.rollback_after(last_slot.strftime("%Y%m%d%H%M"))
+        label_archive.truncate_after(last_slot)
+        datetimes = checkpoint.pending_slots(datetimes, last_slot)
+        print 'Resuming after ' + last_slot.strftime("%Y%m%d%H%M")
+
+    # Slots with no SDF or BT file are skipped before reading, using one
+    # directory listing per month of the archive
+    available = timeslots.slot_availability(config.SDF_FILE, datetimes) & \
+        timeslots.slot_availability(config.BT_FILE, datetimes)
+    if not np.all(available):
+        print str(np.count_nonzero(~available)) + ' slots missing from ' \
+            'the archive'
+    datetimes = datetimes[available]
+
+    # Slots are read ahead in a background thread while the current one is
+    # being tracked. Missing slots are reported and skipped.
+    slots = reader.SlotReader(datetimes, window=window, metrics=run_metrics)
+
+    for slot, sdf_now, bt in slots:
+        date = slot.strftime("%Y%m%d%H%M")
         print '\n' + date + '\n'
-        totaltest = datetime.datetime.now()
-        sdf = Dataset(
-            '/ouce-home/data/satellite/meteosat/seviri/15-min/native/sdf/nc/'
-            'JUNE2012/SDF_v2/SDF_v2.' + date + '.nc')
-        bt = Dataset(
-            '/ouce-home/data/satellite/meteosat/seviri/15-min/native/bt/nc/'
-            'JUNE2012/H-000-MSG2__-MSG2________-'
-            'IR_BrightnessTemperatures___-000005___-' + date + '-__.nc')
-
-        sdf_now = sdf.variables['bt108'][:]
-
-        sdf_plumes, new_ids, plume_ids = plumes.scan_for_plumes(sdf_now,
-                                                              sdf_previous)
+        record = run_metrics.slot(slot)
+
+        # Plumes are matched against the previous slot as predicted by the
+        # matcher, which can move plumes forward and hold undetected ones
+        with record.stage('advection'):
+            sdf_predicted = matcher.predict(slot, sdf_now)
+        sdf_plumes, new_ids, plume_ids, edges = plumes.scan_for_plumes(
+            sdf_now, sdf_predicted, min_size=config.MIN_PLUME_SIZE,
+            next_id=next_id, return_edges=True,
+            split_ids=config.SPLIT_NEW_IDS, record=record)
+        with record.stage('advection'):
+            tracked_ids = matcher.update(slot, sdf_plumes, plume_ids,
+                                         sdf_now)
 
         sdf_previous = sdf_plumes
-
-        new_bool = np.asarray([j in new_ids for j in plume_ids])
-        old_ids = plume_ids[new_bool]
-
-
-        # Then, for each new ID, we initialise plume objects
-        for i in np.arange(0, len(new_ids)):
-            plume = plumes.Plume(new_ids[i], date)
-            plume_objects = shelve.open('plume_objects')
-            plume_objects[str(new_ids[i])] = plume
-
-        # For old IDs, we just run an update. Plumes which no longer exist
-        # are removed
-        for i in np.arange(0, len(old_ids)):
-            pass
+        if len(new_ids) > 0:
+            next_id = max(next_id, int(np.max(new_ids)))
+
+        # Labelled plumes are run-length encoded into the label archive, and
+        # the parent-to-child edges from the matching go in the lineage
+        with record.stage('label_archive'):
+            label_archive.append(slot, sdf_plumes)
+        with record.stage('lineage'):
+            lineage_graph.append(slot, edges)
+
+        # Plumes which are no longer held are classified if they have not
+        # been already and removed, then each new ID is added to the plume
+        # table
+        dying = np.setdiff1d(plume_table.active_ids(), tracked_ids)
+        with record.stage('classification'):
+            classified = plume_table.update_mechanism_likelihood(dying)
+        with record.stage('store_write'):
+            plume_store.write_likelihoods(plume_table, classified)
+        with record.stage('plume_update'):
+            plume_table.die(dying)
+            plume_table.add(new_ids, slot)
+
+            # All active plumes are measured and updated together
+            plume_table.update(slot, sdf_plumes, plume_ids, lons, lats)
+            plume_table.record(slot)
+
+        # Deep convective cells are tracked from the same BT scan and each
+        # plume is associated with its nearest cell
+        with record.stage('convection'):
+            cells, cell_match, cell_distance = convection_tracker.update(
+                slot, bt, sdf_plumes, plume_ids, lons, lats)
+
+        # Plumes old enough to have an early-life speed and direction are
+        # scored for LLJ and CPO emission in one batch
+        with record.stage('classification'):
+            plume_table.update_convection(plume_ids, cell_distance)
+            plume_table.update_mechanism_likelihood()
+
+        # All plumes active at this timestep are committed in one batch
+        with record.stage('store_write'):
+            plume_store.write_table(date, plume_table)
+
+        # Each plume keeps its colour for its whole lifetime, including
+        # while it is held undetected. Frames are written in the
+        # background, so rendering only times the drawing.
+        with record.stage('rendering'):
+            plume_colours.update(tracked_ids)
+            if renderer is not None:
+                renderer.render(sdf_plumes, os.path.join(
+                    config.PLUME_MAP_DIR, 'SDF_plumes_' + date + '.png'),
+                    plume_colours.lut, title=date)
+
+        # Periodically checkpoint the tracker state
+        last_slot = slot
+        slots_since_checkpoint += 1
+        if slots_since_checkpoint == config.CHECKPOINT_INTERVAL:
+            with record.stage('checkpoint'):
+                extra = convection_tracker.to_arrays()
+                extra.update(lineage_graph.to_arrays())
+                extra.update(matcher.to_arrays())
+                extra.update(plume_colours.to_arrays())
+                checkpoint.save_checkpoint(config.CHECKPOINT_FILE,
+                                           last_slot, sdf_previous, next_id,
+                                           plume_table, **extra)
+            slots_since_checkpoint = 0
+
+        record.set('dust_pixels', int(np.count_nonzero(sdf_now)))
+        record.set('plumes', len(plume_ids))
+        record.set('new_plumes', len(new_ids))
+        run_metrics.end_slot(slot)
 
 
         """
-        deep_conv_assoc, deep_conv_IDs = identify_convection(BT, SDF_plumes,
-                                                             new_IDs,
-                                                             deep_conv_IDs_prev)
-        # print 'Identifying deep convection:', datetime.datetime.now() - test
-        # test = datetime.datetime.now()
-        LLJ_plumes, LLJ_IDs, new_plumes = classify_as_LLJ(SDF_plumes,
-                                                          LLJ_plumes_IDs_prev,
-                                                          new_IDs,
-                                                          datetimes[k],
-                                                          deep_conv_assoc)
-        # print 'Identifying LLJs:', datetime.datetime.now() - test
 
         # test = datetime.datetime.now()
 
-        # These throw an error at present - can't store sparse matrices in an nc file - could do possibly to save them to txt or something
-        # Can then read them back in...
-        SDF_plumes_s = sparse.csr_matrix(SDF_plumes)
-        LLJ_plumes_s = sparse.csr_matrix(LLJ_plumes)
-        LLJ_plumes_data = LLJ_plumes_s.data
-        LLJ_plumes_indices = LLJ_plumes_s.indices
-        LLJ_plumes_indptr = SDF_plumes_s.indptr
-        SDF_plumes_data = SDF_plumes_s.data
-        SDF_plumes_indices = SDF_plumes_s.indices
-        SDF_plumes_indptr = SDF_plumes_s.indptr
-
-        np.save('SDF_sparse_matrices/LLJ_plume_data_' + date, LLJ_plumes_data)
-        np.save('SDF_sparse_matrices/LLJ_plume_indices_' + date,
-                LLJ_plumes_indices)
-        np.save('SDF_sparse_matrices/LLJ_plume_indptr_' + date,
-                LLJ_plumes_indptr)
-        np.save('SDF_sparse_matrices/SDF_plume_data_' + date, SDF_plumes_data)
-        np.save('SDF_sparse_matrices/SDF_plume_indices_' + date,
-                SDF_plumes_indices)
-        np.save('SDF_sparse_matrices/SDF_plume_indptr_' + date,
-                SDF_plumes_indptr)
-
         # generate_nc_file(SDF_plumes_s, LLJ_plumes_s, 'SDF_LLJ_plumes_'+date+'.nc', lats, lons, datetimes[k])
         # LLJs[k] = LLJ_plumes
         # SDF_plumes_array[k] = SDF_plumes
@@ -145,51 +227,7 @@ if __name__ == '__main__':
         ID_min = 0
         ID_max = 2
 
-        # print plume_IDs
-
-        # test = datetime.datetime.now()
-        reavailable_IDs = []
-        # Put colours of IDs back into availablity if that ID no longer exists
-        for ID in used_colour_IDs:
-            if ID not in plume_IDs:
-                reavailable_IDs = np.append(reavailable_IDs, ID)
-                available_colours = np.append(available_colours,
-                                              used_colour_IDs[ID])
-        for ID in reavailable_IDs:
-            del used_colour_IDs[ID]
-
-        # For IDs without an assigned colour, assign them a random colour from the available ones
-        for i in np.arange(0, np.shape(plume_IDs)[0]):
-            ID = plume_IDs[i]
-            if ID not in used_colour_IDs:
-                colour = np.random.choice(available_colours)
-                index = np.where(available_colours == colour)[0][0]
-                available_colours = np.delete(available_colours, index)
-                used_colour_IDs[ID] = colour
-
-        # Now create an equivalent array to the plumes, but where plume IDs are replaced with colour IDs
-        coloured_plumes = np.zeros(np.shape(SDF_plumes))
-        # print used_colour_IDs
-        for ID in plume_IDs:
-            coloured_plumes[SDF_plumes == ID] = used_colour_IDs[ID]
-
-        # print 'Generating colour IDs:', datetime.datetime.now() - test
-        clevs = np.arange(0, 41)
-
-        # Need a way of dealing with the colouring of these plumes - the same ID should always be the same colour
-        # But that's tricky because you're constantly switching the colour window to account for new IDs
-
-        # So should really assign each ID to a unique colour, like a dictionary or something
-        # When an ID is assigned to a colour the colour is removed from a list of available colours
-        # When an ID is removed, the colour is re-added to the list of available colours
-
-        # Note that if you just use the existing scheme of no colo
-        # test = datetime.datetime.now()
-        c1 = m.contourf(lons, lats, coloured_plumes, clevs)
-        # print 'Contouring SDF plumes:', datetime.datetime.now() - test
         label_plume_properties(SDF_plumes, date, lons, lats)
-        for coll in c1.collections:
-            plt.gca().collections.remove(coll)
         # test = datetime.datetime.now()
         c2 = m.contourf(lons, lats, deep_conv_assoc)
         plt.savefig('SDF_plumes/Deep_conv_assoc_' + date + '.png')
@@ -210,11 +248,20 @@ if __name__ == '__main__':
         #    plt.gca().collections.remove(coll)
         # test = datetime.datetime.now()
         SDF_previous = SDF_plumes
-        deep_conv_IDs_prev = np.append(deep_conv_IDs_prev, deep_conv_IDs)
-        LLJ_plumes_IDs_prev = np.append(LLJ_plumes_IDs_prev, LLJ_IDs)
         k += 1
         print '\nTotal time:', datetime.datetime.now() - totaltest
         """
 
-
-
+    if slots_since_checkpoint > 0:
+        extra = convection_tracker.to_arrays()
+        extra.update(lineage_graph.to_arrays())
+        extra.update(matcher.to_arrays())
+        extra.update(plume_colours.to_arrays())
+        checkpoint.save_checkpoint(config.CHECKPOINT_FILE, last_slot,
+                                   sdf_previous, next_id, plume_table,
+                                   **extra)
+    plume_store.close()
+    lineage_graph.save(config.LINEAGE_FILE)
+    if renderer is not None:
+        renderer.close()
+    print '\n' + run_metrics.close()
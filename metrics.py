@@ -0,0 +1,386 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+"""
+Per-stage instrumentation of the tracking pipeline. Each stage of each slot
+is timed, with the resident memory after it and how much it grew over the
+stage. Where tracemalloc can reset its peak (Python 3.9 and later), the
+peak of traced memory above its level at the start of the stage is also
+recorded, which numpy reports its arrays to. Every slot is written as a
+line of a JSON-lines log when it completes, and a summary of the run is
+reported at the end. Reads are timed in the reader's background thread,
+and the time the tracker spends waiting for them is recorded as the
+read_wait stage, so a run which is bound on the archive shows up as wait
+rather than as tracking time.
+"""
+
+# Wall clock with the best resolution available
+_clock = getattr(time, 'perf_counter', time.time)
+
+# ru_maxrss is in bytes on macOS and kilobytes elsewhere
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# Stages timed in the reader's background thread, overlapping with the
+# tracking of earlier slots
+READ_STAGES = ('sdf_open', 'sdf_read', 'bt_open', 'bt_read')
+
+# Stages of the main loop which wait on the disk rather than computing
+IO_STAGES = ('read_wait', 'label_archive', 'store_write', 'checkpoint')
+
+# Number of stages open at once across threads. The traced peak is only
+# reset when no other stage is open, so stages in the reader thread never
+# cut short the peak of a stage in the main loop, and the other way round.
+_trace_lock = threading.Lock()
+_open_stages = [0]
+
+
+def peak_rss():
+    """
+    Finds the peak resident memory of the process so far
+    :return: peak resident memory in MB, or nan if it cannot be measured
+    """
+
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * \
+        _MAXRSS_UNIT / 1048576.
+
+
+def can_trace():
+    """
+    :return: True if the peak of traced memory can be measured per stage
+    """
+    return tracemalloc is not None and hasattr(tracemalloc, 'reset_peak')
+
+
+def current_rss():
+    """
+    Finds the resident memory of the process now
+    :return: resident memory in MB, or nan if it cannot be measured
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return float('nan')
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.
+
+
+class _Stage(object):
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.rss = current_rss()
+        self.traced = None
+        if can_trace() and tracemalloc.is_tracing():
+            with _trace_lock:
+                if _open_stages[0] == 0:
+                    tracemalloc.reset_peak()
+                _open_stages[0] += 1
+                self.traced = tracemalloc.get_traced_memory()[0]
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = _clock() - self.start
+        traced_peak = float('nan')
+        if self.traced is not None:
+            with _trace_lock:
+                traced_peak = (tracemalloc.get_traced_memory()[1] -
+                               self.traced) / 1048576.
+                _open_stages[0] -= 1
+        rss = current_rss()
+        self.record.add(self.name, seconds, rss, peak_rss(),
+                        rss - self.rss, traced_peak)
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class _NullRecord(object):
+    """
+    Stand-in for a SlotRecord when nothing is being measured
+    """
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def add(self, name, seconds, rss, peak, rss_growth, traced_peak):
+        pass
+
+    def merge(self, other):
+        pass
+
+    def set(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+# Default record of functions which can be instrumented. It measures
+# nothing, so uninstrumented calls cost nothing extra.
+NULL_RECORD = _NullRecord()
+
+
+class SlotRecord(object):
+    """
+    Measurements of the stages of a single slot
+    """
+
+    def __init__(self, slot):
+        """
+        :param slot: datetime object of the slot
+        """
+        self.slot = slot
+        self.stages = OrderedDict()
+        self.values = OrderedDict()
+
+    def stage(self, name):
+        """
+        Measures a stage of the slot, e.g. with record.stage('labelling'):
+        A stage entered more than once in a slot is added up.
+        :param name: name of the stage
+        :return: a context manager timing the stage
+        """
+        return _Stage(self, name)
+
+    def add(self, name, seconds, rss, peak, rss_growth, traced_peak):
+        """
+        Adds a measurement of a stage
+        :param name: name of the stage
+        :param seconds: wall time of the stage
+        :param rss: resident memory in MB after the stage
+        :param peak: peak resident memory in MB after the stage
+        :param rss_growth: how many MB the resident memory grew by over the
+        stage, negative if memory was released
+        :param traced_peak: the peak of traced memory in MB above its level
+        at the start of the stage, including anything allocated by stages
+        open in other threads, or nan if memory is not being traced
+        """
+
+        if name in self.stages:
+            stage = self.stages[name]
+            stage['seconds'] += seconds
+            stage['rss_growth_mb'] += rss_growth
+            stage['traced_peak_mb'] = max(stage['traced_peak_mb'],
+                                          traced_peak)
+        else:
+            stage = self.stages[name] = {'seconds': seconds,
+                                         'rss_growth_mb': rss_growth,
+                                         'traced_peak_mb': traced_peak}
+        stage['rss_mb'] = rss
+        stage['peak_mb'] = peak
+
+    def merge(self, other):
+        """
+        Adds the stages of another record, e.g. one measured before it was
+        known which slot it belonged to
+        :param other: a SlotRecord
+        """
+
+        for name in other.stages:
+            stage = other.stages[name]
+            self.add(name, stage['seconds'], stage['rss_mb'],
+                     stage['peak_mb'], stage['rss_growth_mb'],
+                     stage['traced_peak_mb'])
+
+    def set(self, name, value):
+        """
+        Records a value describing the slot, e.g. the number of plumes
+        :param name: name of the value
+        :param value: a number
+        """
+        self.values[name] = value
+
+
+class PipelineMetrics(object):
+    """
+    Collects a SlotRecord for every slot of a run, writes each one to a
+    JSON-lines log as the slot completes and keeps running totals for the
+    end-of-run summary. Records can be opened from the reader thread while
+    the tracker completes earlier slots.
+    """
+
+    def __init__(self, filename=config.METRICS_FILE,
+                 trace_memory=config.METRICS_TRACE_MEMORY):
+        """
+        :param filename: path of the JSON-lines log, appended to so a
+        resumed run continues it, or None to keep only the summary
+        :param trace_memory: if True and tracemalloc can reset its peak,
+        memory allocations are traced until close so the peak of each
+        stage can be measured
+        """
+        self.filename = filename
+        self.tracing = False
+        if trace_memory and can_trace() and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        self.log = None
+        if filename is not None:
+            self.log = open(filename, 'a')
+        self.records = {}
+        self.lock = threading.Lock()
+        self.start = _clock()
+        self.last_end = self.start
+        self.n_slots = 0
+        self.totals = OrderedDict()
+
+    def slot(self, slot):
+        """
+        Finds the record of a slot, opening it if it is new
+        :param slot: datetime object of the slot
+        :return: the SlotRecord of the slot
+        """
+
+        with self.lock:
+            if slot not in self.records:
+                self.records[slot] = SlotRecord(slot)
+            return self.records[slot]
+
+    def discard(self, slot):
+        """
+        Drops the record of a slot which will not be tracked, e.g. because
+        its files are missing
+        :param slot: datetime object of the slot
+        """
+
+        with self.lock:
+            self.records.pop(slot, None)
+
+    def end_slot(self, slot):
+        """
+        Completes the record of a slot, writes it to the log and adds it
+        to the run totals. The total time of the slot is the main loop's
+        time since the previous slot completed, including the wait for its
+        files.
+        :param slot: datetime object of the slot
+        :return: the completed SlotRecord
+        """
+
+        with self.lock:
+            record = self.records.pop(slot)
+        end = _clock()
+        total = end - self.last_end
+        self.last_end = end
+
+        for name in record.stages:
+            stage = record.stages[name]
+            if name not in self.totals:
+                self.totals[name] = {'slots': 0, 'seconds': 0.,
+                                     'max_seconds': 0., 'rss_growth_mb': 0.,
+                                     'max_traced_peak_mb':
+                                     stage['traced_peak_mb']}
+            totals = self.totals[name]
+            totals['slots'] += 1
+            totals['seconds'] += stage['seconds']
+            totals['max_seconds'] = max(totals['max_seconds'],
+                                        stage['seconds'])
+            totals['rss_growth_mb'] += stage['rss_growth_mb']
+            totals['max_traced_peak_mb'] = max(totals['max_traced_peak_mb'],
+                                               stage['traced_peak_mb'])
+        self.n_slots += 1
+
+        if self.log is not None:
+            line = OrderedDict([('slot', slot.strftime('%Y%m%d%H%M')),
+                                ('total_seconds', total),
+                                ('peak_mb', peak_rss())])
+            line.update(record.values)
+            line['stages'] = record.stages
+            self.log.write(json.dumps(line) + '\n')
+            self.log.flush()
+
+        return record
+
+    def summary(self):
+        """
+        Summarises the slots completed so far
+        :return: dictionary with the run time, number of slots, peak memory,
+        the share of time spent on I/O and the totals of each stage
+        """
+
+        seconds = _clock() - self.start
+        io_seconds = sum(self.totals[name]['seconds'] for name in
+                         self.totals if name in IO_STAGES)
+
+        return OrderedDict([('seconds', seconds),
+                            ('slots', self.n_slots),
+                            ('peak_mb', peak_rss()),
+                            ('io_fraction', io_seconds / seconds if
+                             seconds > 0 else 0.),
+                            ('stages', self.totals)])
+
+    def report(self):
+        """
+        Formats the summary as a table of stages
+        :return: a multi-line string
+        """
+
+        summary = self.summary()
+        lines = ['Tracked %d slots in %.1f s, peak memory %.0f MB' %
+                 (summary['slots'], summary['seconds'],
+                  summary['peak_mb']),
+                 '%-16s %10s %10s %10s %10s %10s' % ('stage', 'total s',
+                                                      'mean ms', 'max ms',
+                                                      'RSS +MB',
+                                                      'traced MB')]
+        for name in self.totals:
+            totals = self.totals[name]
+            lines.append('%-16s %10.2f %10.1f %10.1f %10.1f %10.1f' % (
+                name, totals['seconds'],
+                1000 * totals['seconds'] / totals['slots'],
+                1000 * totals['max_seconds'], totals['rss_growth_mb'],
+                totals['max_traced_peak_mb']))
+        lines.append('RSS +MB is the total growth of resident memory over '
+                     'each stage, and traced MB the largest peak of traced '
+                     'memory above the start of a stage')
+        lines.append('Stages ' + ', '.join(READ_STAGES) + ' run in the '
+                     'reader thread alongside tracking')
+        lines.append('Time in the main loop spent waiting on I/O: %.0f%%' %
+                     (100 * summary['io_fraction']))
+
+        return '\n'.join(lines)
+
+    def close(self, summary_file=config.METRICS_SUMMARY_FILE):
+        """
+        Closes the log and writes the run summary
+        :param summary_file: path of a JSON file for the summary, or None
+        :return: the summary report from report
+        """
+
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        if summary_file is not None:
+            with open(summary_file, 'w') as f:
+                json.dump(self.summary(), f, indent=1)
+
+        return self.report()
@@ -1,15 +1,21 @@
 import matplotlib
 matplotlib.use('Agg')
-from mpop.satellites import GeostationaryFactory
 import datetime
+import functools
+import hashlib
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from netCDF4 import Dataset
 from netCDF4 import date2num
-from pycoast import ContourWriterAGG
 from PIL import Image
 from pyproj import Proj
 from pyresample.geometry import SwathDefinition
-from pyresample.kd_tree import resample_nearest
+from pyresample.kd_tree import get_neighbour_info
+
+import config
+import timeslots
 
 def load_channels(datetime):
     """
@@ -24,6 +30,9 @@ def load_channels(datetime):
     12.0, 10.8, 8.7 for the desired time
     :return time_slot: a datetime object corresponding to the desired timestep
     """
+    # mpop is imported here so the rest of the module works without it
+    from mpop.satellites import GeostationaryFactory
+
     # Create a datetime object
     time_slot = datetime
 
@@ -34,91 +43,547 @@ def load_channels(datetime):
     return global_data, time_slot
 
 
+# SEVIRI channels loaded for the pink dust RGB, in the order of the channel
+# axis of a batch, and the names mpop gives them
+SEVIRI_CHANNELS = (8.7, 10.8, 12.0)
+SEVIRI_CHANNEL_NAMES = {8.7: 'IR_087', 10.8: 'IR_108', 12.0: 'IR_120'}
+
+
+def get_area_window(source_extent, source_shape, area_extent):
+    """
+    Finds the pixel window of a geostationary grid which covers an area
+    :param source_extent: (x_min, y_min, x_max, y_max) of the grid in
+    projection metres, with the first row at y_max
+    :param source_shape: the (y, x) shape of the grid
+    :param area_extent: (x_min, y_min, x_max, y_max) of the area in
+    projection metres, or None for the whole grid
+    :return: a (row slice, column slice) tuple
+    """
+
+    if area_extent is None:
+        return (slice(None), slice(None))
+
+    x_min, y_min, x_max, y_max = source_extent
+    pixel_height = float(y_max - y_min) / source_shape[0]
+    pixel_width = float(x_max - x_min) / source_shape[1]
+
+    row_lower = max(int(np.floor((y_max - area_extent[3]) / pixel_height)),
+                    0)
+    row_upper = min(int(np.ceil((y_max - area_extent[1]) / pixel_height)),
+                    source_shape[0])
+    column_lower = max(int(np.floor((area_extent[0] - x_min) /
+                                    pixel_width)), 0)
+    column_upper = min(int(np.ceil((area_extent[2] - x_min) /
+                                   pixel_width)), source_shape[1])
+    if row_lower >= row_upper or column_lower >= column_upper:
+        raise ValueError('The area ' + str(area_extent) + ' lies outside '
+                         'the grid ' + str(source_extent))
+
+    return (slice(row_lower, row_upper), slice(column_lower, column_upper))
+
+
+class MpopBackend(object):
+    """
+    Reads the channels of a slot through mpop. The satellite, channel list
+    and area are set up once for a batch, and the area extent is passed to
+    the loader so only its pixels are read and calibrated. Each worker
+    thread creates one scene and reuses it for every slot it reads.
+    """
+
+    def __init__(self, area_extent=None, satellite='Meteosat-9',
+                 channels=SEVIRI_CHANNELS):
+        """
+        :param area_extent: (x_min, y_min, x_max, y_max) of the area in
+        projection metres, or None for the full disk
+        :param satellite: the mpop satellite name
+        :param channels: the channels to load, in order
+        """
+        self.area_extent = area_extent
+        self.satellite = satellite
+        self.channels = list(channels)
+        self.load_options = {}
+        if area_extent is not None:
+            self.load_options['area_extent'] = area_extent
+        self.local = threading.local()
+
+    def get_scene(self, slot):
+        """
+        Finds the scene of the calling thread, creating it on first use,
+        and points it at a slot
+        :param slot: datetime object of the slot
+        :return: an mpop scene object with no channels loaded
+        """
+
+        scene = getattr(self.local, 'scene', None)
+        if scene is None:
+            # mpop is imported here so the rest of the module works
+            # without it
+            from mpop.satellites import GeostationaryFactory
+            scene = self.local.scene = GeostationaryFactory.create_scene(
+                self.satellite, "", "seviri", slot)
+        else:
+            # The previous slot's channels are dropped before the scene is
+            # reused
+            scene.unload(*self.channels)
+            scene.time_slot = slot
+
+        return scene
+
+    def read_slot(self, slot):
+        """
+        :param slot: datetime object of the slot
+        :return: masked array of shape (channel, y, x)
+        """
+
+        global_data = self.get_scene(slot)
+        global_data.load(self.channels, **self.load_options)
+
+        data = [global_data[channel].data for channel in self.channels]
+
+        return np.ma.array([np.ma.getdata(i) for i in data],
+                           mask=[np.ma.getmaskarray(i) for i in data],
+                           dtype=np.float32)
+
+
+class FixtureBackend(object):
+    """
+    Reads the channels of a slot from a local .npz fixture, standing in for
+    mpop so batches can be loaded offline. Each fixture holds the grid
+    extent and an array per channel, written by write_fixture.
+    """
+
+    def __init__(self, template, area_extent=None,
+                 channels=SEVIRI_CHANNELS):
+        """
+        :param template: fixture file template, formatted with {month}
+        and {date} like the templates in config
+        :param area_extent: (x_min, y_min, x_max, y_max) of the area in
+        projection metres, or None for the whole fixture grid
+        :param channels: the channels to load, in order
+        """
+        self.template = template
+        self.area_extent = area_extent
+        self.channels = list(channels)
+        self.window = None
+
+    def read_slot(self, slot):
+        """
+        :param slot: datetime object of the slot
+        :return: masked array of shape (channel, y, x)
+        """
+
+        filename = timeslots.format_filenames(self.template, [slot])[0]
+        if not os.path.exists(filename):
+            raise IOError('No fixture ' + filename)
+        saved = np.load(filename)
+
+        # The window of the area is found from the first fixture and then
+        # reused, as every fixture is on the same grid
+        names = [SEVIRI_CHANNEL_NAMES[channel] for channel in self.channels]
+        if self.window is None:
+            self.window = get_area_window(saved['area_extent'],
+                                          saved[names[0]].shape,
+                                          self.area_extent)
+
+        return np.ma.array([saved[name][self.window] for name in names],
+                           mask=[saved[name + '_mask'][self.window] for
+                                 name in names], dtype=np.float32)
+
+
+def write_fixture(filename, data, area_extent, channels=SEVIRI_CHANNELS):
+    """
+    Writes channel data as a fixture for FixtureBackend
+    :param filename: path of the .npz file
+    :param data: array (optionally masked) of shape (channel, y, x)
+    :param area_extent: (x_min, y_min, x_max, y_max) of the grid in
+    projection metres
+    :param channels: the channels along the first axis of data
+    """
+
+    arrays = {'area_extent': np.asarray(area_extent, dtype=float)}
+    for i, channel in enumerate(channels):
+        name = SEVIRI_CHANNEL_NAMES[channel]
+        arrays[name] = np.ma.getdata(data[i])
+        arrays[name + '_mask'] = np.ma.getmaskarray(data[i])
+    np.savez(filename, **arrays)
+
+
+def _read_batch_slot(backend, item):
+    # Read errors are returned rather than raised, so one missing slot does
+    # not stop the rest of the batch
+    i, slot = item
+    try:
+        return i, backend.read_slot(slot)
+    except (IOError, OSError) as error:
+        return i, error
+
+
+def load_channel_batch(slots, area_extent=None, backend=None,
+                       workers=config.CHANNEL_LOAD_WORKERS):
+    """
+    Loads channels 8.7, 10.8 and 12.0 for a batch of slots with a pool of
+    worker threads, into one stacked array. np.moveaxis(stack, 1, -1) is
+    the (time, y, x, channel) view taken by generate_image_from_array, and
+    the stack can be regridded directly with a Resampler using axis=2.
+    :param slots: list of datetime objects
+    :param area_extent: (x_min, y_min, x_max, y_max) of the area of
+    interest in projection metres, or None for the full disk. Ignored if a
+    backend is given.
+    :param backend: an object with a read_slot(slot) method returning a
+    (channel, y, x) array, e.g. a FixtureBackend. By default an
+    MpopBackend for the area is used.
+    :param workers: number of slots loaded at once
+    :return stack: masked float32 array of shape (time, channel, y, x),
+    masked throughout for slots which could not be read
+    :return missing: list of the slots which could not be read
+    """
+
+    if backend is None:
+        backend = MpopBackend(area_extent)
+
+    stack = None
+    failed = []
+    pool = ThreadPool(workers)
+    try:
+        for i, result in pool.imap_unordered(
+                functools.partial(_read_batch_slot, backend),
+                enumerate(slots)):
+            if isinstance(result, EnvironmentError):
+                print('Could not load ' + str(slots[i]) + ': ' +
+                      str(result))
+                failed.append(i)
+                continue
+            # The stack is allocated once the first slot gives its shape
+            if stack is None:
+                stack = np.ma.masked_all((len(slots),) + result.shape,
+                                         dtype=np.float32)
+            stack[i] = result
+    finally:
+        pool.close()
+        pool.join()
+
+    if stack is None:
+        raise IOError('None of the ' + str(len(slots)) + ' slots could be '
+                      'loaded')
+
+    return stack, [slots[i] for i in sorted(failed)]
+
+
 def generate_image(global_data, filename):
     """
     This function generates an RGB composite directly from a scene with
-    loaded channels and saves to a GeoTiff
+    loaded channels, draws coastlines and borders over it and saves it once
     :param global_data: an mpop scene object with data from IR channels
     12.0, 10.8, 8.7
     :param filename: a string with the name of the image file to be generated
     """
 
-    # Generate a dust composite with Pytroll inbuilt function
+    # Generate a dust composite with Pytroll inbuilt function and keep it in
+    # memory
     img = global_data.image.dust()
+    rgb = pil_frame(img.pil_image())
+
+    write_frame(rgb, config.IMAGERY_DIR + filename)
+
 
-    # Save the image initially so it can be read in as an image object
-    img.save("/ouce-home/students/hert4173/SEVIRI_imagery/" + filename)
+def pil_frame(image):
+    """
+    Converts a PIL image into a frame which write_frame can draw on
+    :param image: a PIL image
+    :return: writable uint8 array of shape (y, x, 3)
+    """
 
-    # Read it back in as an image object
-    img = Image.open("/ouce-home/students/hert4173/SEVIRI_imagery/" + filename)
+    # np.asarray of a PIL image is read-only, so the frame is copied
+    return np.array(image.convert('RGB'))
 
-    # Define projection parameters
-    proj4_string = '+proj=geos +lon_0=0.0 +a=6378169.00 +b=6356583.80 ' \
-                   '+h=35785831.0'
-    area_extent = (-2000000, 0, 3000000, 4000000)
-    area_def = (proj4_string, area_extent)
 
-    # ContourWriterAGG here requires the 'aggdraw' package
-    cw = ContourWriterAGG(
-        '/ouce-home/students/hert4173/.conda_envs/virtual_env/lib/python2.7/'
-        'pycoast/GSHHS_DATA_ROOT')
-    cw.add_coastlines(img, area_def, resolution='i', width=3)
-    cw.add_borders(img, area_def, outline=(255, 255, 255), resolution='i',
-                   width=3)
-    img.save("/ouce-home/students/hert4173/SEVIRI_imagery/" + filename)
+# Full disk SEVIRI projection and the area extent of the quicklooks
+SEVIRI_AREA_DEF = ('+proj=geos +lon_0=0.0 +a=6378169.00 +b=6356583.80 '
+                   '+h=35785831.0', (-2000000, 0, 3000000, 4000000))
 
+# Coastline and border overlays already rasterized in this run, keyed by
+# area definition, image size, resolution and line width
+_overlay_cache = {}
 
-def generate_image_from_array(data_array):
+
+def get_overlay(shape, area_def=SEVIRI_AREA_DEF, resolution='i', width=3):
     """
-    Generate a pink dust image from a SEVIRI netCDF file with channels 12.0,
-    10.8, 8.7
-    :param ncdata: a netCDF4 dataset object containing SEVIRI data
-    :param filename: string containing the name of the output jpg image
-    :return img: a GeoImage object
+    Rasterizes coastlines and borders onto a transparent layer, once per
+    area definition and image size. Only the pixels under a line are kept,
+    as flat indices with their alpha and premultiplied colour, so applying
+    the overlay touches nothing else.
+    :param shape: the (y, x) shape of the frames
+    :param area_def: (proj4 string, area extent) of the frames
+    :param resolution: GSHHS resolution of the lines
+    :param width: line width in pixels
+    :return: a tuple of the flat pixel indices, their alpha (0-255, shape
+    (n, 1)) and their colour multiplied by alpha (shape (n, 3))
     """
 
-    # Read in brightness temperature channels
-    IR_087 = data_array[:, :, 0]
-    IR_108 = data_array[:, :, 1]
-    IR_120 = data_array[:, :, 2]
-
-    # Parameters for pink dust formula from Brindley et al. (2012)
-    MinR = -4.0
-    MaxR = 2.0
-    MinG = 0.0
-    MaxG = 15.0
-    MinB = 261.0
-    MaxB = 289.0
-    GammaR = 1.0
-    GammaG = 2.5
-    GammaB = 1.0
+    key = (area_def, tuple(shape), resolution, width)
+    if key not in _overlay_cache:
+        layer = Image.new('RGBA', (shape[1], shape[0]), (0, 0, 0, 0))
+
+        # pycoast is imported here so the rest of the module works without
+        # it. ContourWriterAGG here requires the 'aggdraw' package.
+        from pycoast import ContourWriterAGG
+        cw = ContourWriterAGG(config.GSHHS_DATA_ROOT)
+        cw.add_coastlines(layer, area_def, resolution=resolution,
+                          width=width)
+        cw.add_borders(layer, area_def, outline=(255, 255, 255),
+                       resolution=resolution, width=width)
+
+        layer = np.asarray(layer).reshape(-1, 4)
+        pixels = np.flatnonzero(layer[:, 3])
+        alpha = layer[pixels, 3:].astype(np.uint16)
+        _overlay_cache[key] = (pixels, alpha,
+                               layer[pixels, :3].astype(np.uint16) * alpha)
+
+    return _overlay_cache[key]
+
+
+def apply_overlay(rgb, overlay):
+    """
+    Alpha-composites an overlay from get_overlay onto a frame in place
+    :param rgb: uint8 array of shape (y, x, 3)
+    :param overlay: the overlay tuple from get_overlay
+    :return rgb: the same array, with the overlay drawn on
+    """
+
+    pixels, alpha, premultiplied = overlay
+    flat = rgb.reshape(-1, 3)
+    blended = flat[pixels].astype(np.uint16) * (255 - alpha) + \
+        premultiplied
+    flat[pixels] = (blended + 127) // 255
+
+    return rgb
+
+
+def write_frame(rgb, filename, area_def=SEVIRI_AREA_DEF, overlay=True):
+    """
+    Draws the coastline and border overlay onto a frame and writes it
+    :param rgb: uint8 array of shape (y, x, 3), drawn on in place
+    :param filename: path of the image file, whose extension sets the
+    format
+    :param area_def: (proj4 string, area extent) of the frame
+    :param overlay: if False, the frame is written without the overlay
+    """
+
+    if overlay:
+        apply_overlay(rgb, get_overlay(rgb.shape[:2], area_def))
+    Image.fromarray(rgb).save(filename)
+
+
+def _write_frame_tiles(rgb, filename, tile_size, area_def, overlay):
+    # Tiles are cut from the frame after the overlay is drawn, and named
+    # by their row and column
+    if overlay:
+        apply_overlay(rgb, get_overlay(rgb.shape[:2], area_def))
+    root, extension = os.path.splitext(filename)
+    filenames = []
+    for row in np.arange(0, rgb.shape[0], tile_size):
+        for column in np.arange(0, rgb.shape[1], tile_size):
+            tile_filename = root + '_' + str(row // tile_size) + '_' + \
+                str(column // tile_size) + extension
+            Image.fromarray(rgb[row:row + tile_size,
+                                column:column + tile_size]).save(
+                tile_filename)
+            filenames.append(tile_filename)
+    return filenames
+
+
+def _render_slot(data_stack, filenames, tile_size, area_def, overlay, i):
+    rgb = generate_image_from_array(data_stack[i])
+    if tile_size is None:
+        write_frame(rgb, filenames[i], area_def, overlay)
+        return [filenames[i]]
+    return _write_frame_tiles(rgb, filenames[i], tile_size, area_def,
+                              overlay)
+
+
+def export_frames(data_stack, slots, directory, extension='.png',
+                  tile_size=None, area_def=SEVIRI_AREA_DEF, overlay=True,
+                  workers=config.RENDER_WORKERS):
+    """
+    Renders and writes the dust RGB of every slot of a stack with a pool of
+    worker threads. The overlay is rasterized once and shared by every
+    frame.
+    :param data_stack: array (optionally masked) of BTs of shape (time, y,
+    x, 3) with channels 8.7, 10.8 and 12.0
+    :param slots: list of datetime objects, one per frame
+    :param directory: directory the frames are written to, named by their
+    datestring
+    :param extension: image file extension, which sets the format
+    :param tile_size: if given, each frame is written as square tiles of
+    this many pixels instead of a single image
+    :param area_def: (proj4 string, area extent) of the frames
+    :param overlay: if False, frames are written without the overlay
+    :param workers: number of frames rendered at once
+    :return: list of the files written
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filenames = [os.path.join(directory, datestring + extension) for
+                 datestring in timeslots.format_datestrings(slots)]
+
+    # Rasterize the overlay before the workers start, so they share it
+    if overlay:
+        get_overlay(np.shape(data_stack)[1:3], area_def)
+
+    pool = ThreadPool(workers)
+    try:
+        written = pool.map(functools.partial(
+            _render_slot, data_stack, filenames, tile_size, area_def,
+            overlay), range(len(filenames)))
+    finally:
+        pool.close()
+        pool.join()
+
+    return [filename for frame in written for filename in frame]
+
+
+def _animation_frames(data_stack, area_def, overlay):
+    # Each frame is composited only when the writer asks for it, so the
+    # RGB of the whole stack is never held at once
+    for i in np.arange(0, np.shape(data_stack)[0]):
+        rgb = generate_image_from_array(data_stack[i])
+        if overlay:
+            apply_overlay(rgb, get_overlay(rgb.shape[:2], area_def))
+        yield Image.fromarray(rgb)
+
+
+def export_animation(data_stack, filename, duration=200,
+                     area_def=SEVIRI_AREA_DEF, overlay=True):
+    """
+    Renders the dust RGB of every slot of a stack into an animated GIF,
+    streaming the frames to the writer one slot at a time
+    :param data_stack: array (optionally masked) of BTs of shape (time, y,
+    x, 3) with channels 8.7, 10.8 and 12.0
+    :param filename: path of the animation
+    :param duration: milliseconds per frame
+    :param area_def: (proj4 string, area extent) of the frames
+    :param overlay: if False, frames are rendered without the overlay
+    """
+
+    frames = _animation_frames(data_stack, area_def, overlay)
+    first = next(frames)
+    first.save(filename, save_all=True, append_images=frames,
+               duration=duration, loop=0)
 
-    # Masked array elements are replaced with zero
-    imgR = np.ma.filled(
-        (255 * (((IR_120 - IR_108) - MinR) / (MaxR - MinR)) ** (1.0 / GammaR)),
-        fill_value=0)
-    imgG = np.ma.filled(
-        (255 * (((IR_108 - IR_087) - MinG) / (MaxG - MinG)) ** (1.0 / GammaG)),
-        fill_value=0)
-    imgB = np.ma.filled(
-        (255 * ((IR_108 - MinB) / (MaxB - MinB)) ** (1.0 / GammaB)),
-        fill_value=0)
+
+# Parameters for pink dust formula from Brindley et al. (2012), as (Min,
+# Max, Gamma) for the red, green and blue beams
+DUST_RGB_PARAMETERS = ((-4.0, 2.0, 1.0),
+                       (0.0, 15.0, 2.5),
+                       (261.0, 289.0, 1.0))
+
+
+def _composite_beam(a, b, mask, minimum, maximum, gamma, scratch, out):
+    """
+    Scales one beam of the pink dust RGB into a uint8 output channel,
+    working in place in a scratch buffer
+    :param a: BT array, or the first BT of a difference
+    :param b: BT array subtracted from a, or None
+    :param mask: boolean array of pixels to set to zero, or None
+    :param minimum: the value mapped to 0
+    :param maximum: the value mapped to 255
+    :param gamma: the gamma correction
+    :param scratch: a float array of the same shape as a
+    :param out: a uint8 array view of the output channel
+    """
+
+    if b is None:
+        np.subtract(a, minimum, out=scratch)
+    else:
+        np.subtract(a, b, out=scratch)
+        scratch -= minimum
+    scratch /= (maximum - minimum)
+
+    # The power is only needed when there is a gamma correction, and the
+    # scaled values are clipped first so it never sees a negative base
+    if gamma != 1.0:
+        np.clip(scratch, 0, 1, out=scratch)
+        np.power(scratch, 1.0 / gamma, out=scratch)
+    scratch *= 255
 
     # Elements outside the RGB range are set to zero or 255
-    imgR[imgR < 0] = 0
-    imgR[imgR > 255] = 255
-    imgG[imgG < 0] = 0
-    imgG[imgG > 255] = 255
-    imgB[imgB < 0] = 0
-    imgB[imgB > 255] = 255
+    np.clip(scratch, 0, 255, out=scratch)
+
+    # Masked array elements are replaced with zero
+    if mask is not None:
+        scratch[mask] = 0
 
-    # All values are set to 'uint8' form from which an image can be generated
-    rgbArray = np.zeros((imgR.shape[0], imgR.shape[1], 3), 'uint8')
-    rgbArray[:, :, 0] = imgR
-    rgbArray[:, :, 1] = imgG
-    rgbArray[:, :, 2] = imgB
+    # Casting truncates to 'uint8' form from which an image can be generated
+    np.copyto(out, scratch, casting='unsafe')
 
-    return rgbArray
+
+def _composite_slot(data_array, out, scratch=None):
+    """
+    Writes the pink dust RGB of a single slot into a uint8 output array
+    :param data_array: an array (optionally masked) of BTs of shape (y, x,
+    3) with channels 8.7, 10.8 and 12.0
+    :param out: a uint8 array of shape (y, x, 3)
+    :param scratch: a float array of shape (y, x) to reuse, or None
+    :return scratch: the scratch array, for reuse by the next slot
+    """
+
+    # Read in brightness temperature channels
+    data = np.ma.getdata(data_array)
+    IR_087 = data[:, :, 0]
+    IR_108 = data[:, :, 1]
+    IR_120 = data[:, :, 2]
+
+    # Each beam is zero wherever one of its channels is masked
+    mask = np.ma.getmask(data_array)
+    if mask is np.ma.nomask:
+        mask_R = mask_G = mask_B = None
+    else:
+        mask_R = mask[:, :, 2] | mask[:, :, 1]
+        mask_G = mask[:, :, 1] | mask[:, :, 0]
+        mask_B = mask[:, :, 1]
+
+    if scratch is None or scratch.shape != IR_108.shape:
+        scratch = np.empty(IR_108.shape,
+                           np.result_type(data.dtype, np.float32))
+
+    (MinR, MaxR, GammaR), (MinG, MaxG, GammaG), (MinB, MaxB, GammaB) = \
+        DUST_RGB_PARAMETERS
+    _composite_beam(IR_120, IR_108, mask_R, MinR, MaxR, GammaR, scratch,
+                    out[:, :, 0])
+    _composite_beam(IR_108, IR_087, mask_G, MinG, MaxG, GammaG, scratch,
+                    out[:, :, 1])
+    _composite_beam(IR_108, None, mask_B, MinB, MaxB, GammaB, scratch,
+                    out[:, :, 2])
+
+    return scratch
+
+
+def generate_image_from_array(data_array, out=None):
+    """
+    Generate a pink dust image from an array of SEVIRI channels 8.7, 10.8
+    and 12.0
+    :param data_array: an array (optionally masked) of BTs with the
+    channels along the last axis, either for one slot (y, x, 3) or for a
+    stack of slots (time, y, x, 3)
+    :param out: a uint8 array of the same shape to write the image into.
+    A new one is allocated if this is None.
+    :return rgbArray: the uint8 RGB array
+    """
+
+    if out is None:
+        out = np.zeros(np.shape(data_array), 'uint8')
+
+    # A stack of slots is composited one slot at a time so the scratch
+    # buffer stays the size of a single image
+    if np.ndim(data_array) == 4:
+        scratch = None
+        for i in np.arange(0, np.shape(data_array)[0]):
+            scratch = _composite_slot(data_array[i], out[i], scratch)
+    else:
+        _composite_slot(data_array, out)
+
+    return out
 
 
 def get_datetime_objects(time_params):
@@ -129,55 +594,269 @@ def get_datetime_objects(time_params):
     :return datetimes: array of datetime objects
     """
 
-    # Get the lower and upper bound of the datetime objects
-    datetime_lower = datetime.datetime(time_params[0], time_params[2],
-                                       time_params[4], time_params[6],
-                                       time_params[8])
-    datetime_upper = datetime.datetime(time_params[1], time_params[3],
-                                       time_params[5], time_params[7],
-                                       time_params[9])
+    return timeslots.slots_from_time_params(time_params).astype(
+        datetime.datetime)
 
-    # Get the difference between the two dates in minutes using a timedelta
-    # object
-    td = datetime_upper - datetime_lower
-    mins_difference = divmod(td.days * 86400 + td.seconds, 60)[0]
 
-    # Get an array of minute values with 15 minute intervals
-    minutes_range = np.arange(0, mins_difference + 15, 15)
+# Reprojected grids already used in this run, keyed by _projection_key
+_latlon_cache = {}
 
-    # Get an array of datetime objects for each 15 minute interval
-    datetimes = np.array(
-        [datetime_lower + datetime.timedelta(minutes=i) for i in
-         minutes_range])
 
-    return datetimes
+def _projection_key(h, x0, y0):
+    """
+    Builds a key identifying a geostationary grid
+    :param h: the satellite viewing height
+    :param x0: 1D array of x coordinates
+    :param y0: 1D array of y coordinates
+    :return: a string which changes if the height or either axis changes
+    """
+
+    coordinate_hash = hashlib.sha1()
+    coordinate_hash.update(np.asarray(x0, dtype=np.float64).tobytes())
+    coordinate_hash.update(np.asarray(y0, dtype=np.float64).tobytes())
+
+    return '%d_%s' % (int(round(h)), coordinate_hash.hexdigest()[:16])
+
+
+def _save_array(filename, array):
+    # Write to a temporary file first so a partial file is never loaded
+    partial = filename + '.partial'
+    with open(partial, 'wb') as f:
+        np.save(f, array)
+    os.rename(partial, filename)
 
 
-def reproject_to_latlon(nc):
+def reproject_to_latlon(nc, cache_dir=config.PROJECTION_CACHE_DIR):
     """
-    Reprojects geostationary projection coordinates to latitude and longitude
+    Reprojects geostationary projection coordinates to latitude and
+    longitude. The SEVIRI grid does not change between slots, so the
+    result is kept in memory for the run and saved as .npy files in
+    cache_dir, which are memory-mapped by later runs.
     :param nc: a netCDF dataset object
+    :param cache_dir: directory for the cached grids, or None to keep
+    them in memory only
     :return: longitude and latitude values
     """
 
     # Get the satellite viewing height
     h = nc.variables['grid_mapping_0'].perspective_point_height
+    x0 = np.asarray(nc.variables['x0'][:])
+    y0 = np.asarray(nc.variables['y0'][:])
 
-    # Define a geostationary projection
-    p = Proj(proj='geos', h=h, lon_0=0)
+    key = _projection_key(h, x0, y0)
+    if key in _latlon_cache:
+        return _latlon_cache[key]
 
-    # Longitude values are duplicated along the y-axis to create a 2D array
-    # (note, should use np.meshgrid)
-    x = np.resize(nc.variables['x0'][:] * h, (2400, 3000))
-    # Latitude values are duplicated along the x-axis to create a 2D array
-    y = np.array([nc.variables['y0'][:] * h] * 3000).transpose()
+    if cache_dir is not None:
+        lons_file = os.path.join(cache_dir, 'lons_' + key + '.npy')
+        lats_file = os.path.join(cache_dir, 'lats_' + key + '.npy')
 
-    # Reproject
-    lons, lats = p(x, y, inverse=True)
+    if cache_dir is not None and os.path.exists(lons_file) and \
+            os.path.exists(lats_file):
+        lons = np.load(lons_file, mmap_mode='r')
+        lats = np.load(lats_file, mmap_mode='r')
+    else:
+        # Define a geostationary projection
+        p = Proj(proj='geos', h=h, lon_0=0)
+
+        # Broadcast the x coordinates along the y-axis and the y coordinates
+        # along the x-axis without materialising copies of either
+        x, y = np.broadcast_arrays(x0[np.newaxis, :] * h,
+                                   y0[:, np.newaxis] * h)
+
+        # Reproject
+        lons, lats = p(x, y, inverse=True)
+
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _save_array(lons_file, lons)
+            _save_array(lats_file, lats)
+
+    _latlon_cache[key] = (lons, lats)
 
     return lons, lats
 
 
+class Resampler(object):
+    """
+    Nearest-neighbour resampling from one grid to another. The neighbour
+    search is done once, giving the flat source index of every target
+    pixel, and any number of channels or timesteps are then resampled with
+    a single gather. The index can be saved to disk and reloaded by later
+    runs on the same grids.
+    """
+
+    def __init__(self, source_index, source_shape, target_shape):
+        """
+        :param source_index: flat index into the source grid for every
+        target pixel, or -1 where no source pixel is within range
+        :param source_shape: the (y, x) shape of the source grid
+        :param target_shape: the (y, x) shape of the target grid
+        """
+        self.source_index = np.asarray(source_index)
+        self.source_shape = tuple(source_shape)
+        self.target_shape = tuple(target_shape)
+        self.valid = self.source_index >= 0
+        self._gather_index = np.where(self.valid, self.source_index, 0)
+
+    @classmethod
+    def from_grids(cls, lons, lats, target_lons, target_lats,
+                   radius_of_influence=7000):
+        """
+        Runs the neighbour search between two grids
+        :param lons: 2D array of source longitudes
+        :param lats: 2D array of source latitudes
+        :param target_lons: 2D array of target longitudes
+        :param target_lats: 2D array of target latitudes
+        :param radius_of_influence: the maximum distance in metres to a
+        neighbour
+        :return: a Resampler
+        """
+
+        def_a = SwathDefinition(lons=target_lons, lats=target_lats)
+        def_b = SwathDefinition(lons=lons, lats=lats)
+        valid_input_index, valid_output_index, index_array, distance_array \
+            = get_neighbour_info(def_b, def_a, radius_of_influence,
+                                 neighbours=1)
+
+        # Indices returned by the search refer to the valid source pixels
+        # only, and equal their count where nothing was found in range
+        valid_inputs = np.flatnonzero(valid_input_index)
+        valid_outputs = np.flatnonzero(valid_output_index)
+        found = index_array < valid_inputs.shape[0]
+
+        source_index = np.empty(np.size(target_lons), dtype=np.int64)
+        source_index[:] = -1
+        source_index[valid_outputs[found]] = valid_inputs[index_array[found]]
+
+        return cls(source_index, np.shape(lons), np.shape(target_lons))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a Resampler saved with save
+        :param filename: path of the .npz file
+        :return: a Resampler
+        """
+
+        saved = np.load(filename)
+        return cls(saved['source_index'], saved['source_shape'],
+                   saved['target_shape'])
+
+    def save(self, filename):
+        """
+        Saves the neighbour index so later runs can skip the search
+        :param filename: path of the .npz file
+        """
+        np.savez(filename, source_index=self.source_index,
+                 source_shape=self.source_shape,
+                 target_shape=self.target_shape)
+
+    def _gather(self, array, axis):
+        # Flatten the two grid axes and take the neighbour of every target
+        # pixel in one go
+        shape = array.shape
+        flat = array.reshape(shape[:axis] + (-1,) + shape[axis + 2:])
+        gathered = np.take(flat, self._gather_index, axis=axis)
+        return gathered.reshape(shape[:axis] + self.target_shape +
+                                shape[axis + 2:])
+
+    def __call__(self, array, axis=0, fill_value=0):
+        """
+        Resamples an array with the source grid on two of its axes
+        :param array: an array (optionally masked) of shape
+        (..., y, x, ...) matching the source grid, e.g. (y, x), (y, x,
+        channel) or (time, y, x, channel)
+        :param axis: the position of the source y axis in array
+        :param fill_value: value for target pixels with no neighbour in
+        range, or None to return them masked
+        :return: the array on the target grid
+        """
+
+        data = self._gather(np.ma.getdata(array), axis)
+        masked = fill_value is None or np.ma.isMaskedArray(array)
+        if masked:
+            mask = self._gather(np.ma.getmaskarray(array), axis)
+
+        # Select the target pixels with no neighbour along the grid axes
+        invalid = (slice(None),) * axis + (~self.valid.reshape(
+            self.target_shape),)
+        if fill_value is None:
+            mask[invalid] = True
+        else:
+            data[invalid] = fill_value
+            if masked:
+                mask[invalid] = False
+
+        if masked:
+            return np.ma.array(data, mask=mask)
+        return data
+
+
+# Resamplers already built in this run, with the grids they were built from
+_resampler_cache = []
+
+# The number of resamplers kept in _resampler_cache
+RESAMPLER_CACHE_SIZE = 4
+
+
+def regular_grid(lons, lats):
+    """
+    Defines a regular lon/lat grid spanning an irregular one at its
+    average resolution
+    :param lons: an array of irregular longitude values
+    :param lats: an array of irregular latitude values
+    :return: 1D arrays of regular longitudes and latitudes
+    """
+
+    # Define the average interval in the existing lons and lats
+    intervals_lon = (np.max(lons) - np.min(lons)) / len(lons[0])
+    intervals_lat = (np.max(lats) - np.min(lats)) / len(lats)
+
+    # Define a regular grid
+    XI = np.arange(np.min(lons), np.max(lons), intervals_lon)
+    YI = np.arange(np.min(lats), np.max(lats), intervals_lat)
+
+    return XI, YI
+
+
+def get_resampler(lons, lats, target_lons=None, target_lats=None,
+                  radius_of_influence=7000):
+    """
+    Returns a Resampler from an irregular grid to a regular one, reusing
+    one already built in this run from the same grid arrays. The grids
+    from reproject_to_latlon are cached, so every slot of a run passes the
+    same array objects and the neighbour search is only run once.
+    :param lons: 2D array of source longitudes
+    :param lats: 2D array of source latitudes
+    :param target_lons: 1D array of target longitudes (defaults to the
+    regular_grid spanning the source)
+    :param target_lats: 1D array of target latitudes (defaults to the
+    regular_grid spanning the source)
+    :param radius_of_influence: the maximum distance in metres to a
+    neighbour
+    :return: a Resampler
+    """
+
+    key = (lons, lats, target_lons, target_lats)
+    for cached_key, cached_radius, resampler in _resampler_cache:
+        if all(i is j for i, j in zip(key, cached_key)) and \
+                cached_radius == radius_of_influence:
+            return resampler
+
+    if target_lons is None or target_lats is None:
+        target_lons, target_lats = regular_grid(lons, lats)
+    XI, YI = np.meshgrid(target_lons, target_lats)
+    resampler = Resampler.from_grids(lons, lats, XI, YI,
+                                     radius_of_influence)
+
+    _resampler_cache.append((key, radius_of_influence, resampler))
+    del _resampler_cache[:-RESAMPLER_CACHE_SIZE]
+
+    return resampler
+
+
 def regrid_data(lons, lats, target_lons, target_lats, array):
     """
     Regrids the irregular lons and lats produced by the reprojection so that
@@ -186,20 +865,15 @@ def regrid_data(lons, lats, target_lons, target_lats, array):
     reprojection function
     :param lats: an array of irregular latitude values produced by the
     reprojection function
+    :param target_lons: 1D array of target longitudes
+    :param target_lats: 1D array of target latitudes
     :param array: an array BTs or RGB values for each pixel
     :return: the array on an interpolated regular grid
     """
 
-    # Define a target grid
-    XI = target_lons
-    YI = target_lats
-    XI, YI = np.meshgrid(XI, YI)
-
     # Resample BT data
-    def_a = SwathDefinition(lons=XI, lats=YI)
-    def_b = SwathDefinition(lons=lons, lats=lats)
-    interp_dat = resample_nearest(def_b, array, def_a,
-                                  radius_of_influence=7000)
+    resampler = get_resampler(lons, lats, target_lons, target_lats)
+    interp_dat = resampler(array)
 
     return interp_dat
 
@@ -212,36 +886,185 @@ def regrid_data_to_regular(lons, lats, array):
     reprojection function
     :param lats: an array of irregular latitude values produced by the
     reprojection function
-    :param array: an array BTs or RGB values for each pixel
+    :param array: an array BTs or RGB values for each pixel, with channels
+    along the last axis
     :return: the array on an interpolated regular grid
     """
 
-    # Define the average interval in the existing lons and lats
-    intervals_lon = (np.max(lons) - np.min(lons)) / len(lons[0])
-    intervals_lat = (np.max(lats) - np.min(lats)) / len(lats)
+    # Resample all channels of the BT data with a single gather
+    resampler = get_resampler(lons, lats)
+    interp_dat_BTs = resampler(array)
 
-    # Define a regular grid
-    XI = np.arange(np.min(lons), np.max(lons), intervals_lon)
-    YI = np.arange(np.min(lats), np.max(lats), intervals_lat)
-    XI, YI = np.meshgrid(XI, YI)
+    return interp_dat_BTs
 
-    # Resample BT data
-    def_a = SwathDefinition(lons=XI, lats=YI)
-    def_b = SwathDefinition(lons=lons, lats=lats)
-    interp_dat_0 = resample_nearest(def_b, array[:, :, 0], def_a,
-                                    radius_of_influence=7000)
-    interp_dat_1 = resample_nearest(def_b, array[:, :, 1], def_a,
-                                    radius_of_influence=7000)
-    interp_dat_2 = resample_nearest(def_b, array[:, :, 2], def_a,
-                                    radius_of_influence=7000)
-
-    # Recombine into a single array
-    interp_dat_BTs = array
-    interp_dat_BTs[:, :, 0] = interp_dat_0
-    interp_dat_BTs[:, :, 1] = interp_dat_1
-    interp_dat_BTs[:, :, 2] = interp_dat_2
 
-    return interp_dat_BTs
+# Chunk shapes for the regridded channels, as (time, lat, lon). A chunk
+# size of None spans the whole dimension. 'map' suits reading whole slots,
+# 'timeseries' suits reading long time series at a few pixels.
+CHUNK_SHAPES = {'map': (1, None, None),
+                'timeseries': (96, 64, 64)}
+
+# Packing of BTs into int16 when quantising, giving 0.01 K steps from
+# about -77 K to 577 K
+BT_SCALE_FACTOR = 0.01
+BT_ADD_OFFSET = 250.0
+
+
+class RegriddedWriter(object):
+    """
+    Appends regridded BT channels and cloud masks to compressed netCDF files
+    along the time dimension. A file is kept open for each period (a day
+    or a month) and the next one is opened when a slot from a new period
+    is appended. Existing files are appended to rather than overwritten.
+    Slots are held in memory until they fill a chunk along time and are
+    then written as one block, so each chunk is compressed once rather
+    than read back and recompressed for every slot. Held slots are written
+    by flush, close or the start of a new period.
+    """
+
+    CHANNELS = ('channel_087', 'channel_108', 'channel_120')
+
+    def __init__(self, filename, lons, lats, period='day', chunking='map',
+                 packed=False, complevel=4):
+        """
+        :param filename: the file to write to. If it contains '{period}',
+        this is replaced by the date (YYYYmmdd) or month (YYYYmm) of each
+        slot to give one file per period.
+        :param lons: 1D array with regular lons
+        :param lats: 1D array with regular lats
+        :param period: 'day' or 'month'
+        :param chunking: a key of CHUNK_SHAPES, or a (time, lat, lon) tuple
+        :param packed: if True, BTs are quantised to int16 with a scale
+        factor and offset, and the cloud mask is stored as int8
+        :param complevel: zlib compression level from 1 to 9
+        """
+        self.filename = filename
+        self.lons = lons
+        self.lats = lats
+        self.period_format = {'day': '%Y%m%d', 'month': '%Y%m'}[period]
+        if chunking in CHUNK_SHAPES:
+            chunking = CHUNK_SHAPES[chunking]
+        time_chunk, lat_chunk, lon_chunk = chunking
+        self.chunksizes = (time_chunk or 1,
+                           min(lat_chunk or len(lats), len(lats)),
+                           min(lon_chunk or len(lons), len(lons)))
+        self.packed = packed
+        self.complevel = complevel
+        self.ncfile = None
+        self.current_filename = None
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _create(self, filename):
+        ncfile = Dataset(filename, 'w', format='NETCDF4_CLASSIC')
+        ncfile.description = 'Brightness temperature values from Meteosat ' \
+                             'SEVIRI, reprojected to lat/lon from ' \
+                             'Geostationary.'
+        ncfile.createDimension('time', None)
+        ncfile.createDimension('lat', len(self.lats))
+        ncfile.createDimension('lon', len(self.lons))
+        times = ncfile.createVariable('time', np.float64, ('time',))
+        latitudes = ncfile.createVariable('latitude', np.float32, ('lat',))
+        longitudes = ncfile.createVariable('longitude', np.float32,
+                                           ('lon',))
+        latitudes.units = 'degrees_north'
+        longitudes.units = 'degrees_east'
+        times.units = 'hours since 0001-01-01 00:00:00'
+        times.calendar = 'gregorian'
+        latitudes[:] = self.lats
+        longitudes[:] = self.lons
+
+        compression = dict(zlib=True, shuffle=True,
+                           complevel=self.complevel,
+                           chunksizes=self.chunksizes)
+        for name in self.CHANNELS:
+            if self.packed:
+                channel = ncfile.createVariable(name, np.int16,
+                                                ('time', 'lat', 'lon'),
+                                                fill_value=-32768,
+                                                **compression)
+                channel.scale_factor = BT_SCALE_FACTOR
+                channel.add_offset = BT_ADD_OFFSET
+            else:
+                channel = ncfile.createVariable(name, np.float32,
+                                                ('time', 'lat', 'lon'),
+                                                **compression)
+            channel.units = 'K'
+        ncfile.createVariable('cloud_mask',
+                              np.int8 if self.packed else np.float32,
+                              ('time', 'lat', 'lon'), **compression)
+
+        return ncfile
+
+    def _open(self, date):
+        filename = self.filename.replace(
+            '{period}', date.strftime(self.period_format))
+        if filename == self.current_filename:
+            return
+
+        self.close()
+        if os.path.exists(filename):
+            self.ncfile = Dataset(filename, 'a')
+        else:
+            self.ncfile = self._create(filename)
+        self.current_filename = filename
+
+    def append(self, date, array_87, array_108, array_120,
+               cloudmask_regridded):
+        """
+        Appends one slot of regridded data along the time dimension
+        :param date: datetime object of the slot
+        :param array_87: array with data for BT channel 8.7 on a regular grid
+        :param array_108: array with data for BT channel 10.8 on a regular
+        grid
+        :param array_120: array with data for BT channel 12.0 on a regular
+        grid
+        :param cloudmask_regridded: array with the cloud mask on a regular
+        grid
+        """
+
+        self._open(date)
+        self.buffer.append((date, (array_87, array_108, array_120,
+                                   cloudmask_regridded)))
+        if len(self.buffer) >= self.chunksizes[0]:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the slots held in memory to the file as one block
+        """
+
+        if len(self.buffer) == 0:
+            return
+
+        variables = self.ncfile.variables
+        times = variables['time']
+        i = len(times)
+        n = len(self.buffer)
+        dates = [date for date, arrays in self.buffer]
+
+        times[i:i + n] = date2num(dates, times.units, times.calendar)
+        for j, name in enumerate(self.CHANNELS + ('cloud_mask',)):
+            variables[name][i:i + n, :, :] = np.ma.stack(
+                [arrays[j] for date, arrays in self.buffer])
+        self.buffer = []
+
+    def close(self):
+        """
+        Writes any slots held in memory and closes the file currently
+        being written
+        """
+
+        if self.ncfile is not None:
+            self.flush()
+            self.ncfile.close()
+            self.ncfile = None
+            self.current_filename = None
 
 
 def save_regridded_data_to_nc(filename, array_87, array_108, array_120,
@@ -254,33 +1077,12 @@ def save_regridded_data_to_nc(filename, array_87, array_108, array_120,
     :param array_120: array with data for BT channel 12.0 on a regular grid
     :param lons: 1D array with regular lons
     :param lats: 1D array with regular lats
+    :param date: datetime object of the slot
     """
-    ncfile = Dataset(filename, 'w', format='NETCDF4_CLASSIC')
-    ncfile.description = 'Brightness temperature values from Meteosat ' \
-                         'SEVIRI, reprojected to lat/lon from Geostationary.'
-    time = ncfile.createDimension('time', None)
-    lat = ncfile.createDimension('lat', len(lats))
-    lon = ncfile.createDimension('lon', len(lons))
-    times = ncfile.createVariable('time', np.float64, ('time'))
-    latitudes = ncfile.createVariable('latitude', np.float32, ('lat'))
-    longitudes = ncfile.createVariable('longitude', np.float32, ('lon'))
-    channel_087 = ncfile.createVariable('channel_087', np.float32,
-                                        ('lat', 'lon'))
-    channel_108 = ncfile.createVariable('channel_108', np.float32,
-                                        ('lat', 'lon'))
-    channel_120 = ncfile.createVariable('channel_120', np.float32,
-                                        ('lat', 'lon'))
-    cloudmask = ncfile.createVariable('cloud_mask', np.float32, ('lat', 'lon'))
-    latitudes.units = 'degrees_north'
-    longitudes.units = 'degrees_east'
-    times.units = 'hours since 0001-01-01 00:00:00'
-    times.calendar = 'gregorian'
-    latitudes[:] = lats
-    longitudes[:] = lons
-    times[:] = date2num(date, times.units)
-    channel_087[:] = array_87
-    channel_108[:] = array_108
-    channel_120[:] = array_120
-    cloudmask[:] = cloudmask_regridded
-    # Forgot to write to time coordinate variable
-    ncfile.close()
+
+    # A single slot is written as a new file with a time dimension of one
+    if os.path.exists(filename):
+        os.remove(filename)
+    with RegriddedWriter(filename, lons, lats) as writer:
+        writer.append(date, array_87, array_108, array_120,
+                      cloudmask_regridded)
@@ -0,0 +1,330 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.colors import BoundaryNorm, ListedColormap
+from mpl_toolkits.basemap import Basemap
+import multiprocessing
+import numpy as np
+from scipy import ndimage
+
+"""
+Plume map rendering. The map background is drawn once and a single image
+artist is updated for every slot, with plume colours looked up from a table
+indexed by plume ID. Rendered frames are encoded and written by a pool of
+background processes while the next slot is tracked.
+"""
+
+# Map extent as (lon_min, lon_max, lat_min, lat_max)
+DEFAULT_EXTENT = (-21, 31, 10, 41)
+
+# Plume colours. Colour index 0 is left transparent for the background.
+DEFAULT_PALETTE = plt.cm.gist_rainbow(np.linspace(0, 1, 256))
+
+
+def _write_frame(filename, rgba):
+    plt.imsave(filename, rgba)
+
+
+def fill_masked_corners(lons, lats):
+    """
+    Fills masked pixel lon/lats, e.g. off the edge of the disk, from the
+    nearest valid pixel, so they can be used as the corners of a mesh. The
+    cells with a filled corner collapse onto their valid neighbours and
+    are flagged so they are not drawn.
+    :param lons: 2D array (optionally masked) of pixel longitudes
+    :param lats: 2D array (optionally masked) of pixel latitudes
+    :return lons: 2D array of longitudes with no masked or nan values
+    :return lats: 2D array of latitudes with no masked or nan values
+    :return bad_cells: boolean array of the mesh cells, one row and column
+    smaller than lons, true where a corner was filled, or None if nothing
+    was filled
+    """
+
+    invalid = np.ma.getmaskarray(lons) | np.ma.getmaskarray(lats)
+    lons = np.ma.filled(np.ma.asarray(lons, dtype=float), np.nan)
+    lats = np.ma.filled(np.ma.asarray(lats, dtype=float), np.nan)
+    invalid |= ~np.isfinite(lons) | ~np.isfinite(lats)
+    if not invalid.any():
+        return lons, lats, None
+    if invalid.all():
+        raise ValueError('No valid lon/lats to draw the plumes on')
+
+    # Indices of the nearest valid pixel to every pixel
+    nearest = ndimage.distance_transform_edt(invalid, return_distances=False,
+                                             return_indices=True)
+    lons = lons[tuple(nearest)]
+    lats = lats[tuple(nearest)]
+
+    bad_cells = invalid[:-1, :-1] | invalid[1:, :-1] | invalid[:-1, 1:] | \
+        invalid[1:, 1:]
+
+    return lons, lats, bad_cells
+
+
+class PlumeMapRenderer(object):
+    """
+    Renders labelled plume rasters onto a fixed map background and writes
+    them as image files
+    """
+
+    def __init__(self, lons, lats, extent=DEFAULT_EXTENT,
+                 palette=DEFAULT_PALETTE, processes=2, max_pending=8,
+                 dpi=100):
+        """
+        :param lons: 1D array of regular longitudes or 2D array of pixel
+        longitudes
+        :param lats: 1D array of regular latitudes or 2D array of pixel
+        latitudes
+        :param extent: map extent as (lon_min, lon_max, lat_min, lat_max)
+        :param palette: array of RGBA colours, of shape (n, 4)
+        :param processes: number of processes writing frames
+        :param max_pending: number of frames which can wait to be written
+        before render blocks
+        :param dpi: resolution of the written frames
+        """
+        self.fig, self.ax = plt.subplots(dpi=dpi)
+        self.m = Basemap(projection='cyl', llcrnrlon=extent[0],
+                         urcrnrlon=extent[1], llcrnrlat=extent[2],
+                         urcrnrlat=extent[3], resolution='i', ax=self.ax)
+        self.m.drawcoastlines(linewidth=0.5)
+        self.m.drawcountries(linewidth=0.5)
+
+        # Colour indices map straight onto the palette, and masked pixels
+        # are not drawn
+        self.n_colours = np.shape(palette)[0]
+        cmap = ListedColormap(np.concatenate(([[0, 0, 0, 0]], palette)))
+        cmap.set_bad((0, 0, 0, 0))
+        norm = BoundaryNorm(np.arange(self.n_colours + 2) - 0.5,
+                            self.n_colours + 1)
+
+        # A regular grid is drawn as an image. Other grids are drawn as a
+        # mesh with the pixel lon/lats as corners, dropping the last row
+        # and column of values.
+        self.bad_cells = None
+        if np.ndim(lons) == 1:
+            self.shape = (np.shape(lats)[0], np.shape(lons)[0])
+            self.trim = (slice(None), slice(None))
+            self.artist = self.ax.imshow(
+                np.ma.masked_all(self.shape), cmap=cmap, norm=norm,
+                interpolation='nearest',
+                origin='lower' if lats[-1] > lats[0] else 'upper',
+                extent=(lons[0], lons[-1], min(lats[0], lats[-1]),
+                        max(lats[0], lats[-1])), zorder=2)
+        else:
+            self.shape = np.shape(lons)
+            self.trim = (slice(None, -1), slice(None, -1))
+            lons, lats, self.bad_cells = fill_masked_corners(lons, lats)
+            x, y = self.m(lons, lats)
+            self.artist = self.ax.pcolormesh(
+                x, y, np.ma.masked_all(self.shape)[self.trim], cmap=cmap,
+                norm=norm, zorder=2)
+
+        # The background is rendered once and restored under every frame
+        self.artist.set_visible(False)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.artist.set_visible(True)
+
+        self.pool = multiprocessing.Pool(processes)
+        self.max_pending = max_pending
+        self.pending = []
+
+    def colour_indices(self, labels, colour_lut=None):
+        """
+        Looks up the colour of every pixel of a labelled raster
+        :param labels: 2D array of plume labels, zero outside plumes
+        :param colour_lut: integer array of palette colours (1 to n)
+        indexed by plume ID, e.g. ColourAllocator.lut, or None to colour
+        plumes by ID
+        :return: masked array of colour indices
+        """
+
+        labels = np.asarray(labels)
+        if colour_lut is None:
+            colours = labels % self.n_colours + 1
+        else:
+            colours = np.asarray(colour_lut)[labels]
+
+        return np.ma.masked_where(labels == 0, colours)
+
+    def render(self, labels, filename, colour_lut=None, title=None):
+        """
+        Draws a labelled raster over the background and queues the frame to
+        be written
+        :param labels: 2D array of plume labels on the renderer's grid
+        :param filename: path of the image file
+        :param colour_lut: integer array of palette colours (1 to n)
+        indexed by plume ID, e.g. ColourAllocator.lut, or None to colour
+        plumes by ID
+        :param title: title of the frame, or None
+        """
+
+        colours = self.colour_indices(labels, colour_lut)[self.trim]
+        if self.bad_cells is not None:
+            colours = np.ma.masked_where(self.bad_cells, colours)
+        self.artist.set_array(colours)
+
+        # Only the plumes and the title are drawn over the background. The
+        # frame is copied out so the canvas can be reused straight away.
+        self.fig.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.artist)
+        if title is not None:
+            self.ax.set_title(title)
+            self.ax.draw_artist(self.ax.title)
+        rgba = np.array(self.fig.canvas.buffer_rgba())
+
+        # Wait for the oldest frame if too many are queued
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).get()
+        self.pending.append(self.pool.apply_async(_write_frame,
+                                                  (filename, rgba)))
+
+    def close(self):
+        """
+        Waits for every queued frame to be written and closes the figure
+        """
+
+        for result in self.pending:
+            result.get()
+        self.pending = []
+        self.pool.close()
+        self.pool.join()
+        plt.close(self.fig)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ColourAllocator(object):
+    """
+    Gives each plume a palette colour for its whole lifetime. Free colours
+    are kept on a stack, so allocating and freeing cost O(1) per plume, and
+    the colour of every plume ID is kept in a dense lookup table which
+    colours a labelled raster with a single indexing operation. If every
+    colour is in use, new plumes share a colour chosen from their ID.
+    """
+
+    def __init__(self, n_colours=None, seed=0):
+        """
+        :param n_colours: number of palette colours, numbered 1 to
+        n_colours. Defaults to the size of DEFAULT_PALETTE.
+        :param seed: seed for the order colours are handed out in, so
+        neighbouring plumes are unlikely to get similar colours
+        """
+        if n_colours is None:
+            n_colours = np.shape(DEFAULT_PALETTE)[0]
+        self.n_colours = n_colours
+        self.free = np.random.RandomState(seed).permutation(
+            np.arange(1, n_colours + 1))
+        self.n_free = n_colours
+
+        # Colour of each plume ID (0 for none), and whether it was taken
+        # from the free stack rather than shared
+        self.lut = np.zeros(64, dtype=np.int32)
+        self.owned = np.zeros(64, dtype=bool)
+        self.active = np.zeros(0, dtype=np.int64)
+
+    def _reserve(self, max_id):
+        # Double the table until it covers the largest ID
+        capacity = self.lut.shape[0]
+        if max_id < capacity:
+            return
+        while capacity <= max_id:
+            capacity *= 2
+        for name in ('lut', 'owned'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:column.shape[0]] = column
+            setattr(self, name, grown)
+
+    def allocate(self, ids):
+        """
+        Gives each plume ID a colour
+        :param ids: array of plume IDs without a colour
+        """
+
+        ids = np.asarray(ids, dtype=np.int64)
+        if ids.shape[0] == 0:
+            return
+        self._reserve(int(np.max(ids)))
+
+        # Colours are popped off the free stack while any remain
+        popped = min(ids.shape[0], self.n_free)
+        self.n_free -= popped
+        self.lut[ids[:popped]] = self.free[self.n_free:self.n_free + popped]
+        self.owned[ids[:popped]] = True
+
+        shared = ids[popped:]
+        self.lut[shared] = shared % self.n_colours + 1
+        self.owned[shared] = False
+
+    def release(self, ids):
+        """
+        Returns the colours of plume IDs to the free stack
+        :param ids: array of plume IDs which no longer exist
+        """
+
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[ids < self.lut.shape[0]]
+        owned = ids[self.owned[ids]]
+        self.free[self.n_free:self.n_free + owned.shape[0]] = self.lut[owned]
+        self.n_free += owned.shape[0]
+
+        self.lut[ids] = 0
+        self.owned[ids] = False
+
+    def update(self, plume_ids):
+        """
+        Frees the colours of plumes which have died and allocates colours to
+        new plumes
+        :param plume_ids: array of the plume IDs active at this timestep
+        """
+
+        plume_ids = np.unique(np.asarray(plume_ids, dtype=np.int64))
+        self.release(np.setdiff1d(self.active, plume_ids,
+                                  assume_unique=True))
+        self.allocate(np.setdiff1d(plume_ids, self.active,
+                                   assume_unique=True))
+        self.active = plume_ids
+
+    def colour(self, labels):
+        """
+        Colours a labelled raster
+        :param labels: array of plume labels, zero outside plumes
+        :return: array of colours, zero outside plumes
+        """
+
+        return self.lut[labels]
+
+    def to_arrays(self):
+        """
+        Gathers the allocator state, e.g. as extra arrays for a checkpoint,
+        so plumes keep their colours when a run is resumed
+        :return: dictionary of arrays, all prefixed 'colour_'
+        """
+
+        return {'colour_free': self.free,
+                'colour_n_free': np.int64(self.n_free),
+                'colour_lut': self.lut,
+                'colour_owned': self.owned,
+                'colour_active': self.active}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuilds an allocator from the output of to_arrays
+        :param arrays: dictionary-like object of arrays
+        :return: a ColourAllocator
+        """
+
+        allocator = cls(n_colours=len(arrays['colour_free']))
+        allocator.free = np.array(arrays['colour_free'])
+        allocator.n_free = int(arrays['colour_n_free'])
+        allocator.lut = np.array(arrays['colour_lut'], dtype=np.int32)
+        allocator.owned = np.array(arrays['colour_owned'], dtype=bool)
+        allocator.active = np.array(arrays['colour_active'], dtype=np.int64)
+
+        return allocator
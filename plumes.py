@@ -1,74 +1,290 @@
+import datetime
 import numpy as np
-from scipy.ndimage import measurements
 from scipy import ndimage as ndi
 
+import config
+import metrics
+
 """
 Handling of plumes objects, including updating of attributes and testing for
 mechanism type
 """
 
+# Global function to build the overlap contingency table between timesteps
+def overlap_table(sdf_clusters, num, sdf_prev):
+    """
+    Counts the pixels shared by every current plume label and every previous
+    plume label in a single pass over the raster
+    :param sdf_clusters: array of current plume labels, numbered 1 to num
+    :param num: the number of current plume labels
+    :param sdf_prev: array of previous plume labels
+    :return counts: array of shape (num+1, len(prev_ids)), where counts[i,
+    j] is the number of pixels of current label i lying on previous ID
+    prev_ids[j]
+    :return prev_ids: sorted array of the previous IDs indexing the columns
+    of counts, with 0 (no plume) always in the first column
+    """
+
+    # Only pixels in a current plume can contribute to an overlap
+    plume_pixels = sdf_clusters != 0
+    current = sdf_clusters[plume_pixels].astype(np.intp)
+    previous = np.asarray(sdf_prev)[plume_pixels]
+
+    # Compact the previous IDs so the table only spans IDs that are present
+    prev_ids, prev_index = np.unique(np.append(0, previous),
+                                     return_inverse=True)
+    prev_index = prev_index[1:]
+
+    # One bincount over the paired labels gives the whole table
+    n_prev = prev_ids.shape[0]
+    counts = np.bincount(current * n_prev + prev_index,
+                         minlength=(num + 1) * n_prev)
+
+    return counts.reshape(num + 1, n_prev), prev_ids
+
+
+# Global function to match current plume labels to previous plume IDs
+def match_to_previous(sdf_clusters, num, sdf_prev):
+    """
+    Finds which current plume labels overlap a previous plume and the
+    previous ID each of them should inherit
+    :param sdf_clusters: array of current plume labels, numbered 1 to num
+    :param num: the number of current plume labels
+    :param sdf_prev: array of previous plume labels
+    :return overlapping: boolean array of length num+1, True for labels
+    with any pixel lying on a previous plume
+    :return prev_match: array of length num+1 with the previous ID matched
+    to each label
+    """
+
+    return match_overlaps(*overlap_table(sdf_clusters, num, sdf_prev))
+
+
+def match_overlaps(counts, prev_ids):
+    """
+    Matches current plume labels to previous IDs from an overlap table
+    :param counts: the overlap table from overlap_table
+    :param prev_ids: the previous IDs indexing the columns of counts
+    :return overlapping: boolean array of length num+1, True for labels
+    with any pixel lying on a previous plume
+    :return prev_match: array of length num+1 with the previous ID matched
+    to each label
+    """
+
+    # A plume is overlapping if any of its pixels lie on a previous plume
+    overlapping = counts[:, 1:].sum(axis=1) > 0
+    overlapping[0] = False
+
+    # Take the most common of the previous IDs (including no plume) as
+    # the one which should be applied to the new plume
+    prev_match = prev_ids[np.argmax(counts, axis=1)]
+
+    return overlapping, prev_match
+
+
+def split_fragments(counts, prev_ids, overlapping, prev_match):
+    """
+    Finds the labels which split off a previous plume. Of the labels
+    matched to the same previous ID, the one with the largest overlap with
+    it continues the plume and the rest are fragments.
+    :param counts: the overlap table from overlap_table
+    :param prev_ids: the previous IDs indexing the columns of counts
+    :param overlapping: the overlapping labels from match_overlaps
+    :param prev_match: the previous ID matched to each label from
+    match_overlaps
+    :return: boolean array of length num+1, True for split fragments
+    """
+
+    fragments = np.zeros(counts.shape[0], dtype=bool)
+    labels = np.flatnonzero(overlapping & (prev_match != 0))
+    if labels.shape[0] == 0:
+        return fragments
+
+    # Sort the matched labels by parent, then largest overlap first, then
+    # scan order, so the first label of each parent keeps its ID
+    parents = prev_match[labels]
+    overlap = counts[labels, np.searchsorted(prev_ids, parents)]
+    order = np.lexsort((labels, -overlap, parents))
+    parents = parents[order]
+    first = np.ones(parents.shape[0], dtype=bool)
+    first[1:] = parents[1:] != parents[:-1]
+    fragments[labels[order][~first]] = True
+
+    return fragments
+
+
+# One parent-to-child edge of the plume lineage. Overlap is in pixels.
+# child_fraction is the share of the child lying on the parent, and
+# parent_fraction the share of the parent's overlap with current plumes
+# which went to the child. fragments is the number of separate clusters of
+# the child on the parent, so more than one means the parent split and the
+# fragments kept its ID.
+EDGE_DTYPE = np.dtype([('parent', '<i8'), ('child', '<i8'),
+                       ('overlap', '<i8'), ('fragments', '<i4'),
+                       ('child_fraction', '<f4'),
+                       ('parent_fraction', '<f4')])
+
+
+# Global function to turn an overlap table into lineage edges
+def lineage_edges(counts, prev_ids, id_lookup):
+    """
+    Builds the parent-to-child edges between two timesteps from the same
+    overlap table used for matching, without another pass over the raster
+    :param counts: the overlap table from overlap_table
+    :param prev_ids: the previous IDs indexing the columns of counts
+    :param id_lookup: array mapping each current label to its plume ID
+    :return: array of EDGE_DTYPE records sorted by parent then child
+    """
+
+    # Labels matched to no plume (0) are dropped from the raster, so only
+    # labels which keep an ID can be children
+    labels, columns = np.nonzero(counts[1:, 1:])
+    labels += 1
+    columns += 1
+    kept = np.asarray(id_lookup)[labels] != 0
+    labels = labels[kept]
+    columns = columns[kept]
+    if labels.shape[0] == 0:
+        return np.zeros(0, dtype=EDGE_DTYPE)
+
+    # Labels which share a plume ID are combined into a single child
+    id_lookup = np.asarray(id_lookup)
+    child_ids = id_lookup[labels]
+    pairs, pair_index = np.unique(
+        np.stack((prev_ids[columns], child_ids), axis=1), axis=0,
+        return_inverse=True)
+    pair_index = np.ravel(pair_index)
+    overlap = np.bincount(pair_index, weights=counts[labels, columns])
+
+    # Child areas are summed over their labels, and parent totals over
+    # every current plume, both from the table's margins
+    current_ids, current_index = np.unique(id_lookup[1:],
+                                           return_inverse=True)
+    child_area = np.bincount(np.ravel(current_index),
+                             weights=counts[1:].sum(axis=1))
+    parent_total = counts[1:].sum(axis=0)
+
+    edges = np.zeros(pairs.shape[0], dtype=EDGE_DTYPE)
+    edges['parent'] = pairs[:, 0]
+    edges['child'] = pairs[:, 1]
+    edges['overlap'] = overlap
+    edges['fragments'] = np.bincount(pair_index)
+    edges['child_fraction'] = overlap / child_area[
+        np.searchsorted(current_ids, pairs[:, 1])]
+    edges['parent_fraction'] = overlap / parent_total[
+        np.searchsorted(prev_ids, pairs[:, 0])]
+
+    return edges
+
+
+# Global function to label connected clusters above a minimum size
+def label_clusters(sdf, min_size=250, structure=None):
+    """
+    Labels the connected clusters in an SDF, removes those of min_size
+    pixels or fewer and compacts the surviving labels to consecutive IDs,
+    all from a single labelling pass
+    :param sdf: array of SDF values, nonzero where dust is flagged
+    :param min_size: clusters of this many pixels or fewer are discarded
+    :param structure: connectivity structuring element passed to
+    ndimage.label (None gives the default cross-shaped connectivity)
+    :return sdf_clusters: array of cluster labels numbered 1 to num
+    :return num: the number of clusters kept
+    """
+
+    label_objects, nb_labels = ndi.label(sdf, structure=structure)
+    sizes = np.bincount(label_objects.ravel())
+
+    # Set clusters of min_size or fewer pixels to zero
+    mask_sizes = sizes > min_size
+    mask_sizes[0] = False
+    num = int(np.count_nonzero(mask_sizes))
+
+    # Surviving labels keep their scan order but are renumbered 1 to num
+    id_lookup = np.zeros(sizes.shape[0], dtype=label_objects.dtype)
+    id_lookup[mask_sizes] = np.arange(1, num + 1)
+    sdf_clusters = id_lookup[label_objects]
+
+    return sdf_clusters, num
+
+
 # Global function to scan the SDFs for unique plumes
-def scan_for_plumes(sdf_now, sdf_prev):
+def scan_for_plumes(sdf_now, sdf_prev, min_size=250, structure=None,
+                    next_id=None, return_edges=False, split_ids=False,
+                    record=metrics.NULL_RECORD):
     """
     Scans a set of SDFs for plumes and labels them
-    :param SDF_now:
-    :return:
+    :param sdf_now: array of SDF values for the current timestep
+    :param sdf_prev: array of plume labels from the previous timestep, or
+    None for the first timestep
+    :param min_size: clusters of this many pixels or fewer are not plumes
+    :param structure: connectivity structuring element for the labelling
+    :param next_id: the highest plume ID assigned so far in the run. If
+    given, new plumes are numbered above it, so the IDs of plumes which
+    have died are never reused. Otherwise new plumes are numbered above
+    the highest ID in sdf_prev.
+    :param return_edges: if True, the lineage edges between the previous
+    and current plumes are also returned
+    :param split_ids: if True, when a previous plume splits only the
+    fragment with the largest overlap keeps its ID, and the others are
+    given new IDs with an edge from the parent. Otherwise every fragment
+    keeps the parent's ID.
+    :param record: a metrics.SlotRecord in which the labelling, matching
+    and lineage stages are measured
+    :return sdf_clusters: array of plume IDs for the current timestep
+    :return new_ids: IDs of plumes with no overlap with a previous plume,
+    and of split fragments if split_ids is True
+    :return large_plume_ids: IDs of all plumes in the current timestep
+    :return edges: array of EDGE_DTYPE records from lineage_edges, only
+    if return_edges is True
     """
 
+    with record.stage('labelling'):
+        sdf_clusters, num = label_clusters(sdf_now, min_size, structure)
+
     if sdf_prev is None:
-        label_objects, nb_labels = ndi.label(sdf_now)
-        sizes = np.bincount(label_objects.ravel())
-
-        # Set clusters smaller than size 250 to zero
-        mask_sizes = sizes > 250
-        mask_sizes[0] = 0
-        sdf_now = mask_sizes[label_objects]
-
-        sdf_clusters, num = measurements.label(sdf_now)
-        plume_ids = np.unique(sdf_clusters)
-        large_plume_ids = np.unique(sdf_clusters[sdf_clusters != 0])
-        new_ids = large_plume_ids
+        old_id_max = 0
     else:
-        label_objects, nb_labels = ndi.label(sdf_now)
-        sizes = np.bincount(label_objects.ravel())
-
-        # Set clusters smaller than size 250 to zero
-        mask_sizes = sizes > 250
-        mask_sizes[0] = 0
-        sdf_now = mask_sizes[label_objects]
-
-        sdf_clusters, num = measurements.label(sdf_now)
-        plume_ids = np.unique(sdf_clusters)
-        large_plume_ids = np.unique(sdf_clusters[sdf_clusters != 0])
-
-        # Increase the plume_ID so that they are all new
         old_id_max = np.max(sdf_prev)
-        sdf_clusters[sdf_clusters != 0] += old_id_max
-
-        # Get an array of plumes which are overlapping
-        overlaps = (sdf_clusters > 0) & (sdf_prev > 0)
-        overlapping_ids = np.unique(sdf_clusters[overlaps])
-        large_plume_ids = np.unique(sdf_clusters[sdf_clusters != 0])
-        new_ids = [j for j in large_plume_ids if j not in overlapping_ids]
-        if new_ids == [0]:
-            new_ids = []
+    if next_id is not None:
+        old_id_max = max(old_id_max, next_id)
+
+    edges = np.zeros(0, dtype=EDGE_DTYPE)
+    with record.stage('matching'):
+        if sdf_prev is None and old_id_max == 0:
+            large_plume_ids = np.arange(1, num + 1)
+            new_ids = large_plume_ids
         else:
-            new_ids = np.asarray(new_ids)
-            new_id_bool = np.asarray([i != 0 for i in new_ids])
-            if new_ids.shape[0] > 0:
-                new_ids = np.unique(new_ids[new_id_bool])
-
-        old_id_array = np.zeros(np.shape(sdf_clusters))
-        for i in overlapping_ids:
-            prev_ids = sdf_prev[sdf_clusters == i]
-            # Take the most common of the previous IDs as the one which should
-            # be applied to the new plume
-            counts = np.bincount(prev_ids)
-            prev_id = np.argmax(counts)
-            # Set prev_ID to whatever that is
-            sdf_clusters[sdf_clusters == i] = prev_id
-            old_id_array[sdf_clusters == i] = prev_id
-        large_plume_ids = np.unique(sdf_clusters[sdf_clusters != 0])
+            if sdf_prev is None:
+                overlapping = np.zeros(num + 1, dtype=bool)
+                prev_match = np.zeros(num + 1, dtype=np.int64)
+            else:
+                counts, prev_ids = overlap_table(sdf_clusters, num,
+                                                 sdf_prev)
+                overlapping, prev_match = match_overlaps(counts, prev_ids)
+
+            # Non-overlapping plumes get IDs above the previous maximum so
+            # that they are all new, as do split fragments if asked
+            inherits = overlapping
+            if split_ids and sdf_prev is not None:
+                inherits = overlapping & ~split_fragments(
+                    counts, prev_ids, overlapping, prev_match)
+            id_lookup = np.arange(num + 1) + old_id_max
+            id_lookup[0] = 0
+            new_ids = id_lookup[1:][~inherits[1:]]
+            id_lookup[inherits] = prev_match[inherits]
+
+            # Relabel the whole raster with a single lookup
+            id_lookup = id_lookup.astype(sdf_clusters.dtype)
+            sdf_clusters = id_lookup[sdf_clusters]
+            large_plume_ids = np.unique(id_lookup[1:])
+            large_plume_ids = large_plume_ids[large_plume_ids != 0]
+
+    if return_edges and sdf_prev is not None and old_id_max > 0:
+        with record.stage('lineage'):
+            edges = lineage_edges(counts, prev_ids, id_lookup)
+
+    if return_edges:
+        return sdf_clusters, new_ids, large_plume_ids, edges
     return sdf_clusters, new_ids, large_plume_ids
 
 # This returns a set of labeled plumes
@@ -89,26 +305,30 @@ def scan_for_plumes(sdf_now, sdf_prev):
 # next timestep you will just get objects for each new plume
 
 ## Class of plumes objects
-class Plume:
-
-    plume_id = 0
-    area = None
-    centroid_lat = None
-    centroid_lon = None
-    source_lat = None
-    source_lon = None
-    centroid_speed = None
-    centroid_direction = 0
-    duration = 0
-    emission_time = 0
-    major_axis_position = 0
-    minor_axis_position = 0
-    LLJ_likelihood = 0
-    CPO_likelihood = 0
+class Plume(object):
+
+    # Slots avoid a per-object dict when many plumes are held in memory
+    __slots__ = ('plume_id', 'area', 'centroid_lat', 'centroid_lon',
+                 'source_lat', 'source_lon', 'centroid_speed',
+                 'centroid_direction', 'duration', 'emission_time',
+                 'major_axis_position', 'minor_axis_position',
+                 'LLJ_likelihood', 'CPO_likelihood')
 
     def __init__(self, plume_id, emission_time):
         self.plume_id = plume_id
+        self.area = None
+        self.centroid_lat = None
+        self.centroid_lon = None
+        self.source_lat = None
+        self.source_lon = None
+        self.centroid_speed = None
+        self.centroid_direction = 0
+        self.duration = 0
         self.emission_time = emission_time
+        self.major_axis_position = 0
+        self.minor_axis_position = 0
+        self.LLJ_likelihood = 0
+        self.CPO_likelihood = 0
 
         # Now this function needs to work out for us where the new plume is
         # located by using the SDF map and finding where there is an ID
@@ -125,58 +345,15 @@ class Plume:
     # So at every timestep you get the plumes and label them, then get
     # instances
 
-    def update_position(self):
-        """
-        Takes an SDF map and updates the centroid lat and lon
-        :return:
-        """
-
-    def update_duration(self):
-        """
-        Takes an SDF map and updates the centroid lat and lon
-        :return:
-        """
-
-    def update_speed(self):
-        """
-        Takes an SDF map and updates the centroid lat and lon
-        :return:
-        """
-
-    def update_direction(self):
-        """
-        Takes an SDF map and updates the centroid lat and lon
-        :return:
-        """
-
-
+    # Position, duration, speed, direction and axes are updated for all
+    # active plumes at once by PlumeTable.update, and LLJ and CPO
+    # likelihoods by PlumeTable.update_mechanism_likelihood
 
     def move(self):
         pass
 
-    def merge(self):
-        pass
-
-    def die(self):
-        pass
-
-    def update_position(self):
-        pass
-
-    def update_duration(self):
-        pass
-
-    def update_speed(self):
-        pass
-
-    def update_direction(self):
-        pass
-
-    def update_axes(self):
-        pass
-
-    def update_mechanism_likelihood(self):
-        pass
+    # Merges and splits are recorded as parent-to-child edges by
+    # lineage.LineageGraph, and deaths by PlumeTable.die
 
 
     # Ok so there could be a method to update various parameters
@@ -205,13 +382,572 @@ class Plume:
 # Implement LLJ checks method
 # Implement CPO checks method
 
-## Class of convection objects
-# Area attribute
-# Centroid position attribute
+# Mean radius of the Earth in metres, used for centroid speeds
+EARTH_RADIUS = 6371000.0
 
-# Move method
-# Merge method
-# Die method
+
+def great_circle_distance(lat1, lon1, lat2, lon2):
+    """
+    Haversine distance between arrays of points
+    :param lat1: latitudes of the first points in degrees
+    :param lon1: longitudes of the first points in degrees
+    :param lat2: latitudes of the second points in degrees
+    :param lon2: longitudes of the second points in degrees
+    :return: array of distances in metres
+    """
+
+    lat1, lon1, lat2, lon2 = [np.radians(i) for i in (lat1, lon1, lat2,
+                                                      lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def initial_bearing(lat1, lon1, lat2, lon2):
+    """
+    Direction of travel from the first points to the second points
+    :param lat1: latitudes of the first points in degrees
+    :param lon1: longitudes of the first points in degrees
+    :param lat2: latitudes of the second points in degrees
+    :param lon2: longitudes of the second points in degrees
+    :return: array of bearings in degrees clockwise from north
+    """
+
+    lat1, lon1, lat2, lon2 = [np.radians(i) for i in (lat1, lon1, lat2,
+                                                      lon2)]
+    x = np.sin(lon2 - lon1) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - \
+        np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def mechanism_likelihoods(local_hour, convection_distance, speed, direction,
+                          radius=config.CONVECTION_RADIUS):
+    """
+    Scores plumes for emission by a low-level jet (LLJ) or a cold pool
+    outflow (CPO). LLJ emission peaks in the mid-morning, away from
+    convection, with plumes carried south-westward by the north-easterly
+    flow. CPO emission peaks in the evening, next to convection, with fast
+    moving fronts. Each likelihood is the mean of its three scores, which
+    each lie between 0 and 1.
+    :param local_hour: array of local solar hours of emission
+    :param convection_distance: array of the closest distance in pixels of
+    each plume to a convective cell, inf if there was none
+    :param speed: array of centroid speeds (m/s), nan before a plume has
+    a second position
+    :param direction: array of centroid directions of travel (degrees
+    clockwise from north)
+    :param radius: plumes within this many pixels of a cell are next to
+    convection
+    :return LLJ_likelihood: array of LLJ likelihoods
+    :return CPO_likelihood: array of CPO likelihoods
+    """
+
+    local_hour = np.asarray(local_hour, dtype=float)
+    near_convection = (np.asarray(convection_distance) <=
+                       radius).astype(float)
+    speed = np.where(np.isfinite(speed), speed, 0)
+    moved = speed > 0
+
+    # Timing scores fall off with the angle between the hour of emission
+    # and the peak hour
+    llj_time = 0.5 * (1 + np.cos(2 * np.pi * (local_hour -
+                                              config.LLJ_PEAK_HOUR) / 24))
+    cpo_time = 0.5 * (1 + np.cos(2 * np.pi * (local_hour -
+                                              config.CPO_PEAK_HOUR) / 24))
+
+    # Plumes which have not moved yet score neither way on direction
+    llj_direction = np.where(moved, 0.5 * (1 + np.cos(np.radians(
+        np.asarray(direction) - config.LLJ_DIRECTION))), 0.5)
+    cpo_speed = np.clip(speed / config.CPO_SPEED, 0, 1)
+
+    LLJ_likelihood = (llj_time + (1 - near_convection) + llj_direction) / 3
+    CPO_likelihood = (cpo_time + near_convection + cpo_speed) / 3
+
+    return LLJ_likelihood, CPO_likelihood
+
+
+# Global function to measure every plume in a labelled raster at once
+def plume_statistics(sdf_clusters, plume_ids, lons, lats):
+    """
+    Measures the area, centroid and axes of every plume in a labelled
+    raster. The plume pixels are extracted in a single pass over the
+    raster, and each statistic is a bincount over those pixels, so the cost
+    does not grow with the number of plumes.
+    :param sdf_clusters: array of plume IDs from scan_for_plumes
+    :param plume_ids: sorted array of the plume IDs to measure
+    :param lons: array (optionally masked) of pixel longitudes
+    :param lats: array (optionally masked) of pixel latitudes
+    :return: dictionary of arrays, in the order of plume_ids, with the area
+    (in pixels), centroid_lat, centroid_lon, and the major_axis and
+    minor_axis lengths (in km) of the plume's equivalent ellipse
+    """
+
+    plume_ids = np.asarray(plume_ids)
+    n_plumes = plume_ids.shape[0]
+
+    # Compact the plume IDs to 0 to n_plumes-1
+    pixels = sdf_clusters != 0
+    index = np.searchsorted(plume_ids, sdf_clusters[pixels])
+    area = np.bincount(index, minlength=n_plumes).astype(float)
+
+    # Only pixels with valid coordinates contribute to the moments
+    valid = ~(np.ma.getmaskarray(lons)[pixels] |
+              np.ma.getmaskarray(lats)[pixels])
+    index = index[valid]
+    lon = np.ma.getdata(lons)[pixels][valid].astype(np.float64)
+    lat = np.ma.getdata(lats)[pixels][valid].astype(np.float64)
+
+    def moment(weights):
+        return np.bincount(index, weights=weights, minlength=n_plumes)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        count = moment(None)
+        centroid_lon = moment(lon) / count
+        centroid_lat = moment(lat) / count
+        var_lon = moment(lon * lon) / count - centroid_lon ** 2
+        var_lat = moment(lat * lat) / count - centroid_lat ** 2
+        cov = moment(lon * lat) / count - centroid_lon * centroid_lat
+
+    # Convert the coordinate covariances to km about each centroid
+    km_per_degree = np.radians(1) * EARTH_RADIUS / 1000
+    coslat = np.cos(np.radians(centroid_lat))
+    sxx = var_lon * (km_per_degree * coslat) ** 2
+    syy = var_lat * km_per_degree ** 2
+    sxy = cov * km_per_degree ** 2 * coslat
+
+    # The eigenvalues of the covariance matrix give the ellipse axes
+    half_trace = (sxx + syy) / 2
+    root = np.sqrt(((sxx - syy) / 2) ** 2 + sxy ** 2)
+    major_axis = 4 * np.sqrt(np.maximum(half_trace + root, 0))
+    minor_axis = 4 * np.sqrt(np.maximum(half_trace - root, 0))
+
+    return {'area': area,
+            'centroid_lat': centroid_lat,
+            'centroid_lon': centroid_lon,
+            'major_axis': major_axis,
+            'minor_axis': minor_axis}
+
+
+## Table of plumes held as columns
+class PlumeTable(object):
+    """
+    A memory-compact collection of plumes. Each Plume attribute is held in
+    its own NumPy column with one row per plume, and the area and centroid
+    of every active plume are appended to history columns at each timestep.
+    The update methods act on all active plumes at once.
+    """
+
+    # Columns holding the Plume attributes, with their types and defaults
+    COLUMNS = (('plume_id', np.int64, 0),
+               ('emission_time', 'datetime64[m]', 'NaT'),
+               ('area', np.float64, np.nan),
+               ('centroid_lat', np.float64, np.nan),
+               ('centroid_lon', np.float64, np.nan),
+               ('source_lat', np.float64, np.nan),
+               ('source_lon', np.float64, np.nan),
+               ('centroid_speed', np.float64, np.nan),
+               ('centroid_direction', np.float64, 0),
+               ('duration', np.float64, 0),
+               ('major_axis_position', np.float64, 0),
+               ('minor_axis_position', np.float64, 0),
+               ('LLJ_likelihood', np.float64, 0),
+               ('CPO_likelihood', np.float64, 0),
+               # Tracking state which is not a Plume attribute
+               ('active', bool, False),
+               ('dormant', bool, False),
+               ('position_time', 'datetime64[m]', 'NaT'),
+               ('previous_lat', np.float64, np.nan),
+               ('previous_lon', np.float64, np.nan),
+               ('previous_time', 'datetime64[m]', 'NaT'),
+               ('convection_distance', np.float64, np.inf),
+               ('classified', bool, False))
+
+    # Columns appended for each active plume at every timestep
+    HISTORY_COLUMNS = (('time', 'datetime64[m]', 'NaT'),
+                       ('row', np.int64, 0),
+                       ('area', np.float64, np.nan),
+                       ('centroid_lat', np.float64, np.nan),
+                       ('centroid_lon', np.float64, np.nan))
+
+    def __init__(self, capacity=1024):
+        """
+        :param capacity: the number of plumes to allocate room for
+        initially. Columns double in size whenever they fill up.
+        """
+        self.size = 0
+        self.history_size = 0
+        self.columns = self._allocate(self.COLUMNS, capacity)
+        self.history = self._allocate(self.HISTORY_COLUMNS, capacity)
+
+    @staticmethod
+    def _allocate(spec, capacity):
+        columns = {}
+        for name, dtype, default in spec:
+            columns[name] = np.empty(capacity, dtype=dtype)
+            columns[name][:] = default
+        return columns
+
+    @staticmethod
+    def _grow(columns, spec, size, needed):
+        # Double the capacity of every column until there is enough room
+        capacity = columns[spec[0][0]].shape[0]
+        if size + needed <= capacity:
+            return columns
+        while size + needed > capacity:
+            capacity *= 2
+        grown = PlumeTable._allocate(spec, capacity)
+        for name in columns:
+            grown[name][:size] = columns[name][:size]
+        return grown
+
+    def __len__(self):
+        return self.size
+
+    def to_arrays(self, active_only=False):
+        """
+        Gathers the filled part of every column, e.g. for a checkpoint
+        :param active_only: if True, only active plumes and their history
+        are gathered, renumbered from row 0, so the size does not grow
+        with the length of the run
+        :return: dictionary of arrays, with plume columns prefixed
+        'plume_' and history columns prefixed 'history_'
+        """
+
+        rows = np.arange(self.size)
+        entries = np.arange(self.history_size)
+        history_rows = self.history['row'][:self.history_size]
+        if active_only:
+            rows = self.active_rows()
+            entries = entries[np.isin(history_rows, rows)]
+            history_rows = np.searchsorted(rows, history_rows[entries])
+
+        arrays = {}
+        for name in self.columns:
+            arrays['plume_' + name] = self.columns[name][rows]
+        for name in self.history:
+            arrays['history_' + name] = self.history[name][entries]
+        arrays['history_row'] = history_rows
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuilds a table from the output of to_arrays
+        :param arrays: dictionary-like object of arrays
+        :return: a PlumeTable
+        """
+
+        size = len(arrays['plume_plume_id'])
+        history_size = len(arrays['history_time'])
+        table = cls(capacity=max(size, history_size, 1))
+        for name, dtype, default in cls.COLUMNS:
+            table.columns[name][:size] = arrays['plume_' + name]
+        for name, dtype, default in cls.HISTORY_COLUMNS:
+            table.history[name][:history_size] = arrays['history_' + name]
+        table.size = size
+        table.history_size = history_size
+
+        return table
+
+    def column(self, name):
+        """
+        :param name: the name of a column
+        :return: a view of the column over every plume in the table
+        """
+        return self.columns[name][:self.size]
+
+    def active_rows(self):
+        """
+        :return: array of the rows of every active plume
+        """
+        return np.flatnonzero(self.columns['active'][:self.size])
+
+    def active_ids(self):
+        """
+        :return: array of the IDs of every active plume
+        """
+        return self.columns['plume_id'][self.active_rows()]
+
+    def rows(self, plume_ids):
+        """
+        Looks up the rows of a set of active plumes
+        :param plume_ids: array of IDs of active plumes
+        :return: array of rows, in the same order as plume_ids
+        """
+
+        plume_ids = np.asarray(plume_ids, dtype=np.int64)
+        active_rows = self.active_rows()
+        active_ids = self.columns['plume_id'][active_rows]
+
+        order = np.argsort(active_ids)
+        sorted_ids = active_ids[order]
+        positions = np.searchsorted(sorted_ids, plume_ids)
+        found = positions < sorted_ids.shape[0]
+        found[found] = sorted_ids[positions[found]] == plume_ids[found]
+        if not np.all(found):
+            raise ValueError('Plume IDs are not active: ' +
+                             str(plume_ids[~found]))
+
+        return active_rows[order][positions]
+
+    def add(self, plume_ids, emission_time):
+        """
+        Adds newly emitted plumes to the table
+        :param plume_ids: array of IDs of the new plumes
+        :param emission_time: datetime object of the emission timestep
+        :return: array of the rows of the new plumes
+        """
+
+        plume_ids = np.asarray(plume_ids, dtype=np.int64)
+        n = plume_ids.shape[0]
+        self.columns = self._grow(self.columns, self.COLUMNS, self.size, n)
+
+        rows = np.arange(self.size, self.size + n)
+        self.columns['plume_id'][rows] = plume_ids
+        self.columns['emission_time'][rows] = np.datetime64(emission_time,
+                                                            'm')
+        self.columns['active'][rows] = True
+        self.size += n
+
+        return rows
+
+    def die(self, plume_ids):
+        """
+        Marks a set of plumes as no longer active
+        :param plume_ids: array of IDs of active plumes
+        """
+        self.columns['active'][self.rows(plume_ids)] = False
+
+    def update_position(self, plume_ids, time, area, centroid_lat,
+                        centroid_lon):
+        """
+        Sets the area and centroid of a set of active plumes. The source
+        location of a plume is the first centroid it is given.
+        :param plume_ids: array of IDs of active plumes
+        :param time: datetime object of the timestep
+        :param area: array of plume areas
+        :param centroid_lat: array of centroid latitudes
+        :param centroid_lon: array of centroid longitudes
+        """
+
+        rows = self.rows(plume_ids)
+        c = self.columns
+
+        # Keep the last position so speed and direction can be derived
+        c['previous_lat'][rows] = c['centroid_lat'][rows]
+        c['previous_lon'][rows] = c['centroid_lon'][rows]
+        c['previous_time'][rows] = c['position_time'][rows]
+
+        c['area'][rows] = area
+        c['centroid_lat'][rows] = centroid_lat
+        c['centroid_lon'][rows] = centroid_lon
+        c['position_time'][rows] = np.datetime64(time, 'm')
+
+        new_source = np.isnan(c['source_lat'][rows])
+        c['source_lat'][rows[new_source]] = c['centroid_lat'][
+            rows[new_source]]
+        c['source_lon'][rows[new_source]] = c['centroid_lon'][
+            rows[new_source]]
+
+    def update_duration(self, time):
+        """
+        Sets the duration of every active plume to the time since emission
+        :param time: datetime object of the timestep
+        """
+
+        rows = self.active_rows()
+        elapsed = np.datetime64(time, 'm') - \
+            self.columns['emission_time'][rows]
+        self.columns['duration'][rows] = elapsed / np.timedelta64(1, 'h')
+
+    def _moved_rows(self):
+        # Active plumes with two positions at different times
+        rows = self.active_rows()
+        c = self.columns
+        moved = ~np.isnan(c['previous_lat'][rows]) & \
+            (c['position_time'][rows] > c['previous_time'][rows])
+        return rows[moved]
+
+    def update_speed(self):
+        """
+        Sets the centroid speed (m/s) of every active plume from its last
+        two positions
+        """
+
+        rows = self._moved_rows()
+        c = self.columns
+        distance = great_circle_distance(c['previous_lat'][rows],
+                                         c['previous_lon'][rows],
+                                         c['centroid_lat'][rows],
+                                         c['centroid_lon'][rows])
+        seconds = (c['position_time'][rows] - c['previous_time'][rows]) / \
+            np.timedelta64(1, 's')
+        c['centroid_speed'][rows] = distance / seconds
+
+    def update_direction(self):
+        """
+        Sets the centroid direction of travel (degrees clockwise from north)
+        of every active plume from its last two positions
+        """
+
+        rows = self._moved_rows()
+        c = self.columns
+        c['centroid_direction'][rows] = initial_bearing(
+            c['previous_lat'][rows], c['previous_lon'][rows],
+            c['centroid_lat'][rows], c['centroid_lon'][rows])
+
+    def update_axes(self, plume_ids, major_axis, minor_axis):
+        """
+        Sets the major and minor axis lengths of a set of active plumes
+        :param plume_ids: array of IDs of active plumes
+        :param major_axis: array of major axis lengths
+        :param minor_axis: array of minor axis lengths
+        """
+
+        rows = self.rows(plume_ids)
+        self.columns['major_axis_position'][rows] = major_axis
+        self.columns['minor_axis_position'][rows] = minor_axis
+
+    def update(self, time, sdf_clusters, plume_ids, lons, lats):
+        """
+        Measures every active plume in a labelled raster and updates its
+        position, area, axes, duration, speed and direction in one call.
+        Active plumes which are not in the raster, e.g. held by an
+        advection.AdvectionMatcher, keep their last measurements and are
+        marked dormant.
+        :param time: datetime object of the timestep
+        :param sdf_clusters: array of plume IDs from scan_for_plumes
+        :param plume_ids: sorted array of the IDs of every plume in the
+        raster
+        :param lons: array of pixel longitudes
+        :param lats: array of pixel latitudes
+        """
+
+        stats = plume_statistics(sdf_clusters, plume_ids, lons, lats)
+        self.update_position(plume_ids, time, stats['area'],
+                             stats['centroid_lat'], stats['centroid_lon'])
+        self.update_axes(plume_ids, stats['major_axis'],
+                         stats['minor_axis'])
+        self.update_duration(time)
+        self.update_speed()
+        self.update_direction()
+
+        rows = self.active_rows()
+        self.columns['dormant'][rows] = ~np.isin(
+            self.columns['plume_id'][rows], plume_ids)
+
+    def update_convection(self, plume_ids, cell_distance):
+        """
+        Keeps the closest distance to convection of a set of active plumes
+        over their lifetime
+        :param plume_ids: array of IDs of active plumes
+        :param cell_distance: array of the distance in pixels of each plume
+        to its nearest convective cell at this timestep, inf if none
+        """
+
+        rows = self.rows(plume_ids)
+        distance = self.columns['convection_distance']
+        distance[rows] = np.minimum(distance[rows], cell_distance)
+
+    def update_mechanism_likelihood(self, plume_ids=None,
+                                    min_duration=config.CLASSIFICATION_AGE):
+        """
+        Scores every active plume which is not yet classified and is old
+        enough to have an early-life speed and direction for LLJ and CPO
+        emission, all in one pass. Each plume is classified once.
+        :param plume_ids: array of IDs of active plumes to classify
+        whatever their age, e.g. plumes which are about to die, or None
+        :param min_duration: hours after emission at which a plume is
+        classified
+        :return: array of the IDs of the plumes classified
+        """
+
+        c = self.columns
+        if plume_ids is None:
+            rows = self.active_rows()
+            rows = rows[c['duration'][rows] >= min_duration]
+        else:
+            rows = self.rows(plume_ids)
+        rows = rows[~c['classified'][rows]]
+
+        # Local solar time of emission at the plume source
+        emission_time = c['emission_time'][rows]
+        minutes = (emission_time - emission_time.astype('datetime64[D]')) / \
+            np.timedelta64(1, 'm')
+        local_hour = (minutes / 60 + c['source_lon'][rows] / 15) % 24
+
+        c['LLJ_likelihood'][rows], c['CPO_likelihood'][rows] = \
+            mechanism_likelihoods(local_hour, c['convection_distance'][rows],
+                                  c['centroid_speed'][rows],
+                                  c['centroid_direction'][rows])
+        c['classified'][rows] = True
+
+        return c['plume_id'][rows]
+
+    def classified_ids(self):
+        """
+        :return: sorted array of the IDs of every classified plume
+        """
+        return np.sort(self.column('plume_id')[self.column('classified')])
+
+    def record(self, time):
+        """
+        Appends the area and centroid of every active plume to the history,
+        except dormant plumes, which were not measured at this timestep
+        :param time: datetime object of the timestep
+        """
+
+        rows = self.active_rows()
+        rows = rows[~self.columns['dormant'][rows]]
+        n = rows.shape[0]
+        self.history = self._grow(self.history, self.HISTORY_COLUMNS,
+                                  self.history_size, n)
+
+        entries = slice(self.history_size, self.history_size + n)
+        self.history['time'][entries] = np.datetime64(time, 'm')
+        self.history['row'][entries] = rows
+        for name in ('area', 'centroid_lat', 'centroid_lon'):
+            self.history[name][entries] = self.columns[name][rows]
+        self.history_size += n
+
+    def get_history(self, plume_id):
+        """
+        Reads the recorded history of the most recent plume with an ID
+        :param plume_id: ID of the plume
+        :return: dictionary with an array for each history column
+        """
+
+        row = np.flatnonzero(self.column('plume_id') == plume_id)[-1]
+        entries = np.flatnonzero(self.history['row'][:self.history_size] ==
+                                 row)
+
+        return dict((name, self.history[name][entries]) for name, dtype,
+                    default in self.HISTORY_COLUMNS if name != 'row')
+
+    def get_plume(self, plume_id):
+        """
+        Builds a Plume object from the most recent plume with an ID
+        :param plume_id: ID of the plume
+        :return: a Plume object
+        """
+
+        row = np.flatnonzero(self.column('plume_id') == plume_id)[-1]
+        emission_time = self.columns['emission_time'][row].astype(
+            datetime.datetime).strftime("%Y%m%d%H%M")
+        plume = Plume(int(plume_id), emission_time)
+        for name in Plume.__slots__:
+            if name not in ('plume_id', 'emission_time'):
+                setattr(plume, name, float(self.columns[name][row]))
+
+        return plume
+
+## Class of convection objects
+# Convective cells are tracked with this same engine by
+# convection.ConvectionTracker, which keeps them in a PlumeTable
 
 # Functions to cloud screen, generate SDFs and categorise to get instances
 # of objects, so main should only have to run these at each timestep,
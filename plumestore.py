@@ -0,0 +1,287 @@
+import sqlite3
+import numpy as np
+
+import plumes
+
+"""
+Catalogue of plume objects for a tracking run. Plume attributes are kept
+in an indexed table with one row per plume, and every timestep appends a
+row per active plume to a log, with plumes which are only being held until
+they are found again marked dormant, so plumes can be looked up by ID, emission
+time or the times they were active without unpickling anything. A plume is
+identified by its ID together with its emission time, so a plume can never
+overwrite the record of an earlier plume given the same ID.
+"""
+
+# Plume attributes stored as columns of the plume table, in column order
+PLUME_FIELDS = ('plume_id', 'emission_time', 'area', 'centroid_lat',
+                'centroid_lon', 'source_lat', 'source_lon',
+                'centroid_speed', 'centroid_direction', 'duration',
+                'major_axis_position', 'minor_axis_position',
+                'LLJ_likelihood', 'CPO_likelihood')
+
+# Plume attributes logged for each active plume at every timestep
+LOG_FIELDS = ('area', 'centroid_lat', 'centroid_lon')
+
+# Plume attributes updated for a plume already in the catalogue
+_UPDATE_FIELDS = PLUME_FIELDS[2:]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plumes (
+    plume_id INTEGER NOT NULL,
+    emission_time TEXT NOT NULL,
+    area REAL,
+    centroid_lat REAL,
+    centroid_lon REAL,
+    source_lat REAL,
+    source_lon REAL,
+    centroid_speed REAL,
+    centroid_direction REAL,
+    duration REAL,
+    major_axis_position REAL,
+    minor_axis_position REAL,
+    LLJ_likelihood REAL,
+    CPO_likelihood REAL,
+    PRIMARY KEY (plume_id, emission_time)
+);
+CREATE INDEX IF NOT EXISTS plumes_emission_time ON plumes (emission_time);
+CREATE TABLE IF NOT EXISTS plume_log (
+    time TEXT,
+    plume_id INTEGER,
+    emission_time TEXT,
+    area REAL,
+    centroid_lat REAL,
+    centroid_lon REAL,
+    dormant INTEGER
+);
+CREATE INDEX IF NOT EXISTS plume_log_time ON plume_log (time);
+CREATE INDEX IF NOT EXISTS plume_log_plume_id ON plume_log (plume_id);
+"""
+
+
+def _to_sql(value):
+    # sqlite only accepts built-in Python scalars
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _to_datestring(time):
+    # Emission times are stored as datestrings
+    if hasattr(time, 'strftime'):
+        return time.strftime("%Y%m%d%H%M")
+    return time
+
+
+class PlumeStore(object):
+    """
+    A plume catalogue backed by a single SQLite file. One connection is held
+    open for the whole run and each timestep is committed as one batch.
+    Times are datestrings of the form YYYYmmddHHMM, which sort in time
+    order.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: path of the catalogue file, created if it does not
+        exist
+        """
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_timestep(self, date, active_plumes):
+        """
+        Stores the current attributes of every active plume and appends
+        them to the timestep log, committing both in a single transaction
+        :param date: datestring of the timestep
+        :param active_plumes: iterable of Plume objects active at this
+        timestep
+        """
+
+        plume_rows = []
+        log_rows = []
+        for plume in active_plumes:
+            row = [_to_sql(getattr(plume, field)) for field in PLUME_FIELDS]
+            row[1] = _to_datestring(row[1])
+            plume_rows.append(tuple(row))
+            log_rows.append((date, row[0], row[1]) +
+                            tuple(_to_sql(getattr(plume, field)) for
+                                  field in LOG_FIELDS) + (False,))
+
+        self._write(plume_rows, log_rows)
+
+    def write_table(self, date, plume_table):
+        """
+        Stores every active plume of a PlumeTable straight from its columns
+        and appends them to the timestep log in a single transaction.
+        Dormant plumes are logged with their last measurements and marked
+        dormant.
+        :param date: datestring of the timestep
+        :param plume_table: a plumes.PlumeTable
+        """
+
+        rows = plume_table.active_rows()
+        columns = dict((field, plume_table.column(field)[rows].tolist())
+                       for field in PLUME_FIELDS)
+        columns['emission_time'] = [i.strftime("%Y%m%d%H%M") for i in
+                                    columns['emission_time']]
+
+        plume_rows = list(zip(*[columns[field] for field in PLUME_FIELDS]))
+        log_rows = list(zip(*[[date] * rows.shape[0],
+                              columns['plume_id'],
+                              columns['emission_time']] +
+                            [columns[field] for field in LOG_FIELDS] +
+                            [plume_table.column('dormant')[rows].tolist()]))
+
+        self._write(plume_rows, log_rows)
+
+    def write_likelihoods(self, plume_table, plume_ids):
+        """
+        Stores the LLJ and CPO likelihoods of a set of plumes, e.g. plumes
+        classified as they die, which are not written again
+        :param plume_table: a plumes.PlumeTable
+        :param plume_ids: array of IDs of active plumes in the table
+        """
+
+        rows = plume_table.rows(plume_ids)
+        emission_times = [i.strftime("%Y%m%d%H%M") for i in
+                          plume_table.column('emission_time')[rows].tolist()]
+        updates = list(zip(plume_table.column('LLJ_likelihood')[rows].tolist(),
+                           plume_table.column('CPO_likelihood')[rows].tolist(),
+                           plume_table.column('plume_id')[rows].tolist(),
+                           emission_times))
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE plumes SET LLJ_likelihood = ?, CPO_likelihood = ? '
+                'WHERE plume_id = ? AND emission_time = ?', updates)
+
+    def _write(self, plume_rows, log_rows):
+        # Plumes already in the catalogue are updated, then the rest are
+        # inserted. Rows are only ever matched on both ID and emission
+        # time, so no other plume's row is replaced.
+        updates = [row[2:] + row[:2] for row in plume_rows]
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE plumes SET ' +
+                ', '.join(field + ' = ?' for field in _UPDATE_FIELDS) +
+                ' WHERE plume_id = ? AND emission_time = ?', updates)
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO plumes VALUES (' +
+                ', '.join(['?'] * len(PLUME_FIELDS)) + ')', plume_rows)
+            self.connection.executemany(
+                'INSERT INTO plume_log VALUES (' +
+                ', '.join(['?'] * (len(LOG_FIELDS) + 4)) + ')', log_rows)
+
+    def rollback_after(self, date):
+        """
+        Removes everything written for timesteps after a given one, e.g.
+        the slots processed after the checkpoint a run is resuming from
+        :param date: datestring of the last timestep to keep
+        """
+
+        with self.connection:
+            self.connection.execute('DELETE FROM plume_log WHERE time > ?',
+                                    (date,))
+            self.connection.execute('DELETE FROM plumes WHERE '
+                                    'emission_time > ?', (date,))
+
+    def get_plume(self, plume_id, emission_time=None):
+        """
+        Rebuilds a single plume object from the catalogue
+        :param plume_id: ID of the plume
+        :param emission_time: datestring (or datetime object) of the
+        plume's emission, or None for the latest plume emitted with the ID
+        :return: a Plume object, or None if the ID is not in the catalogue
+        """
+
+        query = 'SELECT ' + ', '.join(PLUME_FIELDS) + \
+            ' FROM plumes WHERE plume_id = ?'
+        parameters = (_to_sql(plume_id),)
+        if emission_time is not None:
+            query += ' AND emission_time = ?'
+            parameters += (_to_datestring(emission_time),)
+        row = self.connection.execute(
+            query + ' ORDER BY emission_time DESC', parameters).fetchone()
+        if row is None:
+            return None
+
+        plume = plumes.Plume(row[0], row[1])
+        for field, value in zip(PLUME_FIELDS[2:], row[2:]):
+            setattr(plume, field, value)
+
+        return plume
+
+    def active_at(self, date):
+        """
+        Finds every plume which was detected at a given timestep, leaving
+        out dormant plumes
+        :param date: datestring of the timestep
+        :return: array of plume IDs
+        """
+
+        rows = self.connection.execute(
+            'SELECT plume_id FROM plume_log WHERE time = ? AND NOT dormant '
+            'ORDER BY plume_id', (date,)).fetchall()
+
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def emitted_between(self, date_lower, date_upper):
+        """
+        Finds every plume emitted within a time window
+        :param date_lower: datestring of the start of the window (inclusive)
+        :param date_upper: datestring of the end of the window (inclusive)
+        :return: array of plume IDs
+        """
+
+        rows = self.connection.execute(
+            'SELECT plume_id FROM plumes WHERE emission_time BETWEEN ? AND '
+            '? ORDER BY emission_time, plume_id',
+            (date_lower, date_upper)).fetchall()
+
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def get_history(self, plume_id, emission_time=None):
+        """
+        Reads the logged attributes of a plume at every timestep it was
+        active
+        :param plume_id: ID of the plume
+        :param emission_time: datestring (or datetime object) of the
+        plume's emission, or None for the latest plume emitted with the ID
+        :return: dictionary with an array of times and an array for each
+        logged attribute
+        """
+
+        if emission_time is None:
+            row = self.connection.execute(
+                'SELECT MAX(emission_time) FROM plumes WHERE plume_id = ?',
+                (_to_sql(plume_id),)).fetchone()
+            emission_time = row[0]
+        rows = self.connection.execute(
+            'SELECT time, ' + ', '.join(LOG_FIELDS) + ' FROM plume_log '
+            'WHERE plume_id = ? AND emission_time = ? ORDER BY time',
+            (_to_sql(plume_id), _to_datestring(emission_time))).fetchall()
+
+        history = {'time': np.array([row[0] for row in rows])}
+        for i, field in enumerate(LOG_FIELDS):
+            history[field] = np.array([row[i + 1] for row in rows],
+                                      dtype=float)
+
+        return history
+
+    def close(self):
+        """
+        Commits anything outstanding and closes the catalogue
+        """
+
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
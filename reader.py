@@ -0,0 +1,241 @@
+import threading
+import numpy as np
+from netCDF4 import Dataset
+
+import config
+import metrics
+import utilities
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+"""
+Streaming reader for the SDF and brightness temperature archive. Slots are
+read ahead of the tracker in a background thread so that file I/O overlaps
+with labelling and matching
+"""
+
+# Sentinel marking the end of the slots
+_DONE = object()
+
+
+class _MissingSlot(object):
+
+    def __init__(self, slot, error):
+        self.slot = slot
+        self.error = error
+
+
+class _ReadError(object):
+
+    def __init__(self, error):
+        self.error = error
+
+
+def get_region_window(lons, lats, extent):
+    """
+    Turns a lon/lat bounding box into the smallest index window of the grid
+    which contains it
+    :param lons: 2D array (optionally masked) of pixel longitudes
+    :param lats: 2D array (optionally masked) of pixel latitudes
+    :param extent: (lon_min, lon_max, lat_min, lat_max) of the region, or
+    None for the whole grid
+    :return: a (row slice, column slice) tuple
+    """
+
+    if extent is None:
+        return (slice(None), slice(None))
+
+    lon_min, lon_max, lat_min, lat_max = extent
+    valid = ~(np.ma.getmaskarray(lons) | np.ma.getmaskarray(lats))
+    lons = np.ma.getdata(lons)
+    lats = np.ma.getdata(lats)
+    inside = valid & (lons >= lon_min) & (lons <= lon_max) & \
+        (lats >= lat_min) & (lats <= lat_max)
+
+    rows = np.flatnonzero(inside.any(axis=1))
+    columns = np.flatnonzero(inside.any(axis=0))
+    if rows.shape[0] == 0:
+        raise ValueError('No pixels of the grid lie within ' + str(extent))
+
+    return (slice(int(rows[0]), int(rows[-1]) + 1),
+            slice(int(columns[0]), int(columns[-1]) + 1))
+
+
+def read_variable(filename, variable, window=None,
+                  record=metrics.NULL_RECORD, stage='read'):
+    """
+    Reads a variable from a netCDF file and closes the file
+    :param filename: path of the netCDF file
+    :param variable: name of the variable to read
+    :param window: a (row slice, column slice) tuple from
+    get_region_window, so only that hyperslab is read from disk, or None
+    to read the whole variable
+    :param record: a metrics.SlotRecord in which opening the file and
+    reading the variable are measured as the stages stage + '_open' and
+    stage + '_read'
+    :param stage: prefix of the stage names
+    :return: the decoded (masked) array
+    """
+
+    with record.stage(stage + '_open'):
+        nc = Dataset(filename)
+    try:
+        with record.stage(stage + '_read'):
+            if window is None:
+                data = nc.variables[variable][:]
+            else:
+                data = nc.variables[variable][window]
+    finally:
+        nc.close()
+
+    return data
+
+
+def read_region_grids(extent):
+    """
+    Reads the lon/lat grids of the archive and crops them to a region. The
+    grids are read whole once per run to find the window, after which
+    every slot read is limited to it.
+    :param extent: (lon_min, lon_max, lat_min, lat_max) of the region, or
+    None for the whole grid
+    :return window: a (row slice, column slice) tuple for the region
+    :return lons: masked array of longitudes within the window
+    :return lats: masked array of latitudes within the window
+    """
+
+    lons = read_variable(config.LONLAT_FILE, 'longitude')
+    lats = read_variable(config.LONLAT_FILE, 'latitude')
+
+    # Pixels off the edge of the disk have fill values above 360 and 90
+    lons = np.ma.array(lons, mask=lons > 360)
+    lats = np.ma.array(lats, mask=lats > 90)
+
+    window = get_region_window(lons, lats, extent)
+
+    return window, lons[window], lats[window]
+
+
+class SlotReader(object):
+    """
+    Iterates over a sequence of slots, yielding (slot, sdf, bt) for each
+    slot whose files could be read. Up to prefetch slots are read ahead in
+    a background thread. Slots with missing or unreadable files are
+    reported, recorded in the missing attribute and skipped.
+    """
+
+    def __init__(self, datetimes, prefetch=config.PREFETCH_SLOTS,
+                 read_bt=True, window=None, metrics=None):
+        """
+        :param datetimes: array of datetime objects for the slots to read
+        :param prefetch: the number of slots to read ahead
+        :param read_bt: if False, only the SDF is read and bt is None
+        :param window: a (row slice, column slice) tuple from
+        get_region_window to read only a region, or None for the whole grid
+        :param metrics: a metrics.PipelineMetrics in which the reads of
+        each slot, and the time spent waiting for them, are measured, or
+        None
+        """
+        self.datetimes = datetimes
+        self.prefetch = prefetch
+        self.read_bt = read_bt
+        self.window = window
+        self.metrics = metrics
+        self.missing = []
+        self._queue = None
+        self._stop = None
+        self._thread = None
+
+    def _record(self, slot):
+        if self.metrics is None:
+            return metrics.NULL_RECORD
+        return self.metrics.slot(slot)
+
+    def read_slot(self, slot):
+        """
+        Reads the SDF and BT fields for a single slot
+        :param slot: a datetime object for the slot
+        :return: the SDF array and the BT array (None if read_bt is False)
+        """
+
+        record = self._record(slot)
+        sdf = read_variable(utilities.get_slot_filename(config.SDF_FILE,
+                                                        slot),
+                            config.SDF_VARIABLE, self.window, record, 'sdf')
+        bt = None
+        if self.read_bt:
+            bt = read_variable(utilities.get_slot_filename(config.BT_FILE,
+                                                           slot),
+                               config.BT_VARIABLE, self.window, record,
+                               'bt')
+
+        return sdf, bt
+
+    def _put(self, item):
+        # Block while the queue is full, but give up if the reader is closed
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for slot in self.datetimes:
+                try:
+                    sdf, bt = self.read_slot(slot)
+                    item = (slot, sdf, bt)
+                except (IOError, OSError) as e:
+                    item = _MissingSlot(slot, e)
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(_ReadError(e))
+            return
+        self._put(_DONE)
+
+    def __iter__(self):
+        self._queue = queue.Queue(maxsize=max(self.prefetch, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        try:
+            while True:
+                wait = metrics.SlotRecord(None)
+                with wait.stage('read_wait'):
+                    item = self._queue.get()
+                if item is _DONE:
+                    break
+                elif isinstance(item, _ReadError):
+                    raise item.error
+                elif isinstance(item, _MissingSlot):
+                    print('Skipping missing slot ' +
+                          item.slot.strftime("%Y%m%d%H%M") + ': ' +
+                          str(item.error))
+                    self.missing.append(item.slot)
+                    if self.metrics is not None:
+                        self.metrics.discard(item.slot)
+                else:
+                    # The wait is counted against the slot it was for
+                    self._record(item[0]).merge(wait)
+                    yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops the background thread. Files are only held open while a slot
+        is being read, so no handles are left behind.
+        """
+
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,164 @@
+import os
+import re
+import numpy as np
+
+"""
+Generation and formatting of arrays of time slots, and an index of which
+slots have files in the archive. Slots are datetime64[m] arrays and every
+operation works on the whole array at once.
+"""
+
+# Month names used in the archive directory names, e.g. JUNE2012
+MONTH_NAMES = np.array(['JANUARY', 'FEBRUARY', 'MARCH', 'APRIL', 'MAY',
+                        'JUNE', 'JULY', 'AUGUST', 'SEPTEMBER', 'OCTOBER',
+                        'NOVEMBER', 'DECEMBER'])
+
+# Directory listings already read in this run, keyed by directory
+_listing_cache = {}
+
+
+def slot_range(lower, upper, cadence=15):
+    """
+    Generates the slots from lower to upper inclusive at a fixed cadence.
+    If upper is not on the cadence, the range runs on to the next slot
+    after it.
+    :param lower: datetime object (or datetime64) of the first slot
+    :param upper: datetime object (or datetime64) of the last slot
+    :param cadence: minutes between slots
+    :return: datetime64[m] array of slots
+    """
+
+    lower = np.datetime64(lower, 'm')
+    upper = np.datetime64(upper, 'm')
+
+    cadence = np.timedelta64(cadence, 'm')
+
+    return np.arange(lower, upper + cadence, cadence)
+
+
+def slots_from_time_params(time_params, cadence=15):
+    """
+    Generates the slots within the bounds of a time_params array
+    :param time_params: an array of integers corresponding to time bounds,
+    as (year_lower, year_upper, month_lower, month_upper, day_lower,
+    day_upper, hour_lower, hour_upper, minute_lower, minute_upper)
+    :param cadence: minutes between slots
+    :return: datetime64[m] array of slots
+    """
+
+    lower = '%04d-%02d-%02dT%02d:%02d' % tuple(time_params[0::2])
+    upper = '%04d-%02d-%02dT%02d:%02d' % tuple(time_params[1::2])
+
+    return slot_range(np.datetime64(lower), np.datetime64(upper), cadence)
+
+
+def slot_fields(slots):
+    """
+    Splits slots into calendar fields without a Python loop
+    :param slots: datetime64 (or datetime object) array of slots
+    :return: integer arrays of years, months, days, hours and minutes
+    """
+
+    slots = np.asarray(slots, dtype='datetime64[m]')
+    years = slots.astype('datetime64[Y]')
+    months = slots.astype('datetime64[M]')
+    days = slots.astype('datetime64[D]')
+    hours = slots.astype('datetime64[h]')
+
+    return (years.astype(np.int64) + 1970,
+            (months - years).astype(np.int64) + 1,
+            (days - months).astype(np.int64) + 1,
+            (hours - days).astype(np.int64),
+            (slots - hours).astype(np.int64))
+
+
+def format_datestrings(slots):
+    """
+    Formats slots as archive datestrings (YYYYmmddHHMM)
+    :param slots: datetime64 (or datetime object) array of slots
+    :return: string array of datestrings
+    """
+
+    year, month, day, hour, minute = slot_fields(slots)
+    number = (((year * 100 + month) * 100 + day) * 100 + hour) * 100 + \
+        minute
+
+    return number.astype('U12')
+
+
+def format_months(slots):
+    """
+    Formats slots as archive month directory names (e.g. JUNE2012)
+    :param slots: datetime64 (or datetime object) array of slots
+    :return: string array of month names
+    """
+
+    year, month = slot_fields(slots)[:2]
+
+    return np.char.add(MONTH_NAMES[month - 1], year.astype('U4'))
+
+
+def format_filenames(template, slots):
+    """
+    Fills in an archive file template for every slot
+    :param template: a file template from config, e.g. config.SDF_FILE
+    :param slots: datetime64 (or datetime object) array of slots
+    :return: string array of file paths
+    """
+
+    fields = {'{month}': format_months(slots),
+              '{date}': format_datestrings(slots)}
+
+    # Join the literal parts of the template and the formatted fields
+    filenames = np.zeros(np.shape(slots), dtype='U1')
+    for part in re.split(r'(\{month\}|\{date\})', template):
+        filenames = np.char.add(filenames, fields.get(part, part))
+
+    return filenames
+
+
+def list_directory(directory, refresh=False):
+    """
+    Lists a directory once and caches the result for the run
+    :param directory: path of the directory
+    :param refresh: if True, the directory is listed again, e.g. to pick
+    up slots which have arrived since
+    :return: sorted string array of the file names, empty if the
+    directory does not exist
+    """
+
+    if refresh or directory not in _listing_cache:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            names = []
+        _listing_cache[directory] = np.sort(np.array(names, dtype='U'))
+
+    return _listing_cache[directory]
+
+
+def slot_availability(template, slots, refresh=False):
+    """
+    Finds which slots have a file in the archive, from one directory
+    listing per directory instead of a file check per slot
+    :param template: a file template from config, e.g. config.SDF_FILE
+    :param slots: datetime64 (or datetime object) array of slots
+    :param refresh: if True, cached directory listings are read again
+    :return: boolean array, True where the slot's file exists
+    """
+
+    filenames = format_filenames(template, slots)
+    available = np.zeros(filenames.shape, dtype=bool)
+    if filenames.shape[0] == 0:
+        return available
+
+    # The directory part only changes with the month, so each distinct
+    # directory is listed once
+    split = np.char.rpartition(filenames, '/')
+    directories = np.char.add(split[:, 0], split[:, 1])
+    for directory in np.unique(directories):
+        in_directory = directories == directory
+        available[in_directory] = np.isin(
+            split[in_directory, 2], list_directory(directory, refresh))
+
+    return available